@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+"""
+An asyncio GitHub client, for fanning out many more requests at once than
+is practical with threads. Requires aiohttp, which is installed with the
+'async' extra.
+"""
+import asyncio
+import collections
+import json
+import logging
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from preserve import github
+from preserve.github import (
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_PER_PAGE,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_REF_WORKERS,
+    DEFAULT_TIMEOUT,
+    REF_NAMESPACES,
+    GitHubError,
+    RefSyncError,
+    extract_page,
+    ref_details,
+    remaining_page_urls,
+    repository_details,
+    set_query_parameter,
+)
+from preserve.ratelimit import rate_limit_resource
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+logger = logging.getLogger()
+
+
+class AsyncResponse(object):
+    """ A fully read aiohttp response, which quacks enough like a requests
+        response for the RateLimiter and ResponseCache """
+
+    def __init__(self, status_code, headers, links, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.links = links
+        self.content = content
+        self.request = None
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class AsyncGitHubClient(object):
+    """ An asyncio client for the GitHub API, with the same operations as
+        the functions in preserve.github. Use it as an async context
+        manager; it owns a pooled aiohttp session for its lifetime.
+
+        Like GitHubClient, it can be given a ResponseCache, a RateLimiter
+        and a Metrics. """
+
+    def __init__(self, headers=None, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, cache=None, rate_limiter=None,
+                 max_retries=DEFAULT_MAX_RETRIES, metrics=None):
+        if aiohttp is None:
+            raise ImportError("The async client requires aiohttp; install "
+                              "codepreserve[async]")
+        if headers is None:
+            headers = github.HEADERS
+        self.headers = {'Accept': 'application/vnd.github.v3+json'}
+        self.headers.update(headers)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def request(self, method, url, **kwargs):
+        """ Make a request, waiting for the rate limiter if there is one and
+            retrying requests that were rate limited """
+        if self.rate_limiter is None:
+            return await self.measure(method, url, **kwargs)
+
+        resource = rate_limit_resource(url)
+        for attempt in range(self.max_retries + 1):
+            delay = self.rate_limiter.delay(resource)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            response = await self.measure(method, url, **kwargs)
+            self.rate_limiter.update(response, resource)
+
+            delay = self.rate_limiter.retry(response, resource)
+            if delay is None or attempt == self.max_retries:
+                break
+            logger.warning("Rate limited, retrying {} in {:.0f}s".format(
+                url, delay))
+            if self.metrics is not None:
+                self.metrics.record_retry(method, url)
+
+        return response
+
+    async def measure(self, method, url, **kwargs):
+        """ Send a request, recording it if we have a Metrics """
+        if self.metrics is None:
+            return await self.send(method, url, **kwargs)
+
+        start = time.time()
+        response = await self.send(method, url, **kwargs)
+        self.metrics.record_request(method, url, response,
+                                    time.time() - start,
+                                    data=kwargs.get('data'))
+        return response
+
+    async def send(self, method, url, **kwargs):
+        """ Make a request using the pooled session """
+        entry = None
+        if method == 'GET' and self.cache is not None:
+            entry = self.cache.lookup(url)
+        if entry is not None:
+            headers = self.cache.conditional_headers(entry)
+            headers.update(kwargs.pop('headers', None) or {})
+            kwargs['headers'] = headers
+
+        async with self.session.request(method, url, **kwargs) as response:
+            content = await response.read()
+            links = {rel: {'url': str(link['url'])}
+                     for rel, link in response.links.items()}
+            response = AsyncResponse(response.status, response.headers,
+                                     links, content)
+
+        if method != 'GET' or self.cache is None:
+            return response
+        if response.status_code == 304 and entry is not None:
+            return self.cache.response(entry, response)
+        self.cache.store(url, response)
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request('PATCH', url, **kwargs)
+
+    async def rate_limit(self):
+        """ Check GitHub rate limit """
+        rate_limit_url = '/'.join([github.GITHUB_API_URL, 'rate_limit'])
+        response = await self.get(rate_limit_url)
+        response_json = response.json()
+        limit = response_json['rate']['limit']
+        remaining = response_json['rate']['remaining']
+        reset = response_json['rate']['reset']
+        return (limit, remaining, reset)
+
+    async def github_api_page(self, url, extract=None):
+        """ Fetch a single page of results for the given URL """
+        response = await self.get(url)
+        if response.status_code != 200:
+            raise GitHubError(response.json()['message'])
+        return extract_page(response.json(), extract)
+
+    async def github_api_all(self, url, extract=None):
+        """ Fetch all results for the given URL, fetching every page after
+            the first at once, and converting each page with extract as it
+            arrives if it is given """
+        if 'per_page' not in parse_qs(urlsplit(url).query):
+            url = set_query_parameter(url, 'per_page', DEFAULT_PER_PAGE)
+
+        response = await self.get(url)
+        if response.status_code != 200:
+            raise GitHubError(response.json()['message'])
+
+        response_json = extract_page(response.json(), extract)
+        if 'next' not in response.links:
+            return response_json
+
+        page_urls = remaining_page_urls(response.links)
+        if page_urls is None:
+            while 'next' in response.links:
+                response = await self.get(response.links['next']['url'])
+                response_json += extract_page(response.json(), extract)
+            return response_json
+
+        pages = await asyncio.gather(*[
+            self.github_api_page(page_url, extract=extract)
+            for page_url in page_urls])
+        for page_json in pages:
+            response_json += page_json
+        return response_json
+
+    async def list_repository_details(self, user_or_org):
+        """ List a user/org's repositories with the metadata we use """
+        repos_url = '/'.join([github.GITHUB_API_URL, 'orgs', user_or_org,
+                              'repos'])
+        return await self.github_api_all(repos_url,
+                                         extract=repository_details)
+
+    async def list_repositories(self, user_or_org):
+        """ List a user/org's repositories """
+        return [r.name
+                for r in await self.list_repository_details(user_or_org)]
+
+    async def fork_exists(self, origin_user, origin_repository,
+                          destination_org, fork_name=None):
+        """ Check if a fork exists for an org """
+        if fork_name is None:
+            fork_name = origin_repository
+
+        existing_url = '/'.join([
+            github.GITHUB_API_URL,
+            'repos',
+            destination_org,
+            fork_name
+        ])
+        existing_response = await self.get(existing_url)
+        if existing_response.status_code == 200:
+            if existing_response.json()['fork'] is True:
+                return True
+            raise GitHubError(fork_name + ' already exists and is not a fork')
+        return False
+
+    async def fork_repository(self, origin_user, origin_repository,
+                              destination_org, name=None):
+        """ Fork an origin user/org's repository to an org, asking for the
+            fork to be given name if one is given. Returns the name GitHub
+            gave the fork, as github.fork_repository does. """
+        fork_url = '/'.join([
+            github.GITHUB_API_URL,
+            'repos',
+            origin_user,
+            origin_repository,
+            'forks'
+        ])
+        parameters = {'organization': destination_org}
+        if name is not None:
+            parameters['name'] = name
+        fork_response = await self.post(fork_url,
+                                        data=json.dumps(parameters))
+        if fork_response.status_code != 202:
+            raise GitHubError(fork_response.json()['message'])
+
+        return fork_response.json()['name']
+
+    async def rename_repository(self, user_or_org, old_name, new_name):
+        """ Rename a repository """
+        edit_url = '/'.join([
+            github.GITHUB_API_URL,
+            'repos',
+            user_or_org,
+            old_name,
+        ])
+        parameters = json.dumps({'name': new_name})
+        edit_response = await self.post(edit_url, data=parameters)
+        if edit_response.status_code != 200:
+            raise GitHubError(edit_response.json()['message'])
+
+        return True
+
+    async def list_refs(self, user_or_org, repository):
+        """ Get a map of a repository's branches and tags, by their full ref
+            names, to the SHAs they point at """
+        refs = await asyncio.gather(*[
+            self.github_api_all('/'.join([
+                github.GITHUB_API_URL,
+                'repos',
+                user_or_org,
+                repository,
+                'git', 'matching-refs',
+                namespace,
+            ]), extract=ref_details)
+            for namespace in REF_NAMESPACES])
+        return collections.OrderedDict(
+            ref for namespace_refs in refs for ref in namespace_refs)
+
+    async def write_ref(self, fork_user, fork_repository, ref, commit,
+                        exists):
+        """ Point one of a fork's refs at a SHA, creating the ref unless it
+            exists """
+        if exists:
+            patch_url = '/'.join([
+                github.GITHUB_API_URL,
+                'repos',
+                fork_user,
+                fork_repository,
+                'git',
+                ref
+            ])
+            response = await self.patch(patch_url,
+                                        data=json.dumps({'sha': commit}))
+            if response.status_code != 200:
+                raise GitHubError(response.json()['message'])
+
+        else:
+            post_url = '/'.join([
+                github.GITHUB_API_URL,
+                'repos',
+                fork_user,
+                fork_repository,
+                'git', 'refs'
+            ])
+            parameters = {'ref': ref, 'sha': commit}
+            response = await self.post(post_url,
+                                       data=json.dumps(parameters))
+            if response.status_code != 201:
+                raise GitHubError(response.json()['message'])
+
+    async def sync_refs(self, fork_user, fork_repository, upstream_refs,
+                        fork_refs, workers=DEFAULT_REF_WORKERS):
+        """ Point a fork's refs at the SHAs of its upstream's refs, up to
+            workers at once, raising a RefSyncError listing every ref that
+            failed """
+        writes = [(ref, commit, ref in fork_refs)
+                  for ref, commit in upstream_refs.items()
+                  if fork_refs.get(ref) != commit]
+        semaphore = asyncio.Semaphore(workers)
+
+        async def write(ref, commit, exists):
+            async with semaphore:
+                try:
+                    await self.write_ref(fork_user, fork_repository,
+                                         ref, commit, exists)
+                except GitHubError as e:
+                    return ref, str(e)
+            return ref, None
+
+        results = await asyncio.gather(*[write(*ref_write)
+                                         for ref_write in writes])
+        failures = collections.OrderedDict(
+            (ref, error) for ref, error in results if error is not None)
+        if failures:
+            raise RefSyncError(fork_user, fork_repository, failures,
+                               len(writes))
+
+    async def update_fork(self, origin_user, origin_repository, fork_user,
+                          fork_repository):
+        """ Update a fork or an origin user/org's repository """
+        upstream_refs, fork_refs = await asyncio.gather(
+            self.list_refs(origin_user, origin_repository),
+            self.list_refs(fork_user, fork_repository),
+        )
+        await self.sync_refs(fork_user, fork_repository, upstream_refs,
+                             fork_refs)
+
+
+async def preserve_repository(client, org, repo, dest_org):
+    """ Fork or update a single repository in the destination org with an
+        AsyncGitHubClient; returns 'forked', 'updated' or 'failed' """
+    fork_name = org + "_" + repo
+
+    if not await client.fork_exists(org, repo, dest_org, fork_name=fork_name):
+        logger.info("\tForking " + org + '/' + repo)
+
+        # Asked for under its final name; GitHub may still give it another,
+        # if it already has a fork of the repository
+        name = await client.fork_repository(org, repo, dest_org,
+                                            name=fork_name)
+        if not name:
+            logger.error("\tError forking " + org + '/' + repo)
+            return 'failed'
+        logger.debug("Create Fork " + org + '/' + repo + " as " + name)
+
+        if name != fork_name:
+            if not await client.rename_repository(dest_org, name, fork_name):
+                logger.error("\tError renaming fork " + org + '/' + repo)
+                return 'failed'
+            logger.debug("Renamed fork " + fork_name)
+        return 'forked'
+
+    logger.info("\tUpdating fork " + fork_name)
+    await client.update_fork(org, repo, dest_org, fork_name)
+    return 'updated'
+
+
+async def preserve_organization(client, org, dest_org, workers=1):
+    """ Preserve all public repositories for the given GitHub organization
+        with an AsyncGitHubClient, with up to workers repositories in
+        flight at once. As with the threaded version, outcomes are returned
+        in listing order and the first error in listing order is raised. """
+    logger.info("Getting repositories for " + org)
+    repositories = await client.list_repositories(org)
+
+    semaphore = asyncio.Semaphore(workers)
+
+    async def preserve(repo):
+        async with semaphore:
+            return await preserve_repository(client, org, repo, dest_org)
+
+    tasks = [asyncio.ensure_future(preserve(repo)) for repo in repositories]
+    try:
+        return [await task for task in tasks]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def preserve_organizations(orgs, dest_org, workers=1, **kwargs):
+    """ Preserve each of the given orgs in turn on an AsyncGitHubClient
+        built from kwargs, returning a map of each org to its outcomes """
+    async def run():
+        results = {}
+        async with AsyncGitHubClient(**kwargs) as client:
+            for org in orgs:
+                results[org] = await preserve_organization(
+                    client, org, dest_org, workers=workers)
+        return results
+
+    # A loop of our own, as asyncio.run is only in Python 3.7 and later
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
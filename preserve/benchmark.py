@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks preserve_organization end to end against a fake GitHub API
+served locally, with synthetic orgs of 100, 1,000 and 10,000 repositories
+by default, reporting the wall time, the number of API requests issued and
+the requests per repository for each. Run it with:
+
+    python -m preserve.benchmark --workers 8 --latency 0.05
+"""
+import collections
+import hashlib
+import json
+import logging
+import time
+
+import click
+
+from preserve import github
+from preserve.github import DestinationIndex, GitHubError
+from preserve.orgs import preserve_organization
+from preserve.testing import FakeGitHub, FakeGitHubServer
+
+logger = logging.getLogger()
+
+DEFAULT_SIZES = (100, 1000, 10000)
+DEFAULT_WORKERS = 8
+DEFAULT_BRANCHES = 3
+
+# The fraction of repositories that already have forks, and the fraction
+# of those that are behind their upstream
+DEFAULT_FORKED = 0.5
+DEFAULT_STALE = 0.1
+
+# High enough that a benchmark is never rate limited
+BENCHMARK_RATE_LIMIT = 10 ** 9
+
+SOURCE_ORG = 'upstream'
+DEST_ORG = 'preserved'
+
+# The status of the errors the fake API injects
+SERVER_ERROR = 502
+
+
+class RetryingClient(github.GitHubClient):
+    """ A client that retries requests the fake API failed with an injected
+        error, up to max_retries times. The fake fails them before making
+        any change, so they are safe to retry, and a run with an error rate
+        measures the cost of the retries rather than stopping at the first
+        error. """
+
+    def request(self, method, url, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            response = super(RetryingClient, self).request(method, url,
+                                                           **kwargs)
+            if response.status_code != SERVER_ERROR:
+                break
+        return response
+
+
+def synthetic_sha(*parts):
+    return hashlib.sha1('/'.join(str(p) for p in parts).encode()).hexdigest()
+
+
+def synthetic_organization(fake, org, dest_org, size,
+                           branches=DEFAULT_BRANCHES, forked=DEFAULT_FORKED,
+                           stale=DEFAULT_STALE):
+    """ Add an org of size repositories to a FakeGitHub. The first forked
+        fraction of them already have forks in dest_org, and the first
+        stale fraction of those forks are a commit behind on master. """
+    forked_count = int(size * forked)
+    stale_count = int(forked_count * stale)
+
+    for i in range(size):
+        name = 'repo-{:05d}'.format(i)
+        upstream_branches = collections.OrderedDict(
+            ('branch-{}'.format(b) if b else 'master',
+             synthetic_sha(org, name, b))
+            for b in range(branches))
+        fake.add_repository(org, name, branches=upstream_branches)
+
+        if i < forked_count:
+            fork_branches = collections.OrderedDict(upstream_branches)
+            if i < stale_count:
+                fork_branches['master'] = synthetic_sha(org, name, 'stale')
+            fake.add_repository(dest_org, org + '_' + name,
+                                branches=fork_branches, fork=True)
+
+
+def run_benchmark(size, workers=DEFAULT_WORKERS, latency=0.0,
+                  error_rate=0.0, fork_delay=0.0, forked=DEFAULT_FORKED,
+                  stale=DEFAULT_STALE, index=True, **kwargs):
+    """ Preserve a synthetic org of size repositories from a fresh fake
+        GitHub, passing any other options on to preserve_organization, and
+        return a dict of the results. Requests failed by the error rate are
+        retried, and count towards the requests made. A run that still
+        fails with a GitHubError is reported with its error rather than
+        raised. """
+    fake = FakeGitHub(latency=latency, error_rate=error_rate,
+                      fork_delay=fork_delay, rate_limit=BENCHMARK_RATE_LIMIT)
+    synthetic_organization(fake, SOURCE_ORG, DEST_ORG, size, forked=forked,
+                           stale=stale)
+
+    original_url, original_client = github.GITHUB_API_URL, github.client
+    original_level = logger.level
+    outcomes, error = [], None
+    with FakeGitHubServer(fake) as server:
+        github.GITHUB_API_URL = server.url
+        github.client = RetryingClient(headers={},
+                                       pool_size=github.pool_size(workers))
+        logger.setLevel(logging.WARNING)
+
+        start = time.time()
+        try:
+            outcomes = preserve_organization(
+                SOURCE_ORG, DEST_ORG, workers=workers,
+                index=DestinationIndex(DEST_ORG) if index else None,
+                **kwargs)
+        except GitHubError as e:
+            error = str(e)
+        finally:
+            seconds = time.time() - start
+            github.GITHUB_API_URL = original_url
+            github.client = original_client
+            logger.setLevel(original_level)
+
+    return {
+        'repositories': size,
+        'seconds': seconds,
+        'requests': fake.request_count,
+        'requests_per_repository': fake.request_count / size,
+        'outcomes': dict(collections.Counter(outcomes)),
+        'error': error,
+    }
+
+
+def format_result(result):
+    line = '{repositories:>8} {seconds:>9.2f} {requests:>9} ' \
+           '{requests_per_repository:>13.2f}'.format(**result)
+    outcomes = ', '.join('{}={}'.format(outcome, count) for outcome, count
+                         in sorted(result['outcomes'].items()))
+    if result['error'] is not None:
+        outcomes = 'error: ' + result['error']
+    return line + '  ' + outcomes
+
+
+@click.command()
+@click.option('--size', 'sizes', multiple=True, type=int,
+              default=DEFAULT_SIZES,
+              help='Number of repositories in the org; may be repeated')
+@click.option('--workers', default=DEFAULT_WORKERS,
+              type=click.IntRange(min=1),
+              help='Number of repositories to process concurrently')
+@click.option('--latency', default=0.0, type=float,
+              help='Seconds the fake API takes to answer each request')
+@click.option('--error-rate', default=0.0, type=float,
+              help='Fraction of requests the fake API fails with a 502, '
+              'which are retried')
+@click.option('--fork-delay', default=0.0, type=float,
+              help='Seconds until a new fork can be read')
+@click.option('--graphql', is_flag=True,
+              help='Fetch the refs of forks to update in GraphQL batches')
+@click.option('--stream', is_flag=True,
+              help='Start on repositories while the listing is still paging')
+@click.option('--no-index', is_flag=True,
+              help='Check for each fork with its own API call')
+@click.option('--async-forks', is_flag=True,
+              help='Keep going while new forks are created')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print each result as a line of JSON')
+def main(sizes=DEFAULT_SIZES, workers=DEFAULT_WORKERS, latency=0.0,
+         error_rate=0.0, fork_delay=0.0, graphql=False, stream=False,
+         no_index=False, async_forks=False, as_json=False):
+    if not as_json:
+        click.echo('{:>8} {:>9} {:>9} {:>13}  {}'.format(
+            'repos', 'seconds', 'requests', 'requests/repo', 'outcomes'))
+
+    for size in sizes:
+        result = run_benchmark(size, workers=workers, latency=latency,
+                               error_rate=error_rate, fork_delay=fork_delay,
+                               index=not no_index, graphql=graphql,
+                               stream=stream, async_forks=async_forks)
+        if as_json:
+            click.echo(json.dumps(result, sort_keys=True))
+        else:
+            click.echo(format_result(result))
+
+
+if __name__ == '__main__':
+    main()
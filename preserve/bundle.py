@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+A cold archive of git bundles, built incrementally from the bare mirrors
+kept by preserve.mirror.
+
+Each time a mirror is archived, only history that isn't in the archive
+already is bundled. The tips archived before, from the same repository or
+from any other that shares a root commit with it, such as the other forks
+of its upstream, are the new bundle's prerequisites, so a fork of an
+archived upstream costs only its own commits, and a mirror whose refs
+haven't moved costs nothing.
+
+Bundles are stored under the SHA-256 of their contents, at
+<archive_dir>/bundles/ab/abcdef....bundle, so identical bundles are only
+stored once. A SQLite index at <archive_dir>/index.db records each
+repository's refs as of its last archive, which bundle covers each
+archived tip, and which bundles each bundle and repository depend on:
+everything restore_repository needs to rebuild a repository.
+"""
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from preserve.mirror import MirrorError, mirror_lock, mirror_path, run_git
+from preserve.orgs import (
+    DEFAULT_BUFFER_PER_WORKER,
+    group_by_org,
+    map_bounded,
+)
+
+logger = logging.getLogger()
+
+# SQLite's default limit on the parameters of a single statement is 999
+QUERY_CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bundles (
+    bundle TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bundle_dependencies (
+    bundle TEXT NOT NULL,
+    dependency TEXT NOT NULL,
+    PRIMARY KEY (bundle, dependency)
+);
+CREATE TABLE IF NOT EXISTS objects (
+    sha TEXT PRIMARY KEY,
+    bundle TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    org TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    sha TEXT NOT NULL,
+    PRIMARY KEY (org, repository, ref)
+);
+CREATE TABLE IF NOT EXISTS roots (
+    org TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    root TEXT NOT NULL,
+    PRIMARY KEY (org, repository, root)
+);
+CREATE INDEX IF NOT EXISTS roots_root ON roots (root);
+CREATE TABLE IF NOT EXISTS repository_bundles (
+    org TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    bundle TEXT NOT NULL,
+    PRIMARY KEY (org, repository, bundle)
+);
+"""
+
+
+def chunks(items, size=QUERY_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class BundleArchive(object):
+    """ A directory of content-addressed git bundles and the index of what
+        they hold. An object in the index is a tip SHA that was archived;
+        the bundle it maps to, together with that bundle's dependencies,
+        holds its history. Safe to share between threads. """
+
+    def __init__(self, path):
+        os.makedirs(os.path.join(path, 'bundles'), exist_ok=True)
+        self.path = path
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(path, 'index.db'),
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def bundle_path(self, bundle):
+        return os.path.join(self.path, 'bundles', bundle[:2],
+                            bundle + '.bundle')
+
+    def refs(self, org, repository):
+        """ Get a map of a repository's refs to their SHAs as of its last
+            archive, or None if it has never been archived """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT ref, sha FROM refs '
+                'WHERE org = ? AND repository = ?',
+                (org, repository)).fetchall()
+        if not rows:
+            return None
+        return dict(rows)
+
+    def roots(self, org, repository):
+        """ Get the root commits of a repository's archived history """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT root FROM roots WHERE org = ? AND repository = ?',
+                (org, repository)).fetchall()
+        return {root for root, in rows}
+
+    def archived(self, shas):
+        """ Get a map of those of the SHAs that are archived to the bundles
+            that cover them """
+        archived = {}
+        with self.lock:
+            for chunk in chunks(shas):
+                archived.update(self.connection.execute(
+                    'SELECT sha, bundle FROM objects WHERE sha IN ({})'.format(
+                        ', '.join('?' * len(chunk))), chunk).fetchall())
+        return archived
+
+    def related_tips(self, roots):
+        """ Get the archived refs' SHAs of every repository whose history
+            shares one of the root commits """
+        tips = set()
+        with self.lock:
+            for chunk in chunks(roots):
+                tips.update(sha for sha, in self.connection.execute(
+                    'SELECT DISTINCT refs.sha FROM roots JOIN refs '
+                    'ON roots.org = refs.org '
+                    'AND roots.repository = refs.repository '
+                    'WHERE roots.root IN ({})'.format(
+                        ', '.join('?' * len(chunk))), chunk).fetchall())
+        return tips
+
+    def add_bundle(self, path, dependencies):
+        """ Move a bundle file into the archive under its hash, unless an
+            identical bundle is stored already, recording the bundles it
+            depends on. Returns its hash. """
+        bundle = file_hash(path)
+        bundle_path = self.bundle_path(bundle)
+        size = os.path.getsize(path)
+        if os.path.exists(bundle_path):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+            os.replace(path, bundle_path)
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO bundles (bundle, size, created_at) '
+                'VALUES (?, ?, ?)', (bundle, size, time.time()))
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO bundle_dependencies '
+                '(bundle, dependency) VALUES (?, ?)',
+                [(bundle, dependency) for dependency in dependencies])
+        return bundle
+
+    def record(self, org, repository, refs, roots, bundles, objects):
+        """ Record an archive of a repository: its refs and the roots of
+            their history, the bundles that hold them, and the new tips a
+            bundle was written for """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM refs WHERE org = ? AND repository = ?',
+                (org, repository))
+            self.connection.executemany(
+                'INSERT INTO refs (org, repository, ref, sha) '
+                'VALUES (?, ?, ?, ?)',
+                [(org, repository, ref, sha) for ref, sha in refs.items()])
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO roots (org, repository, root) '
+                'VALUES (?, ?, ?)',
+                [(org, repository, root) for root in roots])
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO repository_bundles '
+                '(org, repository, bundle) VALUES (?, ?, ?)',
+                [(org, repository, bundle) for bundle in bundles])
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO objects (sha, bundle) VALUES (?, ?)',
+                objects.items())
+
+    def dependencies(self, org, repository):
+        """ Get every bundle needed to restore a repository, each one after
+            the bundles it depends on """
+        with self.lock:
+            pending = [bundle for bundle, in self.connection.execute(
+                'SELECT bundle FROM repository_bundles '
+                'WHERE org = ? AND repository = ? ORDER BY bundle',
+                (org, repository)).fetchall()]
+            graph = {}
+            while pending:
+                bundle = pending.pop()
+                if bundle in graph:
+                    continue
+                graph[bundle] = [dependency for dependency, in
+                                 self.connection.execute(
+                                     'SELECT dependency FROM '
+                                     'bundle_dependencies WHERE bundle = ? '
+                                     'ORDER BY dependency',
+                                     (bundle,)).fetchall()]
+                pending.extend(graph[bundle])
+
+        ordered = []
+        visited = set()
+
+        def visit(bundle):
+            if bundle in visited:
+                return
+            visited.add(bundle)
+            for dependency in graph[bundle]:
+                visit(dependency)
+            ordered.append(bundle)
+
+        for bundle in sorted(graph):
+            visit(bundle)
+        return ordered
+
+
+def list_tips(path):
+    """ Get a map of a repository's refs to their SHAs """
+    output = run_git(['for-each-ref', '--format=%(refname) %(objectname)'],
+                     cwd=path)
+    return collections.OrderedDict(line.split(' ', 1)
+                                   for line in output.splitlines())
+
+
+def present(path, shas):
+    """ Get those of the SHAs whose objects the repository has """
+    if not shas:
+        return set()
+    output = run_git(['cat-file', '--batch-check'], cwd=path,
+                     input=''.join(sha + '\n' for sha in shas))
+    return {line.split(' ', 1)[0] for line in output.splitlines()
+            if not line.endswith(' missing')}
+
+
+def find_roots(path, shas, exclude):
+    """ Get the root commits in the history of the SHAs, not walking the
+        history of those excluded """
+    lines = [sha for sha in shas] + ['^' + sha for sha in exclude]
+    output = run_git(['rev-list', '--max-parents=0', '--stdin'], cwd=path,
+                     input=''.join(line + '\n' for line in lines))
+    return set(output.split())
+
+
+def create_bundle(archive, path, refs, prerequisites, dependencies):
+    """ Bundle the history of a repository's refs, less the history of the
+        prerequisites, into the archive. Returns the bundle's hash, or None
+        if the prerequisites already hold all of it. """
+    directory = tempfile.mkdtemp(dir=archive.path)
+    try:
+        bundle_file = os.path.join(directory, 'new.bundle')
+        lines = list(refs) + ['^' + sha for sha in sorted(prerequisites)]
+        try:
+            run_git(['bundle', 'create', '--quiet', bundle_file, '--stdin'],
+                    cwd=path, input=''.join(line + '\n' for line in lines))
+        except MirrorError as e:
+            if 'empty bundle' in str(e):
+                return None
+            raise
+        return archive.add_bundle(bundle_file, dependencies)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def archive_mirror(archive, org, repo, path):
+    """ Archive the bare repository at path as org/repo; see
+        archive_repository """
+    tips = list_tips(path)
+    previous = archive.refs(org, repo) or {}
+    if dict(tips) == previous:
+        return 'unchanged'
+
+    archived = archive.archived(set(tips.values()))
+    bundles = set(archived.values())
+    new = collections.OrderedDict((ref, sha) for ref, sha in tips.items()
+                                  if sha not in archived)
+    roots = archive.roots(org, repo)
+    objects = {}
+    outcome = 'updated'
+
+    if new:
+        previous_tips = present(path, set(previous.values()))
+        # Only the new history needs to be walked for its roots
+        roots |= find_roots(path, new.values(), previous_tips)
+
+        candidates = archive.archived(
+            previous_tips | archive.related_tips(roots))
+        prerequisites = present(path, set(candidates))
+        dependencies = {candidates[sha] for sha in prerequisites}
+
+        bundle = create_bundle(archive, path, new, prerequisites,
+                               dependencies)
+        if bundle is None:
+            # The new refs point into history that is already archived
+            bundles |= dependencies
+        else:
+            bundles.add(bundle)
+            objects = {sha: bundle for sha in new.values()}
+            outcome = 'archived'
+
+    archive.record(org, repo, tips, roots, bundles, objects)
+    return outcome
+
+
+def archive_repository(archive, org, repo, mirror_dir):
+    """ Archive a repository's mirror in mirror_dir into a BundleArchive.
+        Returns 'archived' if a bundle was written, 'updated' if its refs
+        moved but only to history the archive already holds, 'unchanged',
+        'skipped' if its mirror is locked by a refresh, or 'failed'. """
+    path = mirror_path(mirror_dir, org, repo)
+
+    with mirror_lock(path) as locked:
+        if not locked:
+            logger.info("\tSkipping archive of " + org + '/' + repo
+                        + ", its mirror is being refreshed")
+            return 'skipped'
+
+        logger.info("\tArchiving " + org + '/' + repo)
+        try:
+            return archive_mirror(archive, org, repo, path)
+        except MirrorError as e:
+            logger.error("\tError archiving " + org + '/' + repo + ": "
+                         + str(e))
+            return 'failed'
+
+
+def mirrored_repositories(mirror_dir, org):
+    """ List the repositories of an org with mirrors in mirror_dir """
+    org_dir = os.path.join(mirror_dir, org)
+    if not os.path.isdir(org_dir):
+        return []
+    return sorted(name[:-len('.git')] for name in os.listdir(org_dir)
+                  if name.endswith('.git')
+                  and os.path.isdir(os.path.join(org_dir, name)))
+
+
+def archive_mirrors(archive, mirror_dir, orgs, workers=1):
+    """ Archive the mirrors of each of the orgs, up to workers at once,
+        returning a map of each org with mirrors to their outcomes """
+    pairs = [(org, repo) for org in orgs
+             for repo in mirrored_repositories(mirror_dir, org)]
+
+    def archive_pair(pair):
+        org, repo = pair
+        return archive_repository(archive, org, repo, mirror_dir)
+
+    def archive_pairs(pairs):
+        if workers <= 1:
+            return [archive_pair(pair) for pair in pairs]
+        return list(map_bounded(archive_pair, pairs, workers,
+                                workers * DEFAULT_BUFFER_PER_WORKER))
+
+    return group_by_org(archive_pairs, pairs)
+
+
+def restore_repository(archive, org, repo, path):
+    """ Rebuild a repository from the archive as a bare repository at path,
+        with its refs as of its last archive """
+    refs = archive.refs(org, repo)
+    if refs is None:
+        raise MirrorError(org + '/' + repo + ' has not been archived')
+
+    run_git(['init', '--quiet', '--bare', path])
+    for bundle in archive.dependencies(org, repo):
+        run_git(['bundle', 'unbundle', archive.bundle_path(bundle)],
+                cwd=path)
+    run_git(['update-ref', '--stdin'], cwd=path,
+            input=''.join('update {} {}\n'.format(ref, sha)
+                          for ref, sha in refs.items()))
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'preserve')
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# The response headers we keep alongside a cached body. Link is needed to
+# follow pagination from a cached page.
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+
+
+class ResponseCache(object):
+    """ An on-disk cache of GitHub API responses, keyed by URL.
+
+        Cached responses are revalidated with If-None-Match and
+        If-Modified-Since. GitHub answers an unchanged resource with a 304,
+        which is not counted against the rate limit, and the cached body is
+        used instead. The least recently used entries are evicted once the
+        cache grows past max_size bytes. """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size = None
+
+    def entry_path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key + '.json')
+
+    def lookup(self, url):
+        """ Get the cached entry for a URL, or None """
+        entry_path = self.entry_path(url)
+        try:
+            with open(entry_path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Mark the entry as recently used so it survives eviction
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return entry
+
+    def conditional_headers(self, entry):
+        """ Get the headers that revalidate a cached entry """
+        headers = {}
+        if entry['headers'].get('ETag') is not None:
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry['headers'].get('Last-Modified') is not None:
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    def response(self, entry, not_modified):
+        """ Build a 200 response from a cached entry for a 304 response.
+            The rate limit headers are taken from the fresh response. """
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry['url']
+        response.encoding = 'utf-8'
+        response._content = entry['content'].encode('utf-8')
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.headers.update(
+            (k, v) for k, v in not_modified.headers.items()
+            if k.lower().startswith('x-ratelimit'))
+        response.request = not_modified.request
+        response.from_cache = True
+        return response
+
+    def store(self, url, response):
+        """ Cache a response if it can be revalidated later """
+        if response.status_code != 200:
+            return
+        headers = {h: response.headers[h] for h in CACHED_HEADERS
+                   if h in response.headers}
+        if 'ETag' not in headers and 'Last-Modified' not in headers:
+            return
+
+        data = json.dumps({
+            'url': url,
+            'headers': headers,
+            'content': response.content.decode('utf-8'),
+        }).encode('utf-8')
+
+        entry_path = self.entry_path(url)
+        with self.lock:
+            if self.size is None:
+                os.makedirs(self.path, exist_ok=True)
+                self.size = sum(s for _, _, s in self.entries())
+
+            try:
+                self.size -= os.path.getsize(entry_path)
+            except OSError:
+                pass
+
+            # Write to a temporary file first so that a concurrent reader
+            # never sees a partial entry. The directory is shared with
+            # other processes, so the file's name must be unique to us.
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, entry_path)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+            self.size += len(data)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    def entries(self):
+        """ List (mtime, path, size) for every entry in the cache """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            entry_path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, entry_path, stat.st_size))
+        return entries
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache is back
+            under three quarters of its maximum size """
+        target = self.max_size * 3 // 4
+        for _, entry_path, size in sorted(self.entries()):
+            if self.size <= target:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            self.size -= size
@@ -13,27 +13,327 @@ particular user or organization are kept up-to-date, new repositories
 are forked, and the code preserve forks of any repositories that may
 have been deleted are left untouched.
 """
+import itertools
 import logging
 import sys
 
 import click
 
-from preserve.orgs import preserve_organization
+from preserve import aio, bundle, github, mirror
+from preserve.cache import DEFAULT_CACHE_DIR, ResponseCache
+from preserve.journal import Journal
+from preserve.metrics import Metrics
+from preserve.orgs import preserve_organization, preserve_organizations
+from preserve.priority import preserve_by_priority
+from preserve.ratelimit import RateLimiter
+from preserve.state import StateStore
+from preserve.watch import DEFAULT_POLL_INTERVAL, Watcher
+from preserve.webhook import (
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    UpdateQueue,
+    WebhookReceiver,
+    WebhookServer,
+)
+from preserve.workqueue import WorkQueue, enqueue_organizations, run_worker
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 
+def read_organizations(org_file):
+    """ Read org names from a file, one per line, skipping blank lines and
+        comments """
+    for line in org_file:
+        org = line.split('#', 1)[0].strip()
+        if org:
+            yield org
+
+
+def record_outcomes(metrics, results):
+    """ Count the outcomes in a map of orgs to their outcomes in metrics, if
+        there are any """
+    if metrics is None:
+        return
+    for outcomes in results.values():
+        metrics.record_outcomes(outcomes)
+
+
 @click.command()
 @click.argument('organization', nargs=-1)
 @click.option('--update', default=True, help='Update forks that already exist')
 @click.option('--dest-org', default='codepreservetest',
               help='Destination organization')
-def main(organization=[], update=True, dest_org='codepreservetest'):
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Number of repositories to process concurrently')
+@click.option('--timeout', default=github.DEFAULT_TIMEOUT, type=float,
+              help='Timeout in seconds for GitHub API requests')
+@click.option('--cache-dir', default=DEFAULT_CACHE_DIR,
+              help='Directory for cached GitHub API responses')
+@click.option('--no-cache', is_flag=True,
+              help='Bypass the GitHub API response cache')
+@click.option('--graphql', is_flag=True,
+              help='Fetch the refs of forks to update in GraphQL batches')
+@click.option('--state', default=None,
+              help='SQLite file recording synced forks, used to skip '
+                   'repositories that have not changed since the last run')
+@click.option('--reconcile', is_flag=True,
+              help='Refresh the recorded state of every fork from GitHub')
+@click.option('--stream', is_flag=True,
+              help='Start on repositories while the listing is still paging')
+@click.option('--no-index', is_flag=True,
+              help='Check for each fork with its own API call instead of '
+                   'listing the destination organization once')
+@click.option('--async-forks', is_flag=True,
+              help='Keep going while new forks are created, renaming each '
+                   'once it is ready')
+@click.option('--org-file', type=click.File('r'), default=None,
+              help='File of organizations to preserve, one per line, or - '
+                   'for stdin. Their repositories share the workers fairly')
+@click.option('--client', 'client_type', default='sync',
+              type=click.Choice(['sync', 'async']),
+              help='Use the threaded requests client or the asyncio client '
+                   '(which needs aiohttp, and supports --workers, --timeout '
+                   'and the cache)')
+@click.option('--metrics-json', default=None,
+              help='Write metrics of the run to this file as JSON')
+@click.option('--metrics-prom', default=None,
+              help='Write metrics of the run to this file in the Prometheus '
+                   'text format, for the node exporter textfile collector')
+@click.option('--queue', default=None,
+              help='SQLite work queue file. Repositories of the orgs given '
+                   'are queued for workers instead of preserved')
+@click.option('--worker', is_flag=True,
+              help='Preserve repositories leased from --queue until it is '
+                   'empty')
+@click.option('--journal', default=None,
+              help='File to record the progress of the run in, so that it '
+                   'can be resumed if it is interrupted')
+@click.option('--resume', is_flag=True,
+              help='Resume the interrupted run recorded in --journal, '
+                   'skipping the repositories it finished')
+@click.option('--backend', default='github',
+              type=click.Choice(['github', 'mirror']),
+              help='Preserve repositories as forks in --dest-org, or as '
+                   'local bare git mirrors in --mirror-dir')
+@click.option('--mirror-dir', default='mirrors',
+              help='Directory of the mirror backend\'s bare mirrors')
+@click.option('--archive-dir', default=None,
+              help='After mirroring, write incremental git bundles of the '
+                   'mirrors to this archive (needs --backend=mirror)')
+@click.option('--watch', is_flag=True,
+              help='Keep running, updating forks from the event feeds of the '
+                   'orgs as their repositories change')
+@click.option('--watch-interval', default=DEFAULT_POLL_INTERVAL,
+              type=click.IntRange(min=1),
+              help='Seconds between polls of the event feeds with --watch')
+@click.option('--webhook', is_flag=True,
+              help='Keep running, updating forks from the GitHub webhook '
+                   'deliveries of the orgs, or of any org if none are given')
+@click.option('--webhook-host', default=DEFAULT_HOST,
+              help='Address to receive webhooks on')
+@click.option('--webhook-port', default=DEFAULT_PORT,
+              type=click.IntRange(min=0),
+              help='Port to receive webhooks on')
+@click.option('--webhook-secret', default=None,
+              envvar='PRESERVE_WEBHOOK_SECRET',
+              help='Secret the webhooks are signed with, needed with '
+                   '--webhook')
+@click.option('--priority', is_flag=True,
+              help='Sync the repositories of all of the orgs most likely to '
+                   'have changed first, skipping those not yet due (needs '
+                   '--state)')
+@click.option('--budget', default=None, type=click.IntRange(min=0),
+              help='Sync at most this many repositories with --priority, '
+                   'leaving the rest for a later run')
+def main(organization=[], update=True, dest_org='codepreservetest',
+         workers=1, timeout=github.DEFAULT_TIMEOUT,
+         cache_dir=DEFAULT_CACHE_DIR, no_cache=False, graphql=False,
+         state=None, reconcile=False, stream=False, no_index=False,
+         async_forks=False, org_file=None, client_type='sync',
+         metrics_json=None, metrics_prom=None, queue=None, worker=False,
+         journal=None, resume=False, backend='github',
+         mirror_dir='mirrors', archive_dir=None, watch=False,
+         watch_interval=DEFAULT_POLL_INTERVAL, webhook=False,
+         webhook_host=DEFAULT_HOST, webhook_port=DEFAULT_PORT,
+         webhook_secret=None, priority=False, budget=None):
     if dest_org in organization:
         logger.error(dest_org + " cannot be a target org")
         sys.exit(1)
 
-    for org in organization:
-        preserve_organization(org, dest_org)
+    if worker and queue is None:
+        logger.error("--worker needs a --queue")
+        sys.exit(1)
+    if queue is not None and (graphql or stream or async_forks or journal):
+        logger.error("--graphql, --stream, --async-forks and --journal are "
+                     "not supported with --queue")
+        sys.exit(1)
+    if resume and journal is None:
+        logger.error("--resume needs a --journal")
+        sys.exit(1)
+    if backend == 'mirror' and (graphql or state or async_forks or queue
+                                or journal or client_type == 'async'):
+        logger.error("--graphql, --state, --async-forks, --queue, "
+                     "--journal and the async client are not supported by "
+                     "the mirror backend")
+        sys.exit(1)
+    if watch and (graphql or stream or async_forks or queue or journal
+                  or backend == 'mirror' or client_type == 'async'):
+        logger.error("--graphql, --stream, --async-forks, --queue, "
+                     "--journal, the mirror backend and the async client are "
+                     "not supported with --watch")
+        sys.exit(1)
+    if webhook and (watch or graphql or stream or async_forks or queue
+                    or journal or backend == 'mirror'
+                    or client_type == 'async'):
+        logger.error("--watch, --graphql, --stream, --async-forks, --queue, "
+                     "--journal, the mirror backend and the async client are "
+                     "not supported with --webhook")
+        sys.exit(1)
+    if webhook and not webhook_secret:
+        logger.error("--webhook needs a --webhook-secret")
+        sys.exit(1)
+    if priority and state is None:
+        logger.error("--priority needs a --state")
+        sys.exit(1)
+    if priority and (reconcile or stream or queue or watch or webhook
+                     or backend == 'mirror' or client_type == 'async'):
+        logger.error("--reconcile, --stream, --queue, --watch, --webhook, "
+                     "the mirror backend and the async client are not "
+                     "supported with --priority")
+        sys.exit(1)
+    if budget is not None and not priority:
+        logger.error("--budget needs --priority")
+        sys.exit(1)
+    if archive_dir is not None and backend != 'mirror':
+        logger.error("--archive-dir needs --backend=mirror")
+        sys.exit(1)
+
+    cache = None if no_cache else ResponseCache(cache_dir)
+
+    metrics = None
+    if metrics_json is not None or metrics_prom is not None:
+        metrics = Metrics()
+
+    if client_type == 'async':
+        if (graphql or state or stream or async_forks or org_file or queue
+                or journal):
+            logger.error("--graphql, --state, --stream, --async-forks, "
+                         "--org-file, --queue and --journal are not "
+                         "supported by the async client")
+            sys.exit(1)
+        if aio.aiohttp is None:
+            logger.error("The async client requires aiohttp")
+            sys.exit(1)
+
+    try:
+        if client_type == 'async':
+            results = aio.preserve_organizations(
+                organization, dest_org, workers=workers,
+                pool_size=max(github.DEFAULT_POOL_SIZE, workers),
+                timeout=timeout, cache=cache, rate_limiter=RateLimiter(),
+                metrics=metrics)
+            record_outcomes(metrics, results)
+            return
+
+        github.configure(pool_size=github.pool_size(workers),
+                         timeout=timeout, cache=cache,
+                         rate_limiter=RateLimiter(), metrics=metrics)
+
+        state_store = None if state is None else StateStore(state)
+
+        # The destination is listed at most once, and shared between orgs
+        index = None if no_index else github.DestinationIndex(dest_org)
+
+        run_journal = None
+        if journal is not None:
+            run_journal = Journal(journal, resume=resume)
+
+        def organizations():
+            orgs = organization
+            if org_file is not None:
+                orgs = itertools.chain(orgs, read_organizations(org_file))
+            for org in orgs:
+                if org == dest_org:
+                    logger.error(dest_org + " cannot be a target org")
+                    continue
+                yield org
+
+        if backend == 'mirror':
+            mirrored = []
+            if org_file is not None:
+                results = mirror.mirror_organizations(
+                    organizations(), mirror_dir, workers=workers)
+                record_outcomes(metrics, results)
+                mirrored.extend(results)
+            else:
+                for org in organization:
+                    outcomes = mirror.mirror_organization(
+                        org, mirror_dir, workers=workers, stream=stream)
+                    record_outcomes(metrics, {org: outcomes})
+                    mirrored.append(org)
+
+            if archive_dir is not None:
+                results = bundle.archive_mirrors(
+                    bundle.BundleArchive(archive_dir), mirror_dir, mirrored,
+                    workers=workers)
+                record_outcomes(metrics, results)
+            return
+
+        if watch:
+            daemon = Watcher(list(organizations()), dest_org,
+                             workers=workers, state=state_store, index=index,
+                             interval=watch_interval)
+            for results in daemon.run():
+                record_outcomes(metrics, results)
+            return
+
+        if webhook:
+            orgs = list(organizations())
+            receiver = WebhookReceiver(
+                UpdateQueue(dest_org, workers=workers, state=state_store,
+                            index=index),
+                webhook_secret, orgs=orgs or None)
+            WebhookServer(receiver, host=webhook_host,
+                          port=webhook_port).serve_forever()
+            return
+
+        if queue is not None:
+            work_queue = WorkQueue(queue)
+            enqueue_organizations(work_queue, organizations(), dest_org)
+            if worker:
+                outcomes = run_worker(work_queue, workers=workers,
+                                      state=state_store, reconcile=reconcile,
+                                      index=not no_index)
+                if metrics is not None:
+                    metrics.record_outcomes(outcomes)
+            return
+
+        if priority:
+            results = preserve_by_priority(
+                organizations(), dest_org, state_store, budget=budget,
+                workers=workers, graphql=graphql, index=index,
+                async_forks=async_forks, journal=run_journal)
+            record_outcomes(metrics, results)
+            return
+
+        if org_file is not None:
+            results = preserve_organizations(
+                organizations(), dest_org, workers=workers, graphql=graphql,
+                state=state_store, reconcile=reconcile, index=index,
+                async_forks=async_forks, journal=run_journal)
+            record_outcomes(metrics, results)
+            return
+
+        for org in organization:
+            outcomes = preserve_organization(
+                org, dest_org, workers=workers, graphql=graphql,
+                state=state_store, reconcile=reconcile, stream=stream,
+                index=index, async_forks=async_forks, journal=run_journal)
+            record_outcomes(metrics, {org: outcomes})
+    finally:
+        if metrics_json is not None:
+            metrics.write_json(metrics_json)
+        if metrics_prom is not None:
+            metrics.write_prometheus(metrics_prom)
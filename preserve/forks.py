@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from preserve.github import fork_ready
+
+logger = logging.getLogger()
+
+DEFAULT_WORKERS = 4
+DEFAULT_INITIAL_DELAY = 1.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_FORK_TIMEOUT = 300.0
+
+
+class ForkPipeline(object):
+    """ Waits for newly created forks to become ready without blocking.
+
+        GitHub creates forks asynchronously, so a fork can't be relied on
+        until some time after the request to create it has returned.
+        when_ready() registers a fork and returns a Future straight away; a
+        background thread polls each registered fork with exponential
+        backoff, and once it is ready (or has timed out) runs its callback
+        on a thread pool and resolves the Future with the callback's result.
+        Many forks can be waiting at once. """
+
+    def __init__(self, workers=DEFAULT_WORKERS,
+                 initial_delay=DEFAULT_INITIAL_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, timeout=DEFAULT_FORK_TIMEOUT,
+                 ready=None):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.ready = ready
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.condition = threading.Condition()
+        self.pending = []
+        self.counter = itertools.count()
+        self.futures = []
+        self.closed = False
+        self.poller = None
+
+    def when_ready(self, destination_org, repository, callback):
+        """ Call callback once destination_org/repository is ready. The
+            repository is the name GitHub gave the fork, which needn't be
+            its upstream's. """
+        now = time.time()
+        entry = {
+            'destination_org': destination_org,
+            'repository': repository,
+            'callback': callback,
+            'delay': self.initial_delay,
+            'deadline': now + self.timeout,
+            'future': Future(),
+        }
+        with self.condition:
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.poll, daemon=True)
+                self.poller.start()
+            self.futures.append(entry['future'])
+            self.schedule(entry, now + self.initial_delay)
+        return entry['future']
+
+    def schedule(self, entry, due):
+        with self.condition:
+            heapq.heappush(self.pending, (due, next(self.counter), entry))
+            self.condition.notify()
+
+    def poll(self):
+        """ Hand each fork to the thread pool to be checked once it's due """
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                due, _, entry = self.pending[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.pending)
+            self.executor.submit(self.check, entry)
+
+    def check(self, entry):
+        """ Check if a fork is ready, completing it if it is and scheduling
+            another check with a longer delay if it isn't """
+        future = entry['future']
+        ready = self.ready if self.ready is not None else fork_ready
+        try:
+            is_ready = ready(entry['destination_org'], entry['repository'])
+            if not is_ready and time.time() < entry['deadline']:
+                entry['delay'] = min(entry['delay'] * 2, self.max_delay)
+                self.schedule(entry, time.time() + entry['delay'])
+                return
+
+            if not is_ready:
+                logger.warning("\tTimed out waiting for fork "
+                               + entry['destination_org'] + '/'
+                               + entry['repository'])
+            future.set_result(entry['callback']())
+        except Exception as e:
+            future.set_exception(e)
+
+    def close(self):
+        """ Wait for every registered fork to complete and shut down """
+        wait(list(self.futures))
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.poller is not None:
+            self.poller.join()
+        self.executor.shutdown(wait=True)
@@ -1,7 +1,24 @@
 # -*- coding: utf-8 -*-
+import collections
+import functools
 import json
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import (
+    parse_qs,
+    parse_qsl,
+    urlencode,
+    urlsplit,
+    urlunsplit,
+)
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from preserve.ratelimit import rate_limit_resource
 
 GITHUB_API_URL = 'https://api.github.com'
 HEADERS = {}
@@ -9,15 +26,191 @@ ACCESS_TOKEN = os.environ.get('GITHUB_API_TOKEN', None)
 if ACCESS_TOKEN is not None:
     HEADERS['Authorization'] = 'token ' + ACCESS_TOKEN
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 5
+
+# Listings are fetched this many results to a page, with up to this many
+# pages fetched at once
+DEFAULT_PER_PAGE = 100
+DEFAULT_PAGE_WORKERS = 8
+
+# The namespaces of refs that are preserved, listed with
+# git/matching-refs
+REF_NAMESPACES = ('heads', 'tags')
+
+# The number of refs of a single fork that are written at once
+DEFAULT_REF_WORKERS = 8
+
+# The number of upstream/fork pairs whose refs are fetched in a single
+# GraphQL query
+DEFAULT_GRAPHQL_BATCH_SIZE = 25
+GRAPHQL_REFS_FRAGMENT = (
+    '{alias}: repository(owner: {owner}, name: {name}) {{'
+    ' refs(refPrefix: {prefix}, first: 100{after}) {{'
+    ' pageInfo {{ hasNextPage endCursor }}'
+    ' nodes {{ name target {{ oid }} }} }} }}'
+)
+
+logger = logging.getLogger()
+
+# Compact records of the few fields we use from GitHub's JSON. Listings are
+# converted to them as each page arrives, so that the decoded JSON of a
+# page, with its dozens of fields for every result, can be dropped at once.
+Repository = collections.namedtuple(
+    'Repository', ['name', 'pushed_at', 'updated_at', 'fork'])
+Repository.__new__.__defaults__ = (None, None, False)
+
+Ref = collections.namedtuple('Ref', ['ref', 'sha'])
+
 
 class GitHubError(Exception):
     pass
 
 
+class RefSyncError(GitHubError):
+    """ Some of a fork's refs couldn't be synced. failures maps each of
+        their names to the error from GitHub. """
+
+    def __init__(self, fork_user, fork_repository, failures, attempted):
+        self.failures = failures
+        super(RefSyncError, self).__init__(
+            'Failed to sync {} of {} refs of {}/{}: {}'.format(
+                len(failures), attempted, fork_user, fork_repository,
+                '; '.join(ref + ': ' + error
+                          for ref, error in failures.items())))
+
+
+class ForkUpdateError(GitHubError):
+    """ Some of a batch of forks couldn't be updated. failures maps each of
+        their (fork_user, fork_repository) to the error from GitHub. """
+
+    def __init__(self, failures, attempted):
+        self.failures = failures
+        super(ForkUpdateError, self).__init__(
+            'Failed to update {} of {} forks: {}'.format(
+                len(failures), attempted,
+                '; '.join(user + '/' + repository + ': ' + error
+                          for (user, repository), error
+                          in failures.items())))
+
+
+class GitHubClient(object):
+    """ A client for the GitHub API that owns a pooled, keep-alive session,
+        so that connections are reused across calls instead of paying a new
+        TCP and TLS handshake for every request.
+
+        If given a ResponseCache, GET requests are made conditionally and
+        unchanged responses are served from the cache. If given a
+        RateLimiter, requests are paced to stay within the rate limit and
+        rate limited requests are retried up to max_retries times. If given
+        a Metrics, every request is recorded in it. """
+
+    def __init__(self, headers=None, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, cache=None, rate_limiter=None,
+                 max_retries=DEFAULT_MAX_RETRIES, metrics=None):
+        if headers is None:
+            headers = HEADERS
+        self.timeout = timeout
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.metrics = metrics
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept'] = 'application/vnd.github.v3+json'
+        self.session.headers.update(headers)
+
+    def request(self, method, url, **kwargs):
+        """ Make a request, waiting for the rate limiter if there is one and
+            retrying requests that were rate limited """
+        if self.rate_limiter is None:
+            return self.measure(method, url, **kwargs)
+
+        resource = rate_limit_resource(url)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait(resource)
+            response = self.measure(method, url, **kwargs)
+            self.rate_limiter.update(response, resource)
+
+            delay = self.rate_limiter.retry(response, resource)
+            if delay is None or attempt == self.max_retries:
+                break
+            logger.warning("Rate limited, retrying {} in {:.0f}s".format(
+                url, delay))
+            if self.metrics is not None:
+                self.metrics.record_retry(method, url)
+
+        return response
+
+    def measure(self, method, url, **kwargs):
+        """ Send a request, recording it if we have a Metrics """
+        if self.metrics is None:
+            return self.send(method, url, **kwargs)
+
+        start = time.time()
+        response = self.send(method, url, **kwargs)
+        self.metrics.record_request(method, url, response,
+                                    time.time() - start,
+                                    data=kwargs.get('data'))
+        return response
+
+    def send(self, method, url, **kwargs):
+        """ Make a request using the pooled session """
+        kwargs.setdefault('timeout', self.timeout)
+        if method != 'GET' or self.cache is None:
+            return self.session.request(method, url, **kwargs)
+
+        entry = self.cache.lookup(url)
+        if entry is not None:
+            headers = self.cache.conditional_headers(entry)
+            headers.update(kwargs.pop('headers', None) or {})
+            kwargs['headers'] = headers
+
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            return self.cache.response(entry, response)
+        self.cache.store(url, response)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+
+# The client shared by all of the API functions below
+client = GitHubClient()
+
+
+def pool_size(workers):
+    """ The number of pooled connections for a run with the given number of
+        workers. Each worker may have a listing's pages or a fork's refs in
+        flight at once, and a new fork being waited for besides; a smaller
+        pool discards connections rather than keeping them alive. """
+    per_worker = max(DEFAULT_PAGE_WORKERS, DEFAULT_REF_WORKERS) + 1
+    return max(DEFAULT_POOL_SIZE, workers * per_worker)
+
+
+def configure(**kwargs):
+    """ Replace the shared client with one built from the given options """
+    global client
+    client = GitHubClient(**kwargs)
+    return client
+
+
 def rate_limit():
     """ Check GitHub rate limit """
     rate_limit_url = '/'.join([GITHUB_API_URL, 'rate_limit'])
-    response = requests.get(rate_limit_url, headers=HEADERS)
+    response = client.get(rate_limit_url)
     response_json = response.json()
     limit = response_json['rate']['limit']
     remaining = response_json['rate']['remaining']
@@ -25,46 +218,196 @@ def rate_limit():
     return (limit, remaining, reset)
 
 
-def github_api_all(url):
+def set_query_parameter(url, name, value):
+    """ Set a query string parameter on a URL, replacing any existing one """
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    parameters = [(k, v) for k, v in parse_qsl(query, keep_blank_values=True)
+                  if k != name]
+    parameters.append((name, str(value)))
+    return urlunsplit((scheme, netloc, path, urlencode(parameters), fragment))
+
+
+def remaining_page_urls(links):
+    """
+    Get the URLs of every page after the current one from the 'next' and
+    'last' links of a response, or None if the page numbers can't be read
+    from them.
+    """
+    try:
+        next_url = links['next']['url']
+        last_url = links['last']['url']
+        next_page = int(dict(parse_qsl(urlsplit(next_url).query))['page'])
+        last_page = int(dict(parse_qsl(urlsplit(last_url).query))['page'])
+    except (KeyError, ValueError):
+        return None
+    return [set_query_parameter(last_url, 'page', page)
+            for page in range(next_page, last_page + 1)]
+
+
+def extract_page(page_json, extract=None):
+    """ Convert each result of a page with extract, if given """
+    if extract is None:
+        return page_json
+    return [extract(result) for result in page_json]
+
+
+def github_api_page(url, extract=None):
+    """ Fetch a single page of results for the given URL """
+    response = client.get(url)
+    if response.status_code != 200:
+        raise GitHubError(response.json()['message'])
+    return extract_page(response.json(), extract)
+
+
+def github_api_all(url, extract=None):
     """
     Fetch all results, not simply the first page of results, for the given URL.
+
+    Results are requested 100 to a page. Once the first page tells us how
+    many pages there are, the rest are fetched concurrently and assembled in
+    order. Given an extract function, each page's results are converted
+    with it as the page arrives, and only what it returns is kept.
     """
+    if 'per_page' not in parse_qs(urlsplit(url).query):
+        url = set_query_parameter(url, 'per_page', DEFAULT_PER_PAGE)
+
     # Get our initial response
-    response = requests.get(url, headers=HEADERS)
+    response = client.get(url)
     if response.status_code != 200:
         raise GitHubError(response.json()['message'])
 
-    response_json = response.json()
-    while 'next' in response.links:
-        # While we have a 'next' link, fetch it and add its response to the
-        # json object.
-        response = requests.get(response.links['next']['url'], headers=HEADERS)
-        response_json += response.json()
+    response_json = extract_page(response.json(), extract)
+    if 'next' not in response.links:
+        return response_json
+
+    page_urls = remaining_page_urls(response.links)
+    if page_urls is None:
+        while 'next' in response.links:
+            # While we have a 'next' link, fetch it and add its response to
+            # the json object.
+            response = client.get(response.links['next']['url'])
+            response_json += extract_page(response.json(), extract)
+        return response_json
+
+    workers = min(DEFAULT_PAGE_WORKERS, len(page_urls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page_json in executor.map(
+                functools.partial(github_api_page, extract=extract),
+                page_urls):
+            response_json += page_json
 
     return response_json
 
 
-def list_repositories(user_or_org):
-    """ List a user/org's repositories """
+def github_api_iter(url, extract=None):
+    """
+    Iterate over all results for the given URL, fetching each page only as
+    the results of the previous one are consumed, and converting each page
+    with extract if it is given.
+    """
+    if 'per_page' not in parse_qs(urlsplit(url).query):
+        url = set_query_parameter(url, 'per_page', DEFAULT_PER_PAGE)
+
+    while url is not None:
+        response = client.get(url)
+        if response.status_code != 200:
+            raise GitHubError(response.json()['message'])
+
+        url = response.links.get('next', {}).get('url')
+        for result in extract_page(response.json(), extract):
+            yield result
+
+
+def repository_details(repository_json):
+    """ Keep only the metadata we use from a repository's JSON """
+    return Repository(repository_json['name'],
+                      repository_json.get('pushed_at'),
+                      repository_json.get('updated_at'),
+                      repository_json.get('fork') is True)
+
+
+def ref_details(ref_json):
+    """ Keep only the name and SHA from a git ref's JSON """
+    return Ref(ref_json['ref'], ref_json['object']['sha'])
+
+
+def list_repository_details(user_or_org):
+    """ List a user/org's repositories with the metadata we use, as
+        Repository records """
     # First see if we were given a user or an organization. Assume org first.
     repos_url = '/'.join([GITHUB_API_URL, 'orgs', user_or_org, 'repos'])
-    response_json = github_api_all(repos_url)
+    repositories = github_api_all(repos_url, extract=repository_details)
 
-    if response_json is None:
+    if repositories is None:
         # If we didn't successfully get an org, let's try a user
         repos_url = '/'.join([GITHUB_API_URL, 'users', user_or_org, 'repos'])
-        response_json = github_api_all(repos_url)
+        repositories = github_api_all(repos_url, extract=repository_details)
 
-    repositories = [r['name'] for r in response_json]
     return repositories
 
 
+def iter_repository_details(user_or_org):
+    """ Iterate over a user/org's repositories like list_repository_details,
+        listing each page only as it is needed """
+    repos_url = '/'.join([GITHUB_API_URL, 'orgs', user_or_org, 'repos'])
+    return github_api_iter(repos_url, extract=repository_details)
+
+
+def list_repositories(user_or_org):
+    """ List a user/org's repositories """
+    return [r.name for r in list_repository_details(user_or_org)]
+
+
+class DestinationIndex(object):
+    """ An in-memory index of a destination org's repositories, built from a
+        single listing of the org the first time it is needed, so that
+        checking for a fork doesn't cost an API call per repository. Safe to
+        share between threads and between source orgs. """
+
+    def __init__(self, destination_org):
+        self.destination_org = destination_org
+        self.lock = threading.Lock()
+        self.repositories = None
+
+    def load(self):
+        """ List the destination org's repositories, if we haven't yet """
+        with self.lock:
+            if self.repositories is not None:
+                return
+            repos_url = '/'.join([GITHUB_API_URL, 'orgs',
+                                  self.destination_org, 'repos'])
+            self.repositories = {
+                r.name: r.fork
+                for r in github_api_all(repos_url, extract=repository_details)}
+
+    def fork_exists(self, fork_name):
+        """ Check if a fork exists, raising GitHubError if a repository with
+            the fork's name exists and is not a fork """
+        self.load()
+        is_fork = self.repositories.get(fork_name)
+        if is_fork is None:
+            return False
+        if is_fork:
+            return True
+        raise GitHubError(fork_name + ' already exists and is not a fork')
+
+    def add(self, fork_name):
+        """ Record a fork created during this run """
+        self.load()
+        with self.lock:
+            self.repositories[fork_name] = True
+
+
 def fork_exists(origin_user, origin_repository,
-                destination_org, fork_name=None):
-    """ Check if a fork exists for an org """
+                destination_org, fork_name=None, index=None):
+    """ Check if a fork exists for an org, using the given DestinationIndex
+        of the org if there is one """
     if fork_name is None:
         fork_name = origin_repository
 
+    if index is not None:
+        return index.fork_exists(fork_name)
+
     # Check to see if we already have a fork of this repository
     existing_url = '/'.join([
         GITHUB_API_URL,
@@ -72,7 +415,7 @@ def fork_exists(origin_user, origin_repository,
         destination_org,
         fork_name
     ])
-    existing_response = requests.get(existing_url, headers=HEADERS)
+    existing_response = client.get(existing_url)
     if existing_response.status_code == 200:
         if existing_response.json()['fork'] is True:
             return True
@@ -80,21 +423,41 @@ def fork_exists(origin_user, origin_repository,
     return False
 
 
-def fork_repository(origin_user, origin_repository, destination_org):
-    """ Fork an origin user/org's repository to an org. """
+def fork_repository(origin_user, origin_repository, destination_org,
+                    name=None):
+    """ Fork an origin user/org's repository to an org, asking for the fork
+        to be given name if one is given. Returns the name GitHub gave the
+        fork, which may not be the one asked for: an existing fork is
+        returned under the name it already has, and a name that is taken
+        gets a numbered suffix. """
     # Fork the repository
     fork_url = '/'.join([
         GITHUB_API_URL,
         'repos',
         origin_user,
         origin_repository,
-        'forks?org=' + destination_org
+        'forks'
     ])
-    fork_response = requests.post(fork_url, headers=HEADERS)
+    parameters = {'organization': destination_org}
+    if name is not None:
+        parameters['name'] = name
+    fork_response = client.post(fork_url, data=json.dumps(parameters))
     if fork_response.status_code != 202:
         raise GitHubError(fork_response.json()['message'])
 
-    return True
+    return fork_response.json()['name']
+
+
+def fork_ready(destination_org, repository):
+    """ Check if a newly created fork's git data can be accessed yet """
+    commits_url = '/'.join([
+        GITHUB_API_URL,
+        'repos',
+        destination_org,
+        repository,
+        'commits?per_page=1'
+    ])
+    return client.get(commits_url).status_code == 200
 
 
 def rename_repository(user_or_org, old_name, new_name):
@@ -107,70 +470,350 @@ def rename_repository(user_or_org, old_name, new_name):
         old_name,
     ])
     parameters = json.dumps({'name': new_name})
-    edit_response = requests.post(edit_url, headers=HEADERS, data=parameters)
+    edit_response = client.post(edit_url, data=parameters)
     if edit_response.status_code != 200:
         raise GitHubError(edit_response.json()['message'])
 
     return True
 
 
-def update_fork(origin_user, origin_repository, fork_user, fork_repository):
-    """ Update a fork or an origin user/org's repository """
+def list_refs(user_or_org, repository):
+    """ Get a map of a repository's branches and tags, by their full ref
+        names such as 'refs/heads/master', to the SHAs they point at """
+    refs = collections.OrderedDict()
+    for namespace in REF_NAMESPACES:
+        refs_url = '/'.join([
+            GITHUB_API_URL,
+            'repos',
+            user_or_org,
+            repository,
+            'git', 'matching-refs',
+            namespace,
+        ])
+        refs.update(github_api_all(refs_url, extract=ref_details))
+    return refs
+
+
+def get_refs(user_or_org, repository, refs):
+    """ Get a map of just the given full ref names of a repository to the
+        SHAs they point at, leaving out refs that don't exist """
+    found = collections.OrderedDict()
+    for ref in refs:
+        ref_url = '/'.join([
+            GITHUB_API_URL,
+            'repos',
+            user_or_org,
+            repository,
+            'git', 'ref',
+            ref[len('refs/'):],
+        ])
+        response = client.get(ref_url)
+        if response.status_code == 404:
+            continue
+        if response.status_code != 200:
+            raise GitHubError(response.json()['message'])
+        found[ref] = response.json()['object']['sha']
+    return found
+
+
+def list_refs_batch(repositories):
+    """
+    Get ref name to SHA maps, as returned by list_refs, for many
+    repositories at once using the GraphQL API. Takes a list of
+    (user_or_org, repository) pairs and returns a dict keyed by those pairs.
+    Repositories that GraphQL could not resolve map to None, so callers can
+    fall back to list_refs.
+    """
+    graphql_url = '/'.join([GITHUB_API_URL, 'graphql'])
+    refs = {repository: {} for repository in repositories}
+
+    # Each namespace of each repository is queried under its own alias, and
+    # those with more than a page of refs are queried again, starting after
+    # the cursor of their last page
+    cursors = {(repository, 'refs/' + namespace + '/'): None
+               for repository in repositories
+               for namespace in REF_NAMESPACES}
+    while cursors:
+        batch = list(cursors.items())
+        fragments = []
+        for index, (((owner, name), prefix), cursor) in enumerate(batch):
+            after = '' if cursor is None else ', after: ' + json.dumps(cursor)
+            fragments.append(GRAPHQL_REFS_FRAGMENT.format(
+                alias='r' + str(index),
+                owner=json.dumps(owner),
+                name=json.dumps(name),
+                prefix=json.dumps(prefix),
+                after=after,
+            ))
+        query = '{' + ' '.join(fragments) + '}'
+
+        response = client.post(graphql_url, data=json.dumps({'query': query}))
+        if response.status_code != 200:
+            raise GitHubError(response.json()['message'])
+        data = response.json().get('data') or {}
+
+        cursors = {}
+        for index, ((repository, prefix), cursor) in enumerate(batch):
+            repository_json = data.get('r' + str(index))
+            if repository_json is None or refs[repository] is None:
+                refs[repository] = None
+                continue
+
+            refs_json = repository_json['refs']
+            for node in refs_json['nodes']:
+                refs[repository][prefix + node['name']] = (
+                    node['target']['oid'])
+            if refs_json['pageInfo']['hasNextPage']:
+                cursors[(repository, prefix)] = (
+                    refs_json['pageInfo']['endCursor'])
+
+    return refs
+
+
+def write_ref(fork_user, fork_repository, ref, commit, exists):
+    """ Point one of a fork's refs, such as 'refs/heads/master', at a SHA,
+        creating the ref unless it exists """
+    if exists:
+        # This is an update to an existing ref
+        patch_url = '/'.join([
+            GITHUB_API_URL,
+            'repos',
+            fork_user,
+            fork_repository,
+            'git',
+            ref
+        ])
+        response = client.patch(patch_url, data=json.dumps({'sha': commit}))
+        if response.status_code != 200:
+            raise GitHubError(response.json()['message'])
+
+    else:
+        # This is a new ref
+        post_url = '/'.join([
+            GITHUB_API_URL,
+            'repos',
+            fork_user,
+            fork_repository,
+            'git', 'refs'
+        ])
+        parameters = {'ref': ref, 'sha': commit}
+        response = client.post(post_url, data=json.dumps(parameters))
+        if response.status_code != 201:
+            raise GitHubError(response.json()['message'])
+
+
+def sync_refs(fork_user, fork_repository, upstream_refs, fork_refs,
+              state=None, workers=DEFAULT_REF_WORKERS):
+    """ Point a fork's refs at the SHAs of its upstream's refs. Both ref
+        arguments map full ref names to SHAs, as returned by list_refs, and
+        refs that already match are left alone. Given a StateStore, each
+        ref written is recorded in it.
+
+        Up to workers refs are written at once. A ref that fails to be
+        written doesn't stop the others; once every ref has been tried, a
+        RefSyncError listing all of the failures is raised. """
+    writes = [(ref, commit, ref in fork_refs)
+              for ref, commit in upstream_refs.items()
+              if fork_refs.get(ref) != commit]
+
+    def write(ref_write):
+        ref, commit, exists = ref_write
+        try:
+            write_ref(fork_user, fork_repository, ref, commit, exists)
+        except GitHubError as e:
+            return ref, str(e)
+        if state is not None:
+            state.record_ref(fork_user, fork_repository, ref, commit)
+        return ref, None
+
+    if workers <= 1 or len(writes) <= 1:
+        results = [write(ref_write) for ref_write in writes]
+    else:
+        with ThreadPoolExecutor(
+                max_workers=min(workers, len(writes))) as executor:
+            results = list(executor.map(write, writes))
+
+    failures = collections.OrderedDict(
+        (ref, error) for ref, error in results if error is not None)
+    if failures:
+        raise RefSyncError(fork_user, fork_repository, failures,
+                           len(writes))
+
+
+def reconcile_refs(fork_user, fork_repository, state):
+    """ Refresh the StateStore's record of a fork's refs from GitHub """
+    fork_refs = list_refs(fork_user, fork_repository)
+    state.replace_refs(fork_user, fork_repository, fork_refs)
+    return fork_refs
+
+
+def sync_recorded_fork(fork_user, fork_repository, upstream_refs, state,
+                       reconcile=False):
+    """ Sync a fork with its upstream's refs, taking the fork's refs from a
+        StateStore rather than listing them from GitHub. If a write based on
+        the store fails, the fork has drifted from our record of it, so the
+        record is refreshed from GitHub and the sync retried. With
+        reconcile, the record is always refreshed first. """
+    fork_refs = None
+    if not reconcile:
+        fork_refs = state.refs(fork_user, fork_repository)
+    if fork_refs is None:
+        fork_refs = reconcile_refs(fork_user, fork_repository, state)
+        sync_refs(fork_user, fork_repository, upstream_refs, fork_refs,
+                  state=state)
+        return
+
+    try:
+        sync_refs(fork_user, fork_repository, upstream_refs, fork_refs,
+                  state=state)
+    except GitHubError:
+        logger.warning("Fork " + fork_user + '/' + fork_repository
+                       + " has drifted from its recorded state, "
+                       "reconciling")
+        fork_refs = reconcile_refs(fork_user, fork_repository, state)
+        sync_refs(fork_user, fork_repository, upstream_refs, fork_refs,
+                  state=state)
+
+
+def update_fork(origin_user, origin_repository, fork_user, fork_repository,
+                state=None, reconcile=False, refs=None):
+    """ Update a fork or an origin user/org's repository, pointing its
+        branches and tags at the origin's
+
+        Given a StateStore, the fork is synced with sync_recorded_fork.
+        Given an iterable of full ref names, only those refs are fetched
+        and synced, rather than every ref of the origin and the fork. """
     # http://stackoverflow.com/a/27762278/2877583
 
-    # Get a list of branches in the origin
-    upstream_branches_url = '/'.join([
-        GITHUB_API_URL,
-        'repos',
-        origin_user,
-        origin_repository,
-        'branches',
-    ])
-    upstream_branches_json = github_api_all(upstream_branches_url)
-    upstream_branches = [(b['name'], b['commit']['sha'])
-                         for b in upstream_branches_json]
+    # Get the branches and tags of the origin
+    if refs is None:
+        upstream_refs = list_refs(origin_user, origin_repository)
+    else:
+        refs = list(refs)
+        upstream_refs = get_refs(origin_user, origin_repository, refs)
+
+    if state is not None:
+        sync_recorded_fork(fork_user, fork_repository, upstream_refs,
+                           state, reconcile=reconcile)
+        return
 
-    # Get a list of fork branches, so we know whether to update the branch or
+    # Get the refs of the fork, so we know whether to update each ref or
     # create a new one
-    fork_branches_url = '/'.join([
-        GITHUB_API_URL,
-        'repos',
-        fork_user,
-        fork_repository,
-        'branches',
-    ])
-    fork_branches_json = github_api_all(fork_branches_url)
-    fork_branches = {b['name']: b['commit']['sha'] for b in fork_branches_json}
+    if refs is None:
+        fork_refs = list_refs(fork_user, fork_repository)
+    else:
+        fork_refs = get_refs(fork_user, fork_repository, refs)
 
-    for branch, commit in upstream_branches:
-        parameters = {'sha': commit}
+    sync_refs(fork_user, fork_repository, upstream_refs, fork_refs)
 
-        if branch in fork_branches:
-            if fork_branches[branch] == commit:
-                continue
 
-            # This is an update to an existing branch
-            patch_url = '/'.join([
-                GITHUB_API_URL,
-                'repos',
-                fork_user,
-                fork_repository,
-                'git', 'refs', 'heads',
-                branch
-            ])
-            response = requests.patch(patch_url, data=json.dumps(parameters))
-            if response.status_code != 200:
-                raise GitHubError(response.json()['message'])
+def update_forks(forks, state=None, reconcile=False):
+    """
+    Update many forks, fetching the refs of all of the upstreams and forks
+    in one GraphQL query. Takes a list of (origin_user, origin_repository,
+    fork_user, fork_repository) tuples.
 
+    Given a StateStore, forks whose refs are recorded in it are synced from
+    the record with sync_recorded_fork instead of being queried.
+
+    A fork that fails to update doesn't stop the rest of the batch; once
+    they have all been tried, a ForkUpdateError listing every failure is
+    raised.
+    """
+    recorded = set()
+    repositories = []
+    for origin_user, origin_repository, fork_user, fork_repository in forks:
+        repositories.append((origin_user, origin_repository))
+        if (state is not None and not reconcile
+                and state.refs(fork_user, fork_repository) is not None):
+            recorded.add((fork_user, fork_repository))
         else:
-            # This is a new branch
-            post_url = '/'.join([
-                GITHUB_API_URL,
-                'repos',
-                fork_user,
-                fork_repository,
-                'git', 'refs'
-            ])
-            response = requests.post(post_url, data=json.dumps(parameters))
-            if response.status_code != 201:
-                raise GitHubError(response.json()['message'])
+            repositories.append((fork_user, fork_repository))
+    refs = list_refs_batch(repositories)
+
+    failures = collections.OrderedDict()
+    for origin_user, origin_repository, fork_user, fork_repository in forks:
+        try:
+            update_batched_fork(origin_user, origin_repository, fork_user,
+                                fork_repository, refs, recorded, state=state,
+                                reconcile=reconcile)
+        except GitHubError as e:
+            logger.error("Error updating fork " + fork_user + '/'
+                         + fork_repository + ": " + str(e))
+            failures[(fork_user, fork_repository)] = str(e)
+
+    if failures:
+        raise ForkUpdateError(failures, len(forks))
+
+
+def update_batched_fork(origin_user, origin_repository, fork_user,
+                        fork_repository, refs, recorded, state=None,
+                        reconcile=False):
+    """ Update one fork of update_forks from the refs its batch query found,
+        or those recorded in the state if the fork is in recorded """
+    upstream_refs = refs[(origin_user, origin_repository)]
+    if upstream_refs is not None and (fork_user,
+                                      fork_repository) in recorded:
+        sync_recorded_fork(fork_user, fork_repository, upstream_refs, state)
+        return
+
+    fork_refs = refs.get((fork_user, fork_repository))
+    if upstream_refs is None or fork_refs is None:
+        update_fork(origin_user, origin_repository,
+                    fork_user, fork_repository,
+                    state=state, reconcile=reconcile)
+        return
+
+    if state is not None:
+        state.replace_refs(fork_user, fork_repository, fork_refs)
+    sync_refs(fork_user, fork_repository, upstream_refs, fork_refs,
+              state=state)
+
+
+class BatchForkUpdater(object):
+    """ Collects forks to update and updates them with update_forks once
+        batch_size of them have been added. Safe to share between threads;
+        call flush() to update whatever remains. If given, on_updated is
+        called with each fork's arguments once its batch has been updated,
+        for every fork that was, before the batch's ForkUpdateError is
+        raised for the rest. The state and reconcile arguments are passed on
+        to update_forks. """
+
+    def __init__(self, batch_size=DEFAULT_GRAPHQL_BATCH_SIZE,
+                 on_updated=None, state=None, reconcile=False):
+        self.batch_size = batch_size
+        self.on_updated = on_updated
+        self.state = state
+        self.reconcile = reconcile
+        self.lock = threading.Lock()
+        self.forks = []
+
+    def __call__(self, origin_user, origin_repository, fork_user,
+                 fork_repository):
+        with self.lock:
+            self.forks.append((origin_user, origin_repository,
+                               fork_user, fork_repository))
+            if len(self.forks) < self.batch_size:
+                return
+            forks, self.forks = self.forks, []
+        self.update(forks)
+
+    def flush(self):
+        with self.lock:
+            forks, self.forks = self.forks, []
+        if forks:
+            self.update(forks)
+
+    def update(self, forks):
+        error = None
+        try:
+            update_forks(forks, state=self.state, reconcile=self.reconcile)
+        except ForkUpdateError as e:
+            error = e
+
+        if self.on_updated is not None:
+            for fork in forks:
+                if error is None or tuple(fork[2:]) not in error.failures:
+                    self.on_updated(*fork)
+        if error is not None:
+            raise error
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+
+
+class Journal(object):
+    """ A checkpoint journal of a run: a JSON lines file with a line for
+        each step of each repository, as it happens. A repository is
+        'start'ed, then 'forked' and 'renamed' if it is new, and 'done'
+        once its outcome is known.
+
+        With resume, the journal of an interrupted run is read back and
+        added to, so that the run can be picked up where it left off:
+        repositories that are done can be skipped, and a repository that
+        was forked but maybe not renamed can be renamed without forking it
+        again. Otherwise the journal starts afresh. Safe to share between
+        threads. """
+
+    def __init__(self, path, resume=False, clock=time.time):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.stages = {}
+        if resume and os.path.exists(path):
+            self.load(path)
+        self.file = open(path, 'a' if resume else 'w')
+
+    def load(self, path):
+        """ Read the last stage each repository reached """
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The run died while writing this line
+                    continue
+                key = (entry['org'], entry['repository'], entry['dest_org'])
+                self.stages[key] = entry['event']
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def record(self, org, repository, dest_org, event, outcome=None):
+        """ Record that a repository has reached a stage """
+        entry = {'time': self.clock(), 'org': org, 'repository': repository,
+                 'dest_org': dest_org, 'event': event}
+        if outcome is not None:
+            entry['outcome'] = outcome
+        line = json.dumps(entry, sort_keys=True) + '\n'
+
+        with self.lock:
+            self.stages[(org, repository, dest_org)] = event
+            self.file.write(line)
+            self.file.flush()
+
+    def stage(self, org, repository, dest_org):
+        """ Get the last stage a repository reached, or None """
+        with self.lock:
+            return self.stages.get((org, repository, dest_org))
+
+    def done(self, org, repository, dest_org):
+        return self.stage(org, repository, dest_org) == 'done'
+
+    def finish(self, org, repository, dest_org, outcome):
+        """ Record a repository as done with its outcome, which may be a
+            Future, unless it failed """
+        if hasattr(outcome, 'add_done_callback'):
+            def finished(future):
+                if future.exception() is None:
+                    self.finish(org, repository, dest_org, future.result())
+            outcome.add_done_callback(finished)
+            return
+
+        if outcome != 'failed':
+            self.record(org, repository, dest_org, 'done', outcome=outcome)
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+import collections
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from preserve import github
+from preserve.ratelimit import CORE, rate_limit_resource
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_PREFIX = 'preserve_'
+
+
+def endpoint(url):
+    """ Get the templated endpoint of a GitHub API URL, with owners,
+        repository names and refs replaced by placeholders, so that
+        requests can be grouped by endpoint """
+    if url.startswith(github.GITHUB_API_URL):
+        url = url[len(github.GITHUB_API_URL):]
+    parts = [p for p in urlsplit(url).path.split('/') if p]
+
+    if parts[:1] == ['repos'] and len(parts) >= 3:
+        template, rest = ['repos', '{owner}', '{repo}'], parts[3:]
+        if rest[:1] == ['git']:
+            template += rest[:2] + (['{ref}'] if len(rest) > 2 else [])
+        else:
+            template += rest[:1] + (['{name}'] if len(rest) > 1 else [])
+    elif parts[:1] == ['orgs'] and len(parts) >= 2:
+        template = ['orgs', '{org}'] + parts[2:]
+    elif parts[:1] == ['users'] and len(parts) >= 2:
+        template = ['users', '{user}'] + parts[2:]
+    else:
+        template = parts
+    return '/' + '/'.join(template)
+
+
+class Metrics(object):
+    """ Collects metrics of a run: GitHub API requests by endpoint and
+        status, a histogram of their latency by endpoint, rate limit
+        retries, bytes sent and received, cache hits and how much of the
+        rate limit was used, as well as counts of repository outcomes.
+
+        Given to a GitHubClient, every request it makes is recorded. The
+        metrics can be exported with to_json, or as a Prometheus textfile
+        with to_prometheus. Safe to share between threads. """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, clock=time.time):
+        self.buckets = tuple(buckets)
+        self.clock = clock
+        self.started = clock()
+
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.latency = {}
+        self.retries = collections.Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.cache_hits = 0
+        self.outcomes = collections.Counter()
+
+        # The highest remaining count before, and lowest after, any request
+        # in each rate limit window, keyed by the window's resource and reset
+        # time, and the last remaining count of each resource
+        self.rate_limit_windows = {}
+        self.rate_limit_remaining = {}
+
+    def record_request(self, method, url, response, seconds, data=None):
+        """ Record a request and its response, which took seconds """
+        key = (method, endpoint(url))
+        from_cache = getattr(response, 'from_cache', False)
+        status = 304 if from_cache else response.status_code
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        with self.lock:
+            self.requests[key + (status,)] += 1
+            histogram = self.latency.setdefault(
+                key, {'buckets': [0] * len(self.buckets), 'sum': 0.0,
+                      'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+            self.bytes_sent += len(data or b'')
+            if from_cache:
+                self.cache_hits += 1
+            else:
+                self.bytes_received += len(response.content or b'')
+
+        self.record_rate_limit(response, charged=not from_cache,
+                               resource=rate_limit_resource(url))
+
+    def record_rate_limit(self, response, charged=True, resource=CORE):
+        """ Track rate limit use from the headers of a response to a request
+            against resource, unless the response names its own """
+        try:
+            remaining = int(response.headers['X-RateLimit-Remaining'])
+            reset = int(response.headers['X-RateLimit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        resource = response.headers.get('X-RateLimit-Resource', resource)
+
+        before = remaining + 1 if charged else remaining
+        with self.lock:
+            window = self.rate_limit_windows.setdefault(
+                (resource, reset), [before, remaining])
+            window[0] = max(window[0], before)
+            window[1] = min(window[1], remaining)
+            self.rate_limit_remaining[resource] = window[1]
+
+    def record_retry(self, method, url):
+        with self.lock:
+            self.retries[(method, endpoint(url))] += 1
+
+    def record_outcomes(self, outcomes):
+        """ Count repository outcomes: 'forked', 'updated', 'skipped' or
+            'failed' """
+        with self.lock:
+            self.outcomes.update(outcomes)
+
+    @property
+    def rate_limit_used(self):
+        """ How much of each resource's rate limit was used """
+        with self.lock:
+            used = collections.Counter()
+            for (resource, reset), (before, after) in (
+                    self.rate_limit_windows.items()):
+                used[resource] += before - after
+            return dict(used)
+
+    def to_dict(self):
+        rate_limit_used = self.rate_limit_used
+        with self.lock:
+            endpoints = collections.OrderedDict()
+            for (method, path, status), count in sorted(
+                    self.requests.items()):
+                histogram = self.latency[(method, path)]
+                entry = endpoints.setdefault(method + ' ' + path, {
+                    'requests': {},
+                    'retries': self.retries[(method, path)],
+                    'latency': {'buckets': list(histogram['buckets']),
+                                'sum': histogram['sum'],
+                                'count': histogram['count']},
+                })
+                entry['requests'][str(status)] = count
+
+            return {
+                'duration': self.clock() - self.started,
+                'requests': sum(self.requests.values()),
+                'retries': sum(self.retries.values()),
+                'cache_hits': self.cache_hits,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'rate_limit_used': rate_limit_used,
+                'rate_limit_remaining': dict(self.rate_limit_remaining),
+                'latency_buckets': list(self.buckets),
+                'endpoints': endpoints,
+                'outcomes': dict(self.outcomes),
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """ Render the metrics in the Prometheus text exposition format """
+        metrics = self.to_dict()
+        lines = []
+
+        def metric(name, kind, description, samples):
+            name = PROMETHEUS_PREFIX + name
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                label_text = ','.join(
+                    '{}="{}"'.format(k, escape_label(v)) for k, v in labels)
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append('{}{}{} {}'.format(name, suffix, label_text,
+                                                format_value(value)))
+
+        requests, retries, latency = [], [], []
+        for name, entry in metrics['endpoints'].items():
+            method, path = name.split(' ', 1)
+            labels = [('method', method), ('endpoint', path)]
+            for status, count in sorted(entry['requests'].items()):
+                requests.append(('', labels + [('status', status)], count))
+            retries.append(('', labels, entry['retries']))
+            for bound, count in zip(self.buckets,
+                                    entry['latency']['buckets']):
+                latency.append(('_bucket', labels + [('le', bound)], count))
+            latency.append(('_bucket', labels + [('le', '+Inf')],
+                            entry['latency']['count']))
+            latency.append(('_sum', labels, entry['latency']['sum']))
+            latency.append(('_count', labels, entry['latency']['count']))
+
+        metric('github_requests_total', 'counter',
+               'GitHub API requests by endpoint and status', requests)
+        metric('github_request_duration_seconds', 'histogram',
+               'GitHub API request latency by endpoint', latency)
+        metric('github_retries_total', 'counter',
+               'Rate limited GitHub API requests that were retried', retries)
+        metric('github_cache_hits_total', 'counter',
+               'GitHub API responses served from the cache',
+               [('', [], metrics['cache_hits'])])
+        metric('github_sent_bytes_total', 'counter',
+               'Bytes of GitHub API request bodies sent',
+               [('', [], metrics['bytes_sent'])])
+        metric('github_received_bytes_total', 'counter',
+               'Bytes of GitHub API response bodies received',
+               [('', [], metrics['bytes_received'])])
+        metric('github_rate_limit_used', 'gauge',
+               'GitHub API rate limit used during the run by resource',
+               [('', [('resource', resource)], used) for resource, used
+                in sorted(metrics['rate_limit_used'].items())])
+        metric('github_rate_limit_remaining', 'gauge',
+               'GitHub API rate limit remaining at the end of the run by '
+               'resource',
+               [('', [('resource', resource)], remaining)
+                for resource, remaining
+                in sorted(metrics['rate_limit_remaining'].items())])
+        metric('repositories_total', 'counter',
+               'Repositories preserved by outcome',
+               [('', [('outcome', outcome)], count) for outcome, count
+                in sorted(metrics['outcomes'].items())])
+        metric('run_duration_seconds', 'gauge',
+               'Duration of the run', [('', [], metrics['duration'])])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        write_atomically(path, self.to_json() + '\n')
+
+    def write_prometheus(self, path):
+        write_atomically(path, self.to_prometheus())
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def write_atomically(path, content):
+    """ Write a file by renaming a complete temporary file into place, so
+        that a collector reading it never sees it half written """
+    # The temporary file's name must be unique, as other runs may be
+    # writing the same file, and it must be on the same filesystem as path
+    # for the rename to be atomic
+    fd, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        # mkstemp makes files only we can read; the collector may not be us
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except OSError:
+        os.remove(temporary_path)
+        raise
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+A backend that preserves repositories as local bare mirrors instead of as
+forks in a GitHub org. Repositories are listed with the GitHub API as
+usual, but are then cloned with `git clone --mirror` and refreshed with
+`git remote update --prune`, so a refresh runs at the speed of git
+transport rather than at the rate of REST calls, and the archive doesn't
+depend on GitHub keeping the forks.
+
+The mirror of org/repository lives at <mirror_dir>/org/repository.git.
+Each mirror is locked while it is cloned or refreshed, so that any number
+of runs, in threads or processes, can share a mirror directory. Locking
+uses flock, so the mirror directory must be on a local filesystem.
+"""
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+
+from preserve.github import iter_repository_details, list_repository_details
+from preserve.orgs import (
+    DEFAULT_ACTIVE_ORGS,
+    DEFAULT_BUFFER_PER_WORKER,
+    group_by_org,
+    interleave_organizations,
+    map_bounded,
+)
+
+logger = logging.getLogger()
+
+GIT_URL = 'https://github.com'
+
+# Seconds a single clone or refresh may take before it is given up on
+DEFAULT_GIT_TIMEOUT = 3600
+
+
+class MirrorError(Exception):
+    pass
+
+
+def run_git(args, cwd=None, input=None, timeout=DEFAULT_GIT_TIMEOUT):
+    """ Run a git command, with input as its stdin if given, raising a
+        MirrorError with git's message if it fails. Returns its output. """
+    # Never stop to ask for credentials
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    if input is not None:
+        input = input.encode('utf-8')
+    try:
+        result = subprocess.run(['git'] + args, cwd=cwd, env=env,
+                                input=input, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise MirrorError('git ' + args[0] + ' timed out')
+    if result.returncode != 0:
+        raise MirrorError(result.stderr.decode('utf-8', 'replace').strip())
+    return result.stdout.decode('utf-8', 'replace')
+
+
+def mirror_path(mirror_dir, org, repo):
+    return os.path.join(mirror_dir, org, repo + '.git')
+
+
+def mirror_url(org, repo, git_url=None):
+    """ The URL to clone a repository from. git_url defaults to GIT_URL,
+        and can be any base git understands, such as a file:// URL """
+    return '/'.join([git_url or GIT_URL, org, repo + '.git'])
+
+
+@contextlib.contextmanager
+def mirror_lock(path):
+    """ Try to lock a mirror without waiting, yielding whether the lock was
+        taken. The lock is released when the context exits, or by the OS if
+        the process dies. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def mirror_repository(org, repository, mirror_dir, git_url=None):
+    """ Clone or refresh the mirror of a single repository, one from
+        list_repository_details; returns 'cloned', 'updated', 'skipped' if
+        another run holds its lock, or 'failed'.
+
+        A new mirror is cloned next to its final path and moved into place
+        once the clone is complete, so an interrupted clone never leaves a
+        partial mirror behind to be refreshed. """
+    repo = repository.name
+    path = mirror_path(mirror_dir, org, repo)
+
+    with mirror_lock(path) as locked:
+        if not locked:
+            logger.info("\tSkipping " + org + '/' + repo
+                        + ", its mirror is being refreshed elsewhere")
+            return 'skipped'
+
+        try:
+            if os.path.exists(path):
+                logger.info("\tUpdating mirror of " + org + '/' + repo)
+                run_git(['remote', 'update', '--prune'], cwd=path)
+                return 'updated'
+
+            logger.info("\tMirroring " + org + '/' + repo)
+            clone_path = path + '.clone'
+            shutil.rmtree(clone_path, ignore_errors=True)
+            try:
+                run_git(['clone', '--mirror', '--quiet',
+                         mirror_url(org, repo, git_url), clone_path])
+            except MirrorError:
+                shutil.rmtree(clone_path, ignore_errors=True)
+                raise
+            os.rename(clone_path, path)
+            return 'cloned'
+        except MirrorError as e:
+            logger.error("\tError mirroring " + org + '/' + repo + ": "
+                         + str(e))
+            return 'failed'
+
+
+def mirror_repositories(repositories, mirror_dir, workers=1, git_url=None):
+    """ Mirror each of an iterable of (org, repository) pairs, where each
+        repository is one from list_repository_details, up to workers at
+        once, returning their outcomes in order """
+    def mirror(item):
+        org, repository = item
+        return mirror_repository(org, repository, mirror_dir,
+                                 git_url=git_url)
+
+    if workers <= 1:
+        return [mirror(item) for item in repositories]
+    return list(map_bounded(mirror, repositories, workers,
+                            workers * DEFAULT_BUFFER_PER_WORKER))
+
+
+def mirror_organization(org, mirror_dir, workers=1, stream=False,
+                        git_url=None):
+    """ Mirror all public repositories of the given GitHub organization into
+        mirror_dir, with the same listing options as preserve_organization.
+        Returns the outcomes in listing order. """
+    logger.info("Getting repositories for " + org)
+
+    if stream:
+        repositories = iter_repository_details(org)
+    else:
+        repositories = list_repository_details(org)
+
+    return mirror_repositories(
+        ((org, repository) for repository in repositories), mirror_dir,
+        workers=workers, git_url=git_url)
+
+
+def mirror_organizations(orgs, mirror_dir, workers=1,
+                         active=DEFAULT_ACTIVE_ORGS, git_url=None):
+    """ Mirror the repositories of an iterable of orgs on one shared pool of
+        workers, as preserve_organizations does, returning a map of each org
+        with repositories to their outcomes in listing order, ending with
+        'failed' for an org whose listing failed """
+    failed = []
+    results = group_by_org(
+        lambda pairs: mirror_repositories(pairs, mirror_dir, workers=workers,
+                                          git_url=git_url),
+        interleave_organizations(orgs, active=active, failed=failed))
+    for org in failed:
+        results.setdefault(org, []).append('failed')
+    return results
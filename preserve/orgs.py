@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
+import collections
+import functools
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+from preserve.forks import ForkPipeline
 
 from preserve.github import (
-    # GitHubError,
+    BatchForkUpdater,
+    GitHubError,
     fork_exists,
     fork_repository,
-    list_repositories,
+    iter_repository_details,
+    list_repository_details,
     rename_repository,
     update_fork,
 )
@@ -14,31 +23,321 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+# How many repositories may be queued ahead of each worker
+DEFAULT_BUFFER_PER_WORKER = 4
 
-def preserve_organization(org, dest_org):
-    """ Preserve all public repositories for the given GitHub organization """
-    logger.info("Getting repositories for " + org)
+# How many orgs share the workers at once when preserving many orgs
+DEFAULT_ACTIVE_ORGS = 16
 
-    # Get a list of that organization's repositories
-    repositories = list_repositories(org)
 
-    # Create forks
-    for repo in repositories:
-        fork_name = org + "_" + repo
+def complete_fork(org, repo, dest_org, fork_name, name, pushed_at=None,
+                  state=None, index=None, journal=None):
+    """ Rename a newly created fork from name, the name GitHub gave it,
+        unless it already has fork_name, and record it; returns 'forked' or
+        'failed' """
+    if name != fork_name:
+        if not rename_repository(dest_org, name, fork_name):
+            logger.error("\tError renaming fork " + org + '/' + repo)
+            return 'failed'
+        logger.debug("Renamed fork " + fork_name)
+
+    if journal is not None:
+        journal.record(org, repo, dest_org, 'renamed')
+    if index is not None:
+        index.add(fork_name)
+    if state is not None:
+        state.record_sync(dest_org, fork_name, pushed_at)
+    return 'forked'
+
+
+def preserve_repository(org, repository, dest_org, update=None, state=None,
+                        reconcile=False, index=None, forks=None,
+                        journal=None):
+    """ Fork or update a single repository in the destination org.
+
+        Takes one of the repositories from list_repository_details. The
+        fork, rename and update calls for a repository are always made in
+        order; returns 'forked', 'updated', 'skipped' or 'failed'.
+
+        Existing forks are updated with update_fork unless another update
+        function is given. Given a StateStore, repositories that haven't
+        been pushed to since their last sync are skipped, successful syncs
+        are recorded, and forks are updated from the recorded state of
+        their refs; a custom update function is responsible for
+        recording its own syncs. With reconcile, nothing is skipped and the
+        recorded state is refreshed from GitHub. Given a DestinationIndex,
+        forks are looked up in it rather than with an API call each.
+
+        Given a ForkPipeline, new forks are renamed once the pipeline finds
+        them ready, and a Future of the outcome is returned instead.
+
+        Given a Journal, the fork and rename of a new repository are
+        recorded in it. A repository that the journal shows was forked but
+        not renamed in an interrupted run is asked for again, which finds
+        its fork wherever it is, or forks it if it never was, and renamed
+        if need be. """
+    repo = repository.name
+    pushed_at = repository.pushed_at
+    fork_name = org + "_" + repo
+
+    if (state is not None and not reconcile and pushed_at is not None
+            and state.pushed_at(dest_org, fork_name) == pushed_at):
+        logger.debug("Skipping unchanged fork " + fork_name)
+        return 'skipped'
+
+    resumed = (journal is not None
+               and journal.stage(org, repo, dest_org) == 'forked')
+    if resumed and fork_exists(org, repo, dest_org, fork_name=fork_name,
+                               index=index):
+        # The run was interrupted after the rename went through
+        return complete_fork(org, repo, dest_org, fork_name, name=fork_name,
+                             pushed_at=pushed_at, state=state, index=index,
+                             journal=journal)
 
-        if not fork_exists(org, repo, dest_org, fork_name=fork_name):
+    if resumed or not fork_exists(org, repo, dest_org, fork_name=fork_name,
+                                  index=index):
+        # Forks are asked for under their final name, as repositories of
+        # the same name from other orgs may be being forked at once. A fork
+        # that already exists is returned under whatever name it has, so a
+        # resumed fork is asked for again to find it.
+        if resumed:
+            logger.info("\tResuming fork of " + org + '/' + repo)
+        else:
             logger.info("\tForking " + org + '/' + repo)
 
-            if not fork_repository(org, repo, dest_org):
-                logger.error("\tError forking " + org + '/' + repo)
-                continue
-            logger.debug("Create Fork " + org + '/' + repo)
+        name = fork_repository(org, repo, dest_org, name=fork_name)
+        if not name:
+            logger.error("\tError forking " + org + '/' + repo)
+            return 'failed'
+        logger.debug("Create Fork " + org + '/' + repo + " as " + name)
+        if journal is not None and not resumed:
+            journal.record(org, repo, dest_org, 'forked')
+
+        complete = functools.partial(
+            complete_fork, org, repo, dest_org, fork_name, name=name,
+            pushed_at=pushed_at, state=state, index=index, journal=journal)
+        if forks is not None:
+            return forks.when_ready(dest_org, name, complete)
+        return complete()
+
+    logger.info("\tUpdating fork " + fork_name)
+    if update is not None:
+        update(org, repo, dest_org, fork_name)
+        return 'updated'
+
+    if state is None:
+        update_fork(org, repo, dest_org, fork_name)
+        return 'updated'
+
+    update_fork(org, repo, dest_org, fork_name, state=state,
+                reconcile=reconcile)
+    state.record_sync(dest_org, fork_name, pushed_at)
+    return 'updated'
+
+
+def map_bounded(function, items, workers, buffer_size):
+    """ Like ThreadPoolExecutor.map, but items are only taken from the
+        iterable as results are consumed, with at most buffer_size of them
+        in flight. The first error, in order, is raised once reached and no
+        more items are started. """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = collections.deque()
+        try:
+            for item in items:
+                if len(futures) >= buffer_size:
+                    yield futures.popleft().result()
+                futures.append(executor.submit(function, item))
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            # Don't start any more items once one has failed
+            for future in futures:
+                future.cancel()
+
+
+def group_by_org(run, pairs):
+    """ Call run with an iterable of (org, item) pairs, which it must consume
+        in order, and group the outcomes it returns for them in the same
+        order by org. Returns a map of each org with items to their
+        outcomes, in the order the orgs first appear. """
+    orgs = []
+
+    def remember(items):
+        for org, item in items:
+            orgs.append(org)
+            yield org, item
+
+    outcomes = run(remember(pairs))
+
+    results = collections.OrderedDict()
+    for org, outcome in zip(orgs, outcomes):
+        results.setdefault(org, []).append(outcome)
+    return results
+
 
-            if not rename_repository(dest_org, repo, fork_name):
-                logger.error("\tError renaming fork " + org + '/' + repo)
-                continue
-            logger.debug("Renamed fork " + fork_name)
+def preserve_repositories(repositories, dest_org, workers=1, graphql=False,
+                          state=None, reconcile=False, index=None,
+                          async_forks=False, journal=None):
+    """ Preserve each of an iterable of (org, repository) pairs, where each
+        repository is one from list_repository_details, returning their
+        outcomes in order. See preserve_organization for the options. """
+    pushed_at = {}
+    update = None
+    if graphql:
+        def record_sync(org, repo, dest_org, fork_name):
+            if state is not None:
+                state.record_sync(dest_org, fork_name, pushed_at[(org, repo)])
+            if journal is not None:
+                journal.finish(org, repo, dest_org, 'updated')
 
+        update = BatchForkUpdater(on_updated=record_sync, state=state,
+                                  reconcile=reconcile)
+
+    forks = ForkPipeline(workers=max(workers, 1)) if async_forks else None
+
+    def preserve(item):
+        org, repository = item
+        repo = repository.name
+        pushed_at[(org, repo)] = repository.pushed_at
+        if journal is None:
+            return preserve_repository(org, repository, dest_org,
+                                       update=update, state=state,
+                                       reconcile=reconcile, index=index,
+                                       forks=forks)
+
+        stage = journal.stage(org, repo, dest_org)
+        if stage == 'done':
+            logger.debug("Skipping " + org + '/' + repo
+                         + ", done before resuming")
+            return 'skipped'
+        if stage is None:
+            journal.record(org, repo, dest_org, 'start')
+        outcome = preserve_repository(org, repository, dest_org,
+                                      update=update, state=state,
+                                      reconcile=reconcile, index=index,
+                                      forks=forks, journal=journal)
+        # Batched updates are finished once their batch is written
+        if update is None or outcome != 'updated':
+            journal.finish(org, repo, dest_org, outcome)
+        return outcome
+
+    try:
+        if workers <= 1:
+            outcomes = [preserve(item) for item in repositories]
         else:
-            logger.info("\tUpdating fork " + fork_name)
-            update_fork(org, repo, dest_org, fork_name)
+            outcomes = list(map_bounded(preserve, repositories, workers,
+                                        workers * DEFAULT_BUFFER_PER_WORKER))
+    finally:
+        if forks is not None:
+            forks.close()
+
+    if forks is not None:
+        outcomes = [o.result() if isinstance(o, Future) else o
+                    for o in outcomes]
+
+    if update is not None:
+        update.flush()
+    return outcomes
+
+
+def preserve_organization(org, dest_org, workers=1, graphql=False,
+                          state=None, reconcile=False, stream=False,
+                          index=None, async_forks=False, journal=None):
+    """ Preserve all public repositories for the given GitHub organization
+
+        With more than one worker, repositories are processed concurrently
+        by a bounded thread pool. Outcomes are returned in listing order,
+        and the first error in listing order is raised, just as it would
+        be in a serial run.
+
+        With stream, the listing is consumed page by page as repositories
+        are processed, so work starts on the first page while later pages
+        have yet to be listed, and only a bounded number of repositories
+        are buffered ahead of the workers.
+
+        With graphql, existing forks are updated in batches whose refs are
+        fetched with a single GraphQL query per batch. Given a
+        StateStore, repositories whose pushed_at hasn't changed since their
+        last sync are skipped without any further API calls, and forks are
+        updated from the recorded state of their refs; reconcile
+        refreshes that state from GitHub for every repository.
+
+        Given a DestinationIndex of dest_org, which can be shared between
+        runs for several orgs, forks are looked up in it.
+
+        With async_forks, the run doesn't wait for each new fork to become
+        ready before moving on. New forks are polled for readiness in the
+        background and renamed as soon as each is ready.
+
+        Given a Journal, each repository's progress is recorded in it, and
+        repositories it shows were done in an interrupted run are skipped.
+        """
+    logger.info("Getting repositories for " + org)
+
+    # Get a list of that organization's repositories
+    if stream:
+        repositories = iter_repository_details(org)
+    else:
+        repositories = list_repository_details(org)
+
+    return preserve_repositories(
+        ((org, repository) for repository in repositories), dest_org,
+        workers=workers, graphql=graphql, state=state, reconcile=reconcile,
+        index=index, async_forks=async_forks, journal=journal)
+
+
+def interleave_organizations(orgs, active=DEFAULT_ACTIVE_ORGS, failed=None):
+    """ Yield (org, repository) pairs for an iterable of orgs, taking one
+        repository from each of up to active orgs in turn. Each org's
+        listing is streamed, and the next org is started as soon as one
+        runs out, so a huge org only ever gets its share of the pairs
+        rather than holding up the orgs behind it.
+
+        An org whose listing fails, because it has been renamed or deleted
+        for instance, is dropped without stopping the others, and added to
+        the list failed if one is given. """
+    orgs = iter(orgs)
+    listings = collections.deque()
+
+    while True:
+        while len(listings) < active:
+            org = next(orgs, None)
+            if org is None:
+                break
+            logger.info("Getting repositories for " + org)
+            listings.append((org, iter_repository_details(org)))
+        if not listings:
+            return
+
+        org, repositories = listings.popleft()
+        try:
+            repository = next(repositories, None)
+        except (GitHubError, requests.RequestException) as e:
+            logger.error("Error listing repositories of " + org + ": "
+                         + str(e))
+            if failed is not None:
+                failed.append(org)
+            continue
+        if repository is not None:
+            yield org, repository
+            listings.append((org, repositories))
+
+
+def preserve_organizations(orgs, dest_org, workers=1,
+                           active=DEFAULT_ACTIVE_ORGS, **kwargs):
+    """ Preserve the repositories of an iterable of orgs, which may be far
+        too long to list up front, scheduling their repositories onto one
+        shared pool of workers with interleave_organizations so that each
+        org being worked on gets a fair share of the pool. Takes the same
+        options as preserve_organization except stream, as listings are
+        always streamed, and returns a map of each org with repositories to
+        their outcomes in listing order, ending with 'failed' for an org
+        whose listing failed. """
+    failed = []
+    results = group_by_org(
+        lambda pairs: preserve_repositories(pairs, dest_org, workers=workers,
+                                            **kwargs),
+        interleave_organizations(orgs, active=active, failed=failed))
+    for org in failed:
+        results.setdefault(org, []).append('failed')
+    return results
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduling of fork syncs by how likely each repository is to have changed,
+so that when a run can only afford to sync some of them, the ones with new
+commits, and the most at risk of being lost, go first.
+
+Each repository's rate of change is estimated from the StateStore's count
+of how often its pushed_at changed between past syncs, and from how
+recently it was last pushed to. That rate puts it in a frequency tier, and
+with the time since its last sync gives its priority: the number of changes
+we expect the fork has missed.
+
+Repositories that have never been synced come first, then those whose
+pushed_at has changed since their last sync. Even unchanged repositories
+are synced again once they have gone a whole period of their tier without
+one, as pushed_at is only a hint; the rest are left out of the run.
+"""
+import calendar
+import collections
+import logging
+import time
+
+from preserve.github import list_repository_details
+from preserve.orgs import group_by_org, preserve_repositories
+
+logger = logging.getLogger()
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# Frequency tiers, from the most active repositories to the least, with the
+# period of each. A repository is in the first tier it is expected to change
+# at least once a period in, and is synced at least once a period.
+TIERS = (
+    ('hot', DAY),
+    ('warm', 7 * DAY),
+    ('cold', 30 * DAY),
+    ('frozen', 365 * DAY),
+)
+
+Priority = collections.namedtuple('Priority', ['score', 'tier', 'reason'])
+
+
+def parse_timestamp(timestamp):
+    """ Convert a GitHub timestamp to seconds since the epoch """
+    if timestamp is None:
+        return None
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def change_rate(repository, activity, now):
+    """ Estimate how many times a second a repository changes, from the
+        changes seen between its past syncs, if it has any, and from how
+        recently it was pushed to """
+    rates = [0.0]
+    if activity is not None:
+        observed = max(now - activity['first_synced_at'], DAY)
+        rates.append(activity['changes'] / observed)
+    pushed_at = parse_timestamp(repository.pushed_at)
+    if pushed_at is not None:
+        rates.append(1.0 / max(now - pushed_at, HOUR))
+    return max(rates)
+
+
+def tier(rate):
+    """ Get the name and period of the frequency tier for a change rate """
+    for name, period in TIERS:
+        if rate * period >= 1:
+            return name, period
+    return TIERS[-1]
+
+
+def prioritize(org, repository, dest_org, state, now):
+    """ Get the Priority of syncing a repository, one from
+        list_repository_details, to its fork in dest_org. Its reason is
+        'new', 'changed' or 'stale' if the repository is due to be synced,
+        or None if it isn't. """
+    activity = state.activity(dest_org, org + "_" + repository.name)
+    if activity is None:
+        return Priority(float('inf'), TIERS[0][0], 'new')
+
+    rate = change_rate(repository, activity, now)
+    name, period = tier(rate)
+    since_sync = now - activity['synced_at']
+    expected = rate * since_sync
+
+    pushed_at = repository.pushed_at
+    if pushed_at is None or pushed_at != activity['pushed_at']:
+        # There is at least the one change we know of
+        return Priority(1 + expected, name, 'changed')
+    if since_sync >= period:
+        return Priority(expected, name, 'stale')
+    return Priority(expected, name, None)
+
+
+def schedule(repositories, dest_org, state, budget=None, clock=time.time):
+    """ Order an iterable of (org, repository) pairs, where each repository
+        is one from list_repository_details, by priority, leaving out those
+        that aren't due and any beyond the first budget of them. Stale
+        repositories that are kept have their recorded pushed_at expired,
+        so that they are synced. """
+    now = clock()
+    due = []
+    for position, (org, repository) in enumerate(repositories):
+        priority = prioritize(org, repository, dest_org, state, now)
+        if priority.reason is not None:
+            due.append((-priority.score, position, org, repository,
+                        priority))
+    due.sort(key=lambda item: item[:2])
+
+    if budget is not None and len(due) > budget:
+        logger.info("Deferring " + str(len(due) - budget)
+                    + " repositories to a later run")
+        due = due[:budget]
+
+    tiers = collections.Counter(item[4].tier for item in due)
+    logger.info("Scheduled " + str(len(due)) + " repositories: " + ', '.join(
+        name + ' ' + str(tiers[name]) for name, _ in TIERS if tiers[name]))
+
+    scheduled = []
+    for _, _, org, repository, priority in due:
+        if priority.reason == 'stale':
+            state.expire(dest_org, org + "_" + repository.name)
+        scheduled.append((org, repository))
+    return scheduled
+
+
+def preserve_by_priority(orgs, dest_org, state, budget=None,
+                         clock=time.time, **kwargs):
+    """ Preserve the repositories of an iterable of orgs that are due, most
+        important first across all of them, syncing at most budget of them.
+        Every org is listed before anything is preserved. Takes the same
+        options as preserve_repositories, and returns a map of each org with
+        scheduled repositories to their outcomes in priority order. """
+    repositories = []
+    for org in orgs:
+        logger.info("Getting repositories for " + org)
+        repositories.extend((org, repository)
+                            for repository in list_repository_details(org))
+
+    scheduled = schedule(repositories, dest_org, state, budget=budget,
+                         clock=clock)
+    return group_by_org(
+        lambda pairs: preserve_repositories(pairs, dest_org, state=state,
+                                            **kwargs),
+        scheduled)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+logger = logging.getLogger()
+
+# Requests held back from pacing so that a run never hits zero
+DEFAULT_RESERVE = 10
+
+# The fraction of the limit below which requests are spread evenly over the
+# time left until the limit resets. Above it requests go out at full speed.
+DEFAULT_PACE_BELOW = 0.5
+
+
+# The resource of GitHub's REST API rate limit, and of its GraphQL API's
+# separate budget of points
+CORE = 'core'
+GRAPHQL = 'graphql'
+
+
+def rate_limit_resource(url):
+    """ Get the rate limit resource a request to a GitHub API URL counts
+        against: GRAPHQL for the GraphQL API and CORE for everything else """
+    if urlsplit(url).path.rstrip('/').endswith('/graphql'):
+        return GRAPHQL
+    return CORE
+
+
+class RateLimitWindow(object):
+    """ The budget of one rate limit resource until its next reset """
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.next_request = 0
+
+
+class RateLimiter(object):
+    """ Schedules requests to stay within GitHub's rate limits.
+
+        The limit, remaining budget and reset time of each resource, such as
+        the REST API's core limit and the GraphQL API's, are tracked from
+        the X-RateLimit headers of every response, and each request is
+        paced by its own resource's budget. While plenty of the budget
+        remains requests are not delayed; once it falls below pace_below of
+        the limit the remaining budget is spread over the time left until
+        the reset, and once only the reserve is left requests wait for the
+        reset instead of failing. Secondary (abuse) limits are honoured by
+        pausing every request for the response's Retry-After. """
+
+    def __init__(self, reserve=DEFAULT_RESERVE, pace_below=DEFAULT_PACE_BELOW,
+                 clock=time.time, sleep=time.sleep):
+        self.reserve = reserve
+        self.pace_below = pace_below
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.next_request = 0
+
+    def window(self, resource):
+        """ Get the window of a resource; the lock must be held """
+        if resource not in self.windows:
+            self.windows[resource] = RateLimitWindow()
+        return self.windows[resource]
+
+    def update(self, response, resource=CORE):
+        """ Track the rate limit headers of a response to a request against
+            resource, unless the response names its own """
+        headers = response.headers
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = int(headers['X-RateLimit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        resource = headers.get('X-RateLimit-Resource', resource)
+
+        with self.lock:
+            window = self.window(resource)
+            # Responses to concurrent requests can arrive out of order, so
+            # within one window keep the lowest remaining count we've seen
+            if window.reset == reset and window.remaining is not None:
+                remaining = min(remaining, window.remaining)
+            elif window.reset is not None and reset < window.reset:
+                return
+            window.limit = limit
+            window.remaining = remaining
+            window.reset = reset
+
+    def delay(self, resource=CORE):
+        """ Reserve a slot for the next request against resource and return
+            how long to wait before making it """
+        with self.lock:
+            window = self.window(resource)
+            now = self.clock()
+            start = max(now, self.next_request, window.next_request)
+            interval = 0
+
+            if window.reset is not None and window.reset <= start:
+                # The window has reset; the next response will tell us the
+                # new budget
+                window.remaining = None
+                window.reset = None
+
+            if window.remaining is not None:
+                if window.remaining <= self.reserve:
+                    start = max(start, window.reset + 1)
+                    window.remaining = None
+                    window.reset = None
+                elif window.remaining < window.limit * self.pace_below:
+                    usable = window.remaining - self.reserve
+                    interval = (window.reset - start) / float(usable)
+                    window.remaining -= 1
+                else:
+                    window.remaining -= 1
+
+            window.next_request = start + interval
+            return start - now
+
+    def wait(self, resource=CORE):
+        """ Block until the next request against resource may be made """
+        delay = self.delay(resource)
+        if delay > 0:
+            logger.debug("Waiting {:.1f}s for the rate limit".format(delay))
+            self.sleep(delay)
+
+    def retry_after(self, response):
+        """ Get how long to wait before retrying a rate limited response, or
+            None if the response wasn't rate limited """
+        if response.status_code not in (403, 429):
+            return None
+
+        headers = response.headers
+        if 'Retry-After' in headers:
+            try:
+                return float(headers['Retry-After'])
+            except ValueError:
+                return None
+
+        if headers.get('X-RateLimit-Remaining') == '0':
+            try:
+                reset = int(headers['X-RateLimit-Reset'])
+            except (KeyError, ValueError):
+                return None
+            return max(reset - self.clock(), 0) + 1
+
+        return None
+
+    def backoff(self, delay, resource=None):
+        """ Hold back the requests against resource for the given number of
+            seconds, or every request if no resource is given """
+        with self.lock:
+            if resource is None:
+                self.next_request = max(self.next_request,
+                                        self.clock() + delay)
+            else:
+                window = self.window(resource)
+                window.next_request = max(window.next_request,
+                                          self.clock() + delay)
+
+    def retry(self, response, resource=CORE):
+        """ Hold back the requests that must wait before a rate limited
+            response to a request against resource is retried, and return
+            how long that is, or None if the response wasn't rate limited.
+            A secondary limit holds back every request, while an exhausted
+            primary limit only holds back its own resource's """
+        delay = self.retry_after(response)
+        if delay is not None:
+            if 'Retry-After' in response.headers:
+                self.backoff(delay)
+            else:
+                self.backoff(delay, response.headers.get(
+                    'X-RateLimit-Resource', resource))
+        return delay
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ An HTTP server that handles each request on its own daemon thread,
+        as http.server.ThreadingHTTPServer does from Python 3.7 """
+    daemon_threads = True
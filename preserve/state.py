@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repositories (
+    fork_owner TEXT NOT NULL,
+    fork_name TEXT NOT NULL,
+    pushed_at TEXT,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (fork_owner, fork_name)
+);
+CREATE TABLE IF NOT EXISTS refs (
+    fork_owner TEXT NOT NULL,
+    fork_name TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    sha TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (fork_owner, fork_name, ref)
+);
+CREATE TABLE IF NOT EXISTS activity (
+    fork_owner TEXT NOT NULL,
+    fork_name TEXT NOT NULL,
+    first_synced_at REAL NOT NULL,
+    changes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (fork_owner, fork_name)
+);
+"""
+
+
+class StateStore(object):
+    """ A local SQLite record of the forks that have been synced, so that
+        a run can tell which repositories haven't changed since the last
+        one, and of the SHA each fork ref was last set to, so that forks can
+        be updated without listing their refs. How often each upstream's
+        pushed_at has changed is kept too, for scheduling syncs by
+        activity. Safe to share between threads. """
+
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def pushed_at(self, fork_owner, fork_name):
+        """ Get the upstream pushed_at of a fork's last successful sync """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT pushed_at FROM repositories '
+                'WHERE fork_owner = ? AND fork_name = ?',
+                (fork_owner, fork_name)).fetchone()
+        return None if row is None else row[0]
+
+    def record_sync(self, fork_owner, fork_name, pushed_at):
+        """ Record a successful sync of a fork with its upstream as of the
+            upstream's pushed_at, counting a change if it differs from the
+            pushed_at of the last sync """
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT pushed_at FROM repositories '
+                'WHERE fork_owner = ? AND fork_name = ?',
+                (fork_owner, fork_name)).fetchone()
+            changed = (row is not None and row[0] is not None
+                       and pushed_at is not None and row[0] != pushed_at)
+            self.connection.execute(
+                'INSERT OR IGNORE INTO activity '
+                '(fork_owner, fork_name, first_synced_at) VALUES (?, ?, ?)',
+                (fork_owner, fork_name, now))
+            if changed:
+                self.connection.execute(
+                    'UPDATE activity SET changes = changes + 1 '
+                    'WHERE fork_owner = ? AND fork_name = ?',
+                    (fork_owner, fork_name))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO repositories '
+                '(fork_owner, fork_name, pushed_at, synced_at) '
+                'VALUES (?, ?, ?, ?)',
+                (fork_owner, fork_name, pushed_at, now))
+
+    def activity(self, fork_owner, fork_name):
+        """ Get a dict of a fork's last synced pushed_at, the time of its
+            last and first syncs, and the number of times the upstream had
+            changed between syncs, or None if it has never been synced """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT r.pushed_at, r.synced_at, a.first_synced_at, '
+                'a.changes FROM repositories r LEFT JOIN activity a '
+                'ON a.fork_owner = r.fork_owner AND a.fork_name = r.fork_name '
+                'WHERE r.fork_owner = ? AND r.fork_name = ?',
+                (fork_owner, fork_name)).fetchone()
+        if row is None:
+            return None
+        pushed_at, synced_at, first_synced_at, changes = row
+        # Forks synced before activity was recorded
+        if first_synced_at is None:
+            first_synced_at, changes = synced_at, 0
+        return {'pushed_at': pushed_at, 'synced_at': synced_at,
+                'first_synced_at': first_synced_at, 'changes': changes}
+
+    def expire(self, fork_owner, fork_name):
+        """ Forget the pushed_at of a fork's last sync, so that it is synced
+            again even if its upstream hasn't been pushed to """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE repositories SET pushed_at = NULL '
+                'WHERE fork_owner = ? AND fork_name = ?',
+                (fork_owner, fork_name))
+
+    def refs(self, fork_owner, fork_name):
+        """ Get a map of a fork's ref names to the SHAs we last set them to,
+            or None if we have no record of the fork's refs """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT ref, sha FROM refs '
+                'WHERE fork_owner = ? AND fork_name = ?',
+                (fork_owner, fork_name)).fetchall()
+        if not rows:
+            return None
+        return dict(rows)
+
+    def record_ref(self, fork_owner, fork_name, ref, sha):
+        """ Record that a fork ref was set to a SHA """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO refs '
+                '(fork_owner, fork_name, ref, sha, synced_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (fork_owner, fork_name, ref, sha, time.time()))
+
+    def replace_refs(self, fork_owner, fork_name, refs):
+        """ Replace the record of a fork's refs with the given map of ref
+            names to SHAs, as read from GitHub """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM refs WHERE fork_owner = ? AND fork_name = ?',
+                (fork_owner, fork_name))
+            self.connection.executemany(
+                'INSERT INTO refs '
+                '(fork_owner, fork_name, ref, sha, synced_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(fork_owner, fork_name, ref, sha, now)
+                 for ref, sha in refs.items()])
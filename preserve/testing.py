@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""
+A fake GitHub API, served locally over HTTP, for testing and benchmarking
+preserve end to end without touching GitHub.
+
+It covers the parts of the API that preserve uses: listing repositories
+with Link header pagination, repository lookups, asynchronous forks,
+renames, branches, git refs, the GraphQL refs query, org event feeds and
+the rate limit, with conditional requests, rate limit headers and
+configurable latency and error rates.
+"""
+import collections
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qsl, urlencode
+
+from preserve.server import ThreadingHTTPServer
+
+DEFAULT_PER_PAGE = 30
+MAX_PER_PAGE = 100
+DEFAULT_RATE_LIMIT = 5000
+RATE_LIMIT_WINDOW = 3600
+
+# GitHub keeps an org's most recent 300 events, and asks for its event feeds
+# to be polled no more often than once a minute
+MAX_EVENTS = 300
+EVENTS_POLL_INTERVAL = 60
+
+OWNER = r'/repos/(?P<owner>[^/]+)/(?P<repo>[^/]+)'
+ROUTES = [
+    ('GET', r'/rate_limit', 'get_rate_limit'),
+    ('GET', r'/(?:orgs|users)/(?P<owner>[^/]+)/repos', 'list_repositories'),
+    ('GET', r'/orgs/(?P<owner>[^/]+)/events', 'list_events'),
+    ('GET', OWNER, 'get_repository'),
+    ('POST', OWNER, 'edit_repository'),
+    ('POST', OWNER + r'/forks', 'create_fork'),
+    ('GET', OWNER + r'/commits', 'list_commits'),
+    ('GET', OWNER + r'/branches', 'list_branches'),
+    ('GET', OWNER + r'/git/refs', 'list_refs'),
+    ('GET', OWNER + r'/git/matching-refs/(?P<prefix>.*)', 'list_refs'),
+    ('GET', OWNER + r'/git/ref/(?P<ref>.+)', 'get_ref'),
+    ('POST', OWNER + r'/git/refs', 'create_ref'),
+    ('PATCH', OWNER + r'/git/refs/(?P<ref>.+)', 'update_ref'),
+    ('POST', r'/graphql', 'graphql'),
+]
+ROUTES = [(method, re.compile(pattern + '$'), name)
+          for method, pattern, name in ROUTES]
+
+# Matches the repository fragments of preserve's GraphQL refs query
+GRAPHQL_REPOSITORY = re.compile(
+    r'(?P<alias>\w+): repository\(owner: (?P<owner>"(?:[^"\\]|\\.)*"), '
+    r'name: (?P<name>"(?:[^"\\]|\\.)*")\) \{ '
+    r'refs\(refPrefix: (?P<prefix>"[^"]*"), first: (?P<first>\d+)'
+    r'(?:, after: (?P<after>"(?:[^"\\]|\\.)*"))?\)')
+
+
+class FakeGitHub(object):
+    """ The state of a fake GitHub and the logic of its API, independent of
+        HTTP. Repositories are added with add_repository; every request
+        handled is counted in requests by method and route name. Changes
+        made with add_repository, push and delete_ref show up in the
+        owner's event feed.
+
+        Each request is delayed by latency seconds, and fails with a 502
+        with probability error_rate. New forks can't be read until
+        fork_delay seconds after they are created. Requests are counted
+        against a rate limit of rate_limit per hour, as GitHub does;
+        conditional requests that return 304 are free. """
+
+    def __init__(self, latency=0.0, error_rate=0.0, fork_delay=0.0,
+                 rate_limit=DEFAULT_RATE_LIMIT, seed=0, clock=time.time,
+                 sleep=time.sleep):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fork_delay = fork_delay
+        self.rate_limit = rate_limit
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.repositories = collections.OrderedDict()
+        self.requests = collections.Counter()
+        self.events = collections.deque(maxlen=MAX_EVENTS)
+        self.event_ids = itertools.count(1)
+        self.remaining = rate_limit
+        self.reset = clock() + RATE_LIMIT_WINDOW
+
+    def add_repository(self, owner, name, branches=None, tags=None,
+                       fork=False, pushed_at='2017-01-01T00:00:00Z'):
+        """ Add a repository, with maps of branch and tag names to SHAs """
+        refs = collections.OrderedDict()
+        for branch, sha in (branches or {}).items():
+            refs['refs/heads/' + branch] = sha
+        for tag, sha in (tags or {}).items():
+            refs['refs/tags/' + tag] = sha
+
+        with self.lock:
+            self.repositories[(owner, name)] = {
+                'owner': owner,
+                'name': name,
+                'fork': fork,
+                'pushed_at': pushed_at,
+                'updated_at': pushed_at,
+                'refs': refs,
+                'ready_at': 0,
+            }
+            self.add_event(owner, name, 'CreateEvent',
+                           {'ref': None, 'ref_type': 'repository'})
+
+    def push(self, owner, name, ref, sha):
+        """ Point a full ref name at a SHA, as a push would """
+        with self.lock:
+            refs = self.repository(owner, name)['refs']
+            if ref not in refs:
+                self.add_event(owner, name, 'CreateEvent', {
+                    'ref': ref.split('/', 2)[2],
+                    'ref_type': 'branch' if ref.startswith('refs/heads/')
+                    else 'tag'})
+            refs[ref] = sha
+            self.add_event(owner, name, 'PushEvent', {'ref': ref, 'head': sha})
+
+    def delete_ref(self, owner, name, ref):
+        """ Delete a full ref name, as pushing its deletion would """
+        with self.lock:
+            del self.repository(owner, name)['refs'][ref]
+            self.add_event(owner, name, 'DeleteEvent', {
+                'ref': ref.split('/', 2)[2],
+                'ref_type': 'branch' if ref.startswith('refs/heads/')
+                else 'tag'})
+
+    def add_event(self, owner, name, event_type, payload):
+        self.events.appendleft({
+            'id': str(next(self.event_ids)),
+            'type': event_type,
+            'repo': {'name': owner + '/' + name},
+            'payload': payload,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                        time.gmtime(self.clock())),
+        })
+
+    def repository(self, owner, name):
+        """ Get a repository's state, or None if it doesn't exist """
+        return self.repositories.get((owner, name))
+
+    def branches(self, owner, name):
+        """ Get a map of a repository's branch names to SHAs """
+        return {ref[len('refs/heads/'):]: sha
+                for ref, sha in self.repository(owner, name)['refs'].items()
+                if ref.startswith('refs/heads/')}
+
+    def tags(self, owner, name):
+        """ Get a map of a repository's tag names to SHAs """
+        return {ref[len('refs/tags/'):]: sha
+                for ref, sha in self.repository(owner, name)['refs'].items()
+                if ref.startswith('refs/tags/')}
+
+    @property
+    def request_count(self):
+        return sum(self.requests.values())
+
+    def handle(self, method, url, headers, body):
+        """ Handle a request, returning a status code, a dict of headers and
+            the body as JSON-serializable data """
+        path, _, query = url.partition('?')
+        query = dict(parse_qsl(query))
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match is not None:
+                break
+        else:
+            name, match = None, None
+
+        with self.lock:
+            self.requests[(method, name)] += 1
+            error = self.random.random() < self.error_rate
+        if self.latency:
+            self.sleep(self.latency)
+
+        if error:
+            return 502, {}, {'message': 'Server Error'}
+        if name != 'get_rate_limit':
+            limited = self.count_request()
+            if limited is not None:
+                return limited
+        if name is None:
+            return 404, {}, {'message': 'Not Found'}
+
+        try:
+            data = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            return 400, {}, {'message': 'Problems parsing JSON'}
+
+        with self.lock:
+            return getattr(self, name)(query=query, data=data,
+                                       **match.groupdict())
+
+    def count_request(self):
+        """ Count a request against the rate limit, returning the response
+            for a rate limited request if it has been used up """
+        with self.lock:
+            now = self.clock()
+            if now >= self.reset:
+                self.remaining = self.rate_limit
+                self.reset = now + RATE_LIMIT_WINDOW
+            if self.remaining <= 0:
+                return 403, {}, {'message': 'API rate limit exceeded'}
+            self.remaining -= 1
+
+    def rate_limit_headers(self):
+        return {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': str(int(self.reset)),
+        }
+
+    def refund(self):
+        """ Give back a request that turned out to be free """
+        with self.lock:
+            self.remaining = min(self.remaining + 1, self.rate_limit)
+
+    def repository_json(self, repository):
+        return {
+            'name': repository['name'],
+            'full_name': repository['owner'] + '/' + repository['name'],
+            'fork': repository['fork'],
+            'pushed_at': repository['pushed_at'],
+            'updated_at': repository['updated_at'],
+        }
+
+    def not_ready(self, repository):
+        return self.clock() < repository['ready_at']
+
+    def get_rate_limit(self, query, data):
+        resources = {'limit': self.rate_limit, 'remaining': self.remaining,
+                     'reset': int(self.reset)}
+        return 200, {}, {'resources': {'core': resources}, 'rate': resources}
+
+    def list_repositories(self, query, data, owner):
+        status, headers, page = paginate(
+            [r for r in self.repositories.values() if r['owner'] == owner],
+            query)
+        return status, headers, [self.repository_json(r) for r in page]
+
+    def list_events(self, query, data, owner):
+        status, headers, page = paginate(
+            [e for e in self.events
+             if e['repo']['name'].split('/')[0] == owner], query)
+        headers['X-Poll-Interval'] = str(EVENTS_POLL_INTERVAL)
+        return status, headers, page
+
+    def get_repository(self, query, data, owner, repo):
+        repository = self.repository(owner, repo)
+        if repository is None:
+            return 404, {}, {'message': 'Not Found'}
+        return 200, {}, self.repository_json(repository)
+
+    def edit_repository(self, query, data, owner, repo):
+        repository = self.repository(owner, repo)
+        if repository is None:
+            return 404, {}, {'message': 'Not Found'}
+        new_name = data.get('name', repo)
+        if new_name != repo:
+            if self.repository(owner, new_name) is not None:
+                return 422, {}, {'message':
+                                 'name already exists on this account'}
+            del self.repositories[(owner, repo)]
+            repository['name'] = new_name
+            self.repositories[(owner, new_name)] = repository
+        return 200, {}, self.repository_json(repository)
+
+    def create_fork(self, query, data, owner, repo):
+        repository = self.repository(owner, repo)
+        if repository is None:
+            return 404, {}, {'message': 'Not Found'}
+        destination = query.get('org') or data.get('organization')
+        if destination is None:
+            return 422, {}, {'message': 'An organization is required'}
+
+        # An existing fork is returned under whatever name it has, and a
+        # new one whose name is taken gets a numbered suffix, as on GitHub
+        for fork in self.repositories.values():
+            if (fork['owner'] == destination
+                    and fork.get('parent') == (owner, repo)):
+                return 202, {}, self.repository_json(fork)
+        name = data.get('name') or repo
+        suffix = itertools.count(1)
+        while self.repository(destination, name) is not None:
+            name = (data.get('name') or repo) + '-' + str(next(suffix))
+
+        fork = dict(repository, owner=destination, name=name, fork=True,
+                    parent=(owner, repo),
+                    refs=collections.OrderedDict(repository['refs']),
+                    ready_at=self.clock() + self.fork_delay)
+        self.repositories[(destination, name)] = fork
+        return 202, {}, self.repository_json(fork)
+
+    def list_commits(self, query, data, owner, repo):
+        repository = self.repository(owner, repo)
+        if repository is None:
+            return 404, {}, {'message': 'Not Found'}
+        if self.not_ready(repository):
+            return 409, {}, {'message': 'Git Repository is empty.'}
+        commits = [{'sha': sha} for sha in repository['refs'].values()]
+        return paginate(commits, query)
+
+    def list_branches(self, query, data, owner, repo):
+        repository = self.repository(owner, repo)
+        if repository is None:
+            return 404, {}, {'message': 'Not Found'}
+        if self.not_ready(repository):
+            return 409, {}, {'message': 'Git Repository is empty.'}
+        branches = [{'name': branch, 'commit': {'sha': sha}}
+                    for branch, sha in self.branches(owner, repo).items()]
+        return paginate(branches, query)
+
+    def list_refs(self, query, data, owner, repo, prefix=''):
+        repository = self.repository(owner, repo)
+        if repository is None:
+            return 404, {}, {'message': 'Not Found'}
+        if self.not_ready(repository):
+            return 409, {}, {'message': 'Git Repository is empty.'}
+        refs = [{'ref': ref, 'object': {'sha': sha, 'type': 'commit'}}
+                for ref, sha in repository['refs'].items()
+                if ref.startswith('refs/' + prefix)]
+        return paginate(refs, query)
+
+    def get_ref(self, query, data, owner, repo, ref):
+        repository = self.repository(owner, repo)
+        if repository is None:
+            return 404, {}, {'message': 'Not Found'}
+        if self.not_ready(repository):
+            return 409, {}, {'message': 'Git Repository is empty.'}
+        ref = 'refs/' + ref
+        if ref not in repository['refs']:
+            return 404, {}, {'message': 'Not Found'}
+        return 200, {}, {'ref': ref, 'object': {
+            'sha': repository['refs'][ref], 'type': 'commit'}}
+
+    def create_ref(self, query, data, owner, repo):
+        repository = self.repository(owner, repo)
+        if repository is None:
+            return 404, {}, {'message': 'Not Found'}
+        ref, sha = data.get('ref'), data.get('sha')
+        if not ref or not sha:
+            return 422, {}, {'message': 'Invalid request. "ref" and "sha" '
+                                        'are required.'}
+        if ref in repository['refs']:
+            return 422, {}, {'message': 'Reference already exists'}
+        repository['refs'][ref] = sha
+        return 201, {}, {'ref': ref, 'object': {'sha': sha}}
+
+    def update_ref(self, query, data, owner, repo, ref):
+        repository = self.repository(owner, repo)
+        if repository is None:
+            return 404, {}, {'message': 'Not Found'}
+        ref = 'refs/' + ref
+        if ref not in repository['refs']:
+            return 422, {}, {'message': 'Reference does not exist'}
+        if not data.get('sha'):
+            return 422, {}, {'message': 'Invalid request. "sha" is required.'}
+        repository['refs'][ref] = data['sha']
+        return 200, {}, {'ref': ref, 'object': {'sha': data['sha']}}
+
+    def graphql(self, query, data):
+        results = {}
+        for match in GRAPHQL_REPOSITORY.finditer(data.get('query', '')):
+            owner = json.loads(match.group('owner'))
+            name = json.loads(match.group('name'))
+            repository = self.repository(owner, name)
+            if repository is None or self.not_ready(repository):
+                results[match.group('alias')] = None
+                continue
+
+            prefix = json.loads(match.group('prefix'))
+            refs = [(ref[len(prefix):], sha)
+                    for ref, sha in repository['refs'].items()
+                    if ref.startswith(prefix)]
+            start = 0
+            if match.group('after') is not None:
+                start = int(json.loads(match.group('after')))
+            end = start + int(match.group('first'))
+            results[match.group('alias')] = {'refs': {
+                'pageInfo': {'hasNextPage': end < len(refs),
+                             'endCursor': str(end)},
+                'nodes': [{'name': ref, 'target': {'oid': sha}}
+                          for ref, sha in refs[start:end]],
+            }}
+        return 200, {}, {'data': results}
+
+
+def paginate(results, query):
+    """ Return a page of results as GitHub does, with the links to the other
+        pages in a Link header """
+    per_page = min(int(query.get('per_page', DEFAULT_PER_PAGE)),
+                   MAX_PER_PAGE)
+    page = int(query.get('page', 1))
+    last_page = max((len(results) + per_page - 1) // per_page, 1)
+
+    links = collections.OrderedDict()
+    if page < last_page:
+        links['next'] = page + 1
+        links['last'] = last_page
+    if page > 1:
+        links['first'] = 1
+        links['prev'] = page - 1
+
+    headers = {}
+    if links:
+        headers['Link'] = links
+    start = (page - 1) * per_page
+    return 200, headers, results[start:start + per_page]
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        github = self.server.github
+        status, headers, data = github.handle(self.command, self.path,
+                                              self.headers, body)
+
+        content = json.dumps(data).encode('utf-8')
+        if 'Link' in headers:
+            headers['Link'] = self.link_header(headers['Link'])
+        if status == 200 and self.command == 'GET':
+            etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                github.refund()
+                status, content = 304, b''
+        headers.update(github.rate_limit_headers())
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def link_header(self, pages):
+        """ Build a Link header from a map of relations to page numbers """
+        path, _, query = self.path.partition('?')
+        parameters = [(k, v) for k, v in parse_qsl(query) if k != 'page']
+        base = 'http://' + self.headers['Host'] + path
+        return ', '.join(
+            '<' + base + '?' + urlencode(parameters + [('page', page)])
+            + '>; rel="' + rel + '"' for rel, page in pages.items())
+
+    do_GET = do_POST = do_PATCH = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGitHubServer(object):
+    """ Serves a FakeGitHub on a local port from a background thread. Use
+        it as a context manager; url is the base URL of the API, to be used
+        in place of preserve.github.GITHUB_API_URL. """
+
+    def __init__(self, github=None, host='127.0.0.1', port=0):
+        self.github = github if github is not None else FakeGitHub()
+        self.server = ThreadingHTTPServer((host, port), FakeGitHubHandler)
+        self.server.github = self.github
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05},
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
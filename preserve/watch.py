@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+A daemon that keeps forks up to date from the event feeds of the orgs they
+are forked from, instead of sweeping every repository of every org.
+
+Each round, the feed at /orgs/{org}/events is polled with the ETag of the
+last poll, so a feed that hasn't changed costs a free 304. The push, create
+and delete events that are new since the last poll name the repositories
+and refs that changed, and only those refs are synced, with update_fork.
+New repositories are forked with preserve_repository.
+
+GitHub only keeps an org's most recent 300 events. When the new events run
+past the end of the feed, some may have been missed, so the org is swept
+with preserve_organization instead. The first round is always a sweep, as
+is the round after one that failed.
+"""
+import collections
+import logging
+import time
+
+import requests
+
+from preserve import github
+from preserve.github import (
+    GitHubError,
+    Repository,
+    set_query_parameter,
+    update_fork,
+)
+from preserve.orgs import (
+    DEFAULT_BUFFER_PER_WORKER,
+    map_bounded,
+    preserve_organization,
+    preserve_repository,
+)
+
+logger = logging.getLogger()
+
+# Seconds between polls of each feed, unless GitHub asks for longer
+DEFAULT_POLL_INTERVAL = 60
+
+# The namespace of the refs named by create and delete events
+REF_TYPES = {'branch': 'refs/heads/', 'tag': 'refs/tags/'}
+
+
+class EventFeed(object):
+    """ The event feed of an org, remembering the newest event and the ETag
+        of the last poll """
+
+    def __init__(self, org):
+        self.org = org
+        self.etag = None
+        self.last_id = None
+        self.poll_interval = None
+
+    def reset(self):
+        """ Forget the last poll, so the next is treated as having gaps """
+        self.etag = None
+        self.last_id = None
+
+    def poll(self):
+        """ Get the events since the last poll, newest first, and whether
+            they are complete. They aren't on the first poll, or if there
+            are more new events than the feed keeps. """
+        events_url = set_query_parameter(
+            '/'.join([github.GITHUB_API_URL, 'orgs', self.org, 'events']),
+            'per_page', github.DEFAULT_PER_PAGE)
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        response = github.client.get(events_url, headers=headers)
+        if response.status_code == 304:
+            return [], True
+        if response.status_code != 200:
+            raise GitHubError(response.json()['message'])
+
+        etag = response.headers.get('ETag')
+        if 'X-Poll-Interval' in response.headers:
+            self.poll_interval = int(response.headers['X-Poll-Interval'])
+
+        complete = self.last_id is not None
+        events = [] if complete else response.json()
+        while complete:
+            page = response.json()
+            new = [event for event in page
+                   if int(event['id']) > self.last_id]
+            events.extend(new)
+            if len(new) < len(page) or not page:
+                break
+
+            # Every event on the page is new, so keep paging back to the
+            # last one we saw
+            if 'next' not in response.links:
+                complete = False
+                break
+            response = github.client.get(response.links['next']['url'])
+            if response.status_code != 200:
+                raise GitHubError(response.json()['message'])
+
+        if events:
+            self.last_id = max(int(event['id']) for event in events)
+        self.etag = etag
+        return events, complete
+
+
+def repository_changes(org, events):
+    """ Get a map of the names of an org's repositories that events show
+        have changed to the set of full ref names that were pushed to or
+        created, or to None if the repository itself was created.
+        Repositories are in the order they first changed. """
+    changes = collections.OrderedDict()
+    for event in reversed(events):
+        owner, _, repo = event['repo']['name'].partition('/')
+        if owner != org:
+            continue
+        payload = event['payload']
+
+        if event['type'] == 'PushEvent':
+            ref = payload['ref']
+        elif (event['type'] in ('CreateEvent', 'DeleteEvent')
+                and payload['ref_type'] in REF_TYPES):
+            ref = REF_TYPES[payload['ref_type']] + payload['ref']
+        elif (event['type'] == 'CreateEvent'
+                and payload['ref_type'] == 'repository'):
+            changes[repo] = None
+            continue
+        else:
+            continue
+
+        if event['type'] == 'DeleteEvent':
+            # The fork keeps deleted refs, that's the point of it
+            logger.debug("Keeping " + ref + " of " + org + '/' + repo
+                         + ", deleted upstream")
+            continue
+        refs = changes.setdefault(repo, set())
+        if refs is not None:
+            refs.add(ref)
+    return changes
+
+
+def update_repository(org, repo, dest_org, refs=None, state=None,
+                      index=None):
+    """ Sync the given full ref names of a repository's fork in dest_org, or
+        preserve the whole repository if refs is None. A targeted update
+        that fails, because the fork doesn't exist yet for instance, falls
+        back to preserving the whole repository. The state and index are
+        passed on to update_fork and preserve_repository. """
+    repository = Repository(repo)
+    if refs is not None:
+        fork_name = org + "_" + repo
+        logger.info("\tUpdating " + ', '.join(sorted(refs)) + " of fork "
+                    + fork_name)
+        try:
+            update_fork(org, repo, dest_org, fork_name, state=state,
+                        refs=refs)
+            return 'updated'
+        except GitHubError as e:
+            logger.warning("\tError updating fork " + fork_name + ": "
+                           + str(e) + ", preserving it instead")
+
+    return preserve_repository(org, repository, dest_org, state=state,
+                               index=index)
+
+
+class Watcher(object):
+    """ Polls the event feeds of orgs, and updates their forks in dest_org
+        from the changes in them. Each round of polls is started with run,
+        which yields a map of each org to the outcomes of its round.
+
+        Up to workers repositories are updated at once. The state and index
+        arguments are passed on to preserve_organization and
+        preserve_repository, and the state to update_fork. """
+
+    def __init__(self, orgs, dest_org, workers=1, state=None, index=None,
+                 interval=DEFAULT_POLL_INTERVAL, clock=time.time,
+                 sleep=time.sleep):
+        self.feeds = collections.OrderedDict(
+            (org, EventFeed(org)) for org in orgs)
+        self.dest_org = dest_org
+        self.workers = workers
+        self.state = state
+        self.index = index
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+
+    def run(self, rounds=None):
+        """ Poll every feed once a round, forever or for the given number of
+            rounds, waiting at least interval seconds, or as long as GitHub
+            asks, between the start of each round """
+        count = 0
+        started = None
+        while rounds is None or count < rounds:
+            if started is not None:
+                self.sleep(max(started + self.wait() - self.clock(), 0))
+            started = self.clock()
+            yield self.poll()
+            count += 1
+
+    def wait(self):
+        return max([self.interval] + [
+            feed.poll_interval for feed in self.feeds.values()
+            if feed.poll_interval is not None])
+
+    def poll(self):
+        """ Poll every feed and act on its changes. An org whose round
+            fails is swept in the next round. """
+        results = collections.OrderedDict()
+        for org, feed in self.feeds.items():
+            try:
+                results[org] = self.poll_feed(feed)
+            except (GitHubError, requests.RequestException) as e:
+                logger.error("Error watching " + org + ": " + str(e))
+                feed.reset()
+        return results
+
+    def poll_feed(self, feed):
+        """ Act on the new events of a feed, returning the outcomes """
+        events, complete = feed.poll()
+        if not complete:
+            logger.info("Events of " + feed.org + " may have gaps, "
+                        "sweeping the org")
+            return preserve_organization(feed.org, self.dest_org,
+                                         workers=self.workers,
+                                         state=self.state, index=self.index)
+
+        changes = repository_changes(feed.org, events)
+        if not changes:
+            return []
+        logger.info(str(len(changes)) + " repositories of " + feed.org
+                    + " have changed")
+
+        def update(item):
+            repo, refs = item
+            return update_repository(feed.org, repo, self.dest_org, refs,
+                                     state=self.state, index=self.index)
+
+        if self.workers <= 1:
+            return [update(item) for item in changes.items()]
+        return list(map_bounded(update, changes.items(), self.workers,
+                                self.workers * DEFAULT_BUFFER_PER_WORKER))
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+A small HTTP server that receives GitHub webhooks from the orgs being
+preserved and updates their forks as soon as they are pushed to, without
+polling anything.
+
+Deliveries must be signed with the webhook's secret in the
+X-Hub-Signature-256 header; any that aren't are refused. push and create
+events sync the ref they name with update_fork, and repository events for
+new or newly public repositories preserve the whole repository.
+
+A push often comes in a burst of deliveries, one per ref. The changes to a
+repository are held for delay seconds after the first of them arrives, and
+made together, and a repository is never updated by two workers at once.
+"""
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+from preserve.server import ThreadingHTTPServer
+from preserve.watch import REF_TYPES, update_repository
+
+logger = logging.getLogger()
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+
+# Seconds to collect a burst of deliveries for a repository before acting
+DEFAULT_DELAY = 5
+
+# The actions of repository events that leave a public repository to fork
+REPOSITORY_ACTIONS = ('created', 'publicized', 'renamed', 'transferred',
+                      'unarchived')
+
+
+def signature(secret, body):
+    """ The X-Hub-Signature-256 of a delivery's body """
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), body,
+                                hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret, body, header):
+    """ Check an X-Hub-Signature-256 header, which may be None """
+    if header is None:
+        return False
+    return hmac.compare_digest(signature(secret, body), header)
+
+
+def payload_changes(event, payload):
+    """ Get the org, repository name and the set of full ref names changed
+        by a webhook delivery, with None for the refs if the whole
+        repository should be preserved, or None if there is nothing to do """
+    if 'repository' not in payload:
+        return None
+    org = payload['repository']['owner']['login']
+    repo = payload['repository']['name']
+
+    if event == 'push':
+        if payload.get('deleted'):
+            # The fork keeps deleted refs
+            return None
+        return org, repo, {payload['ref']}
+    if event == 'create' and payload.get('ref_type') in REF_TYPES:
+        return org, repo, {REF_TYPES[payload['ref_type']] + payload['ref']}
+    if event == 'repository' and payload.get('action') in REPOSITORY_ACTIONS:
+        if payload['repository'].get('private'):
+            return None
+        return org, repo, None
+    return None
+
+
+class UpdateQueue(object):
+    """ Coalesces the changes to repositories and makes them with
+        update_repository on a pool of worker threads.
+
+        Changes added for a repository within delay seconds of the first
+        are merged, and the repository is updated once that delay is up.
+        Changes added while a repository is being updated are made after
+        it finishes. Call start to start the workers, and stop to make any
+        changes that are left and stop them. """
+
+    def __init__(self, dest_org, delay=DEFAULT_DELAY, workers=1, state=None,
+                 index=None, clock=time.time):
+        self.dest_org = dest_org
+        self.delay = delay
+        self.workers = workers
+        self.state = state
+        self.index = index
+        self.clock = clock
+
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.due = {}
+        self.running = set()
+        self.stopping = False
+        self.threads = []
+
+    def add(self, org, repo, refs):
+        """ Queue an update of a set of full ref names of a repository, or
+            of the whole repository if refs is None """
+        key = (org, repo)
+        with self.condition:
+            if key not in self.pending:
+                self.pending[key] = None if refs is None else set(refs)
+                self.due[key] = self.clock() + self.delay
+            elif refs is None or self.pending[key] is None:
+                self.pending[key] = None
+            else:
+                self.pending[key].update(refs)
+            self.condition.notify_all()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def join(self):
+        """ Wait until every queued change has been made """
+        with self.condition:
+            while self.pending or self.running:
+                self.condition.wait()
+
+    def next(self):
+        """ Wait for a repository that is due and not being updated, and
+            take it and its changes. Returns None once stopped with nothing
+            left to do. """
+        with self.condition:
+            while True:
+                now = self.clock()
+                wait = None
+                for key, due in self.due.items():
+                    if key in self.running:
+                        continue
+                    if self.stopping or due <= now:
+                        del self.due[key]
+                        self.running.add(key)
+                        return key, self.pending.pop(key)
+                    wait = due - now if wait is None else min(wait, due - now)
+                if self.stopping and not self.pending:
+                    return None
+                self.condition.wait(wait)
+
+    def work(self):
+        while True:
+            item = self.next()
+            if item is None:
+                return
+            (org, repo), refs = item
+            try:
+                update_repository(org, repo, self.dest_org, refs,
+                                  state=self.state, index=self.index)
+            except Exception as e:
+                # Keep the worker going, whatever went wrong
+                logger.error("\tError updating " + org + '/' + repo + ": "
+                             + str(e))
+            finally:
+                with self.condition:
+                    self.running.discard((org, repo))
+                    self.condition.notify_all()
+
+
+class WebhookReceiver(object):
+    """ The logic of the webhook endpoint, independent of HTTP. Deliveries
+        signed with secret, for repositories of one of orgs or of any org
+        if orgs is None, are added to an UpdateQueue. """
+
+    def __init__(self, queue, secret, orgs=None):
+        self.queue = queue
+        self.secret = secret
+        self.orgs = None if orgs is None else set(orgs)
+
+    def receive(self, event, signature_header, body):
+        """ Handle a delivery, returning a status code and a message """
+        if not verify_signature(self.secret, body, signature_header):
+            logger.warning("Refusing a " + str(event)
+                           + " delivery with a bad signature")
+            return 401, 'Bad signature'
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return 400, 'Problems parsing JSON'
+
+        if event == 'ping':
+            return 200, 'pong'
+        changes = payload_changes(event, payload)
+        if changes is None:
+            return 200, 'Ignored'
+        org, repo, refs = changes
+        if org == self.queue.dest_org or (self.orgs is not None
+                                          and org not in self.orgs):
+            return 200, 'Ignored'
+
+        logger.info("Received " + event + " of " + org + '/' + repo)
+        self.queue.add(org, repo, refs)
+        return 202, 'Queued'
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, message = self.server.receiver.receive(
+            self.headers.get('X-GitHub-Event'),
+            self.headers.get('X-Hub-Signature-256'), body)
+
+        content = json.dumps({'message': message}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class WebhookServer(object):
+    """ Serves a WebhookReceiver, and runs its UpdateQueue. Use serve_forever
+        to run it in the foreground, or start and stop to run it on a
+        background thread. """
+
+    def __init__(self, receiver, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.receiver = receiver
+        self.server = ThreadingHTTPServer((host, port), WebhookHandler)
+        self.server.receiver = receiver
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def serve_forever(self):
+        self.receiver.queue.start()
+        logger.info("Receiving webhooks at " + self.url)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.receiver.queue.stop()
+
+    def start(self):
+        self.receiver.queue.start()
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05},
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.receiver.queue.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+A durable queue of repositories to preserve, for sharding a sweep across
+any number of worker processes, on one host or on several sharing the
+queue's file.
+
+A coordinator lists orgs into the queue with enqueue_organizations, and
+workers lease repositories from it with run_worker. A lease expires if its
+worker doesn't finish or extend it within the visibility timeout, so the
+repositories of a worker that dies are picked up again by the others.
+
+The queue is a SQLite database. SQLite's locking is only reliable on a
+local filesystem, so workers on other hosts should share it over a
+filesystem that supports it properly, or be given a queue per host.
+"""
+import collections
+import contextlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from preserve.github import (
+    DestinationIndex,
+    Repository,
+    list_repository_details,
+)
+from preserve.orgs import preserve_repository
+
+logger = logging.getLogger()
+
+# Seconds a leased task is hidden from other workers
+DEFAULT_VISIBILITY_TIMEOUT = 300
+
+# Times a task is tried before it is marked as failed
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Seconds an idle worker waits before looking for work again
+DEFAULT_POLL_INTERVAL = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    org TEXT NOT NULL,
+    name TEXT NOT NULL,
+    dest_org TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    lease TEXT,
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    outcome TEXT,
+    error TEXT,
+    UNIQUE (org, name, dest_org)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires);
+"""
+
+Task = collections.namedtuple(
+    'Task', ['id', 'org', 'repository', 'dest_org', 'lease', 'attempts'])
+
+
+def default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """ A SQLite queue of repositories to preserve. Each task is a
+        Repository, as returned by list_repository_details, to be
+        preserved in a destination org. Tasks are 'pending' until leased,
+        'leased' until completed or their lease expires, and then 'done', or
+        'failed' once they have failed max_attempts times. Safe to share
+        between threads and processes. """
+
+    def __init__(self, path, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, clock=time.time):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60,
+                                          isolation_level=None,
+                                          check_same_thread=False)
+        with self.lock:
+            if path != ':memory:':
+                self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    @contextlib.contextmanager
+    def write(self):
+        """ Hold a write transaction on the queue, so that workers' leases
+            can't interleave """
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def enqueue(self, org, repositories, dest_org):
+        """ Queue an org's repositories to be preserved in dest_org.
+            Repositories that are already pending have their details
+            refreshed, finished ones are queued again for this sweep, and
+            leased ones are left to their workers. Returns the number of
+            repositories now pending. """
+        rows = [(org, repository.name, dest_org,
+                 json.dumps(repository._asdict()))
+                for repository in repositories]
+        pending = 0
+        with self.write() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO tasks '
+                '(org, name, dest_org, repository) VALUES (?, ?, ?, ?)',
+                rows)
+            for org, name, dest_org, repository in rows:
+                pending += connection.execute(
+                    "UPDATE tasks SET repository = ?, status = 'pending', "
+                    "attempts = 0, lease = NULL, lease_owner = NULL, "
+                    "lease_expires = NULL, outcome = NULL, error = NULL "
+                    "WHERE org = ? AND name = ? AND dest_org = ? "
+                    "AND status != 'leased'",
+                    (repository, org, name, dest_org)).rowcount
+        return pending
+
+    def lease(self, worker_id, limit=1):
+        """ Lease up to limit tasks that are pending or whose leases have
+            expired, oldest first """
+        now = self.clock()
+        tasks = []
+        with self.write() as connection:
+            rows = connection.execute(
+                "SELECT id, org, repository, dest_org, attempts FROM tasks "
+                "WHERE status = 'pending' "
+                "OR (status = 'leased' AND lease_expires <= ?) "
+                "ORDER BY id LIMIT ?", (now, limit)).fetchall()
+            for task_id, org, repository, dest_org, attempts in rows:
+                if attempts >= self.max_attempts:
+                    # Its workers keep dying before they finish it
+                    connection.execute(
+                        "UPDATE tasks SET status = 'failed', "
+                        "error = 'Lease expired', lease = NULL, "
+                        "lease_expires = NULL WHERE id = ?", (task_id,))
+                    continue
+                lease = uuid.uuid4().hex
+                connection.execute(
+                    "UPDATE tasks SET status = 'leased', lease = ?, "
+                    "lease_owner = ?, lease_expires = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    (lease, worker_id, now + self.visibility_timeout,
+                     task_id))
+                repository = Repository(**json.loads(repository))
+                tasks.append(Task(task_id, org, repository, dest_org, lease,
+                                  attempts + 1))
+        return tasks
+
+    def extend(self, task):
+        """ Extend a task's lease by the visibility timeout. Returns False
+            if the lease has been lost to another worker. """
+        with self.write() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET lease_expires = ? "
+                "WHERE id = ? AND lease = ? AND status = 'leased'",
+                (self.clock() + self.visibility_timeout, task.id,
+                 task.lease))
+        return cursor.rowcount == 1
+
+    def complete(self, task, outcome):
+        """ Mark a leased task as done. Returns False if the lease has been
+            lost to another worker. """
+        with self.write() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET status = 'done', outcome = ?, "
+                "error = NULL, lease = NULL, lease_expires = NULL "
+                "WHERE id = ? AND lease = ? AND status = 'leased'",
+                (outcome, task.id, task.lease))
+        return cursor.rowcount == 1
+
+    def fail(self, task, error):
+        """ Release a task that failed, to be retried unless it has been
+            tried max_attempts times. Returns False if the lease has been
+            lost to another worker. """
+        status = 'failed' if task.attempts >= self.max_attempts else 'pending'
+        with self.write() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET status = ?, error = ?, "
+                "lease = NULL, lease_expires = NULL "
+                "WHERE id = ? AND lease = ? AND status = 'leased'",
+                (status, error, task.id, task.lease))
+        return cursor.rowcount == 1
+
+    def counts(self):
+        """ Get the number of tasks with each status """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT status, COUNT(*) FROM tasks GROUP BY status'
+            ).fetchall()
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        counts.update(rows)
+        return counts
+
+
+def enqueue_organizations(queue, orgs, dest_org):
+    """ List each org's repositories into the queue, to be preserved in
+        dest_org by workers. Returns the number of repositories queued. """
+    queued = 0
+    for org in orgs:
+        logger.info("Queueing repositories for " + org)
+        queued += queue.enqueue(org, list_repository_details(org), dest_org)
+    return queued
+
+
+def run_worker(queue, worker_id=None, workers=1, state=None,
+               reconcile=False, index=True, wait_for_leases=True,
+               poll_interval=DEFAULT_POLL_INTERVAL):
+    """ Lease repositories from the queue and preserve them with
+        preserve_repository, up to workers at a time, until the queue is
+        empty. Leases are extended while their repositories are in
+        progress. Repositories that fail, with a GitHubError or a network
+        error for instance, are released to be tried again, by this worker
+        or another.
+
+        With wait_for_leases, the worker doesn't stop while other workers
+        hold leases, so that it can take over their tasks if they die.
+        The state and reconcile options are passed on to
+        preserve_repository, and with index each destination org is listed
+        once into a DestinationIndex. Returns a Counter of outcomes. """
+    if worker_id is None:
+        worker_id = default_worker_id()
+    indexes = {}
+    outcomes = collections.Counter()
+
+    def preserve(task):
+        destination_index = None
+        if index:
+            destination_index = indexes.setdefault(
+                task.dest_org, DestinationIndex(task.dest_org))
+        return preserve_repository(task.org, task.repository, task.dest_org,
+                                   state=state, reconcile=reconcile,
+                                   index=destination_index)
+
+    # Extend leases well before they expire
+    heartbeat = queue.visibility_timeout / 3
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while True:
+            if len(running) < workers:
+                for task in queue.lease(worker_id, workers - len(running)):
+                    logger.info("Leased " + task.org + '/'
+                                + task.repository.name)
+                    running[executor.submit(preserve, task)] = task
+
+            if not running:
+                counts = queue.counts()
+                if counts['pending'] == 0 and not (wait_for_leases
+                                                   and counts['leased']):
+                    return outcomes
+                time.sleep(poll_interval)
+                continue
+
+            finished, _ = wait(list(running), timeout=heartbeat,
+                               return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                name = task.org + '/' + task.repository.name
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    # Network errors and the like are failures of the task
+                    # too; the worker carries on and its lease is released
+                    logger.error("\tError preserving " + name + ": "
+                                 + str(e))
+                    outcomes['failed'] += 1
+                    queue.fail(task, str(e))
+                    continue
+                outcomes[outcome] += 1
+                if not queue.complete(task, outcome):
+                    logger.warning("\tLost the lease on " + name)
+
+            for task in running.values():
+                queue.extend(task)
@@ -35,8 +35,9 @@ setup(
         'requests',
     ],
     extras_require={
+        'async': ['aiohttp'],
         'dev': ['check-manifest'],
-        'test': ['tox', 'pytest', 'pytest-cov', 'flake8'],
+        'test': ['tox', 'pytest', 'pytest-cov', 'flake8', 'aiohttp'],
     },
     setup_requires=[
         'pytest-runner',
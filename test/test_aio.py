@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from preserve.aio import (
+    AsyncGitHubClient,
+    preserve_organization,
+    preserve_organizations,
+)
+from preserve.cache import ResponseCache
+from preserve.github import GitHubError
+from preserve.metrics import Metrics
+from preserve.testing import FakeGitHub, FakeGitHubServer
+
+
+def make_app(calls):
+    """ A tiny stand-in for the GitHub API """
+    async def org_repos(request):
+        calls.append(('GET', request.path_qs))
+        page = int(request.query.get('page', 1))
+        headers = {'ETag': '"repos-' + str(page) + '"'}
+        if page == 1:
+            base = str(request.url.with_query({}))
+            headers['Link'] = (
+                '<' + base + '?per_page=100&page=2>; rel="next", '
+                '<' + base + '?per_page=100&page=2>; rel="last"')
+        if request.headers.get('If-None-Match') == headers['ETag']:
+            return web.Response(status=304, headers=headers)
+        names = ['one-repo', 'new-repo'] if page == 1 else ['same-repo']
+        return web.json_response([{'name': name} for name in names],
+                                 headers=headers)
+
+    async def repository(request):
+        calls.append(('GET', request.path_qs))
+        name = request.match_info['repo']
+        if name in ('someone_one-repo', 'someone_same-repo'):
+            return web.json_response({'name': name, 'fork': True})
+        if name == 'someone_not-fork':
+            return web.json_response({'name': name, 'fork': False})
+        return web.json_response({'message': 'Not Found'}, status=404)
+
+    async def refs(request):
+        calls.append(('GET', request.path_qs))
+        shas = {'someone': 'abc', 'myorg': 'def'}
+        if request.match_info['repo'] == 'someone_same-repo':
+            shas['myorg'] = 'abc'
+        sha = shas[request.match_info['owner']]
+        ref = 'refs/heads/master'
+        if request.match_info['namespace'] == 'tags':
+            if sha != 'abc':
+                return web.json_response([])
+            ref = 'refs/tags/v1.0'
+        return web.json_response([{'ref': ref, 'object': {'sha': sha}}])
+
+    async def write(request):
+        calls.append((request.method, request.path_qs))
+        status = {'POST': 202, 'PATCH': 200}[request.method]
+        if request.path.endswith('/forks'):
+            data = await request.json()
+            return web.json_response({'name': data['name']}, status=status)
+        if request.path.endswith('/git/refs'):
+            status = 201
+        elif request.method == 'POST':
+            status = 200
+        return web.json_response({}, status=status)
+
+    app = web.Application()
+    app.router.add_get('/orgs/{org}/repos', org_repos)
+    app.router.add_get('/repos/{owner}/{repo}', repository)
+    app.router.add_get('/repos/{owner}/{repo}/git/matching-refs/{namespace}',
+                       refs)
+    app.router.add_route('POST', '/repos/{owner}/{repo}/forks', write)
+    app.router.add_route('POST', '/repos/{owner}/{repo}', write)
+    app.router.add_route('POST', '/repos/{owner}/{repo}/git/refs', write)
+    app.router.add_route('PATCH', '/repos/{owner}/{repo}/git/refs/'
+                                  '{namespace}/{name}', write)
+    return app
+
+
+class AsyncGitHubClientTestCase(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path)
+
+    def run_with_server(self, function, **client_kwargs):
+        async def run():
+            server = TestServer(make_app(self.calls))
+            await server.start_server(access_log=None)
+            try:
+                url = str(server.make_url('')).rstrip('/')
+                with mock.patch('preserve.github.GITHUB_API_URL', url):
+                    async with AsyncGitHubClient(
+                            headers={}, **client_kwargs) as client:
+                        return await function(client)
+            finally:
+                await server.close()
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_list_repositories(self):
+        """ Pages after the first are fetched at once """
+        result = self.run_with_server(
+            lambda client: client.list_repositories('someone'))
+        self.assertEqual(result, ['one-repo', 'new-repo', 'same-repo'])
+        self.assertIn(('GET', '/orgs/someone/repos?per_page=100&page=2'),
+                      self.calls)
+
+    def test_list_repositories_cached(self):
+        """ Unchanged pages are served from the cache """
+        async def list_twice(client):
+            await client.list_repositories('someone')
+            return await client.list_repositories('someone')
+
+        result = self.run_with_server(
+            list_twice, cache=ResponseCache(self.cache_path))
+        self.assertEqual(result, ['one-repo', 'new-repo', 'same-repo'])
+
+    def test_metrics(self):
+        metrics = Metrics()
+        self.run_with_server(
+            lambda client: client.list_repositories('someone'),
+            metrics=metrics)
+        listing = metrics.to_dict()['endpoints']['GET /orgs/{org}/repos']
+        self.assertEqual(listing['requests'], {'200': 2})
+
+    def test_fork_exists(self):
+        async def check(client):
+            return [
+                await client.fork_exists('someone', 'one-repo', 'myorg',
+                                         fork_name='someone_one-repo'),
+                await client.fork_exists('someone', 'new-repo', 'myorg',
+                                         fork_name='someone_new-repo'),
+            ]
+        self.assertEqual(self.run_with_server(check), [True, False])
+
+    def test_fork_exists_not_fork(self):
+        with self.assertRaises(GitHubError):
+            self.run_with_server(lambda client: client.fork_exists(
+                'someone', 'not-fork', 'myorg', fork_name='someone_not-fork'))
+
+    @mock.patch('preserve.aio.logger')
+    def test_preserve_organization(self, mock_logger):
+        """ New repos are forked and renamed, others are updated """
+        result = self.run_with_server(lambda client: preserve_organization(
+            client, 'someone', 'myorg', workers=4))
+
+        self.assertEqual(result, ['updated', 'forked', 'updated'])
+        # The fork was made under its final name
+        self.assertIn(('POST', '/repos/someone/new-repo/forks'), self.calls)
+        self.assertNotIn(('POST', '/repos/myorg/new-repo'), self.calls)
+        self.assertIn(('PATCH', '/repos/myorg/someone_one-repo/git/refs/'
+                                'heads/master'), self.calls)
+        self.assertNotIn(('PATCH', '/repos/myorg/someone_same-repo/git/refs/'
+                                   'heads/master'), self.calls)
+        # The fork that lacks the upstream's tag has it created
+        self.assertIn(('POST', '/repos/myorg/someone_one-repo/git/refs'),
+                      self.calls)
+        self.assertNotIn(('POST', '/repos/myorg/someone_same-repo/git/refs'),
+                         self.calls)
+
+
+class FakeGitHubServerTestCase(TestCase):
+
+    def setUp(self):
+        self.fake = FakeGitHub()
+        self.server = FakeGitHubServer(self.fake).start()
+        self.addCleanup(self.server.stop)
+        for patcher in [
+                mock.patch('preserve.github.GITHUB_API_URL', self.server.url),
+                mock.patch('preserve.aio.logger')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_fork_names(self):
+        """ Forks are renamed from the name GitHub gave them, and never
+            from their upstream's name if another fork holds it """
+        for owner, name, sha in [('someone', 'one-repo', 'abc'),
+                                 ('someone', 'two-repo', 'abc'),
+                                 ('another', 'one-repo', 'def')]:
+            self.fake.add_repository(owner, name, branches={'master': sha})
+        # Another org's fork holds the upstream's name of one repository,
+        # and the other was forked under its upstream's name before
+        self.fake.create_fork(query={'org': 'myorg'}, data={},
+                              owner='another', repo='one-repo')
+        self.fake.create_fork(query={'org': 'myorg'}, data={},
+                              owner='someone', repo='two-repo')
+
+        result = preserve_organizations(['someone'], 'myorg', headers={})
+
+        self.assertEqual(result, {'someone': ['forked', 'forked']})
+        self.assertEqual(self.fake.branches('myorg', 'someone_one-repo'),
+                         {'master': 'abc'})
+        self.assertEqual(self.fake.branches('myorg', 'someone_two-repo'),
+                         {'master': 'abc'})
+        self.assertEqual(self.fake.branches('myorg', 'one-repo'),
+                         {'master': 'def'})
+        self.assertEqual(self.fake.requests[('POST', 'edit_repository')], 1)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+
+from preserve import github
+from preserve.benchmark import run_benchmark, synthetic_organization
+from preserve.testing import FakeGitHub
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_run_benchmark(self):
+        client = github.client
+        result = run_benchmark(20, workers=2)
+
+        self.assertEqual(result['outcomes'], {'forked': 10, 'updated': 10})
+        self.assertIsNone(result['error'])
+        # Listing both orgs, then a fork, made under its final name, for
+        # each new repository, heads and tags listings on both sides of each
+        # existing fork, and a PATCH for the one stale fork
+        self.assertEqual(result['requests'], 2 + 10 + 10 * 4 + 1)
+        self.assertEqual(result['requests_per_repository'], 53 / 20)
+
+        # The shared client is put back afterwards
+        self.assertIs(github.client, client)
+        self.assertEqual(github.GITHUB_API_URL, 'https://api.github.com')
+
+    def test_run_benchmark_error_rate(self):
+        """ Injected errors are retried rather than ending the run """
+        result = run_benchmark(50, workers=2, error_rate=0.05)
+
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['outcomes'], {'forked': 25, 'updated': 25})
+        # The retries are counted
+        self.assertGreater(result['requests'], 2 + 25 + 25 * 4 + 2)
+
+    def test_run_benchmark_error(self):
+        result = run_benchmark(5, workers=1, error_rate=1.0)
+        self.assertEqual(result['outcomes'], {})
+        self.assertEqual(result['error'], 'Server Error')
+
+    def test_synthetic_organization(self):
+        fake = FakeGitHub()
+        synthetic_organization(fake, 'someone', 'myorg', 10, branches=2)
+
+        self.assertEqual(len(fake.repositories), 15)
+        self.assertEqual(sorted(fake.branches('someone', 'repo-00000')),
+                         ['branch-1', 'master'])
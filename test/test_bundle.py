@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+from preserve.bundle import (
+    BundleArchive,
+    archive_mirrors,
+    archive_repository,
+    list_tips,
+    restore_repository,
+)
+from preserve.github import Repository
+from preserve.mirror import (
+    mirror_lock,
+    mirror_path,
+    mirror_repository,
+    run_git,
+)
+
+
+class BundleArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.upstreams = os.path.join(self.path, 'upstreams')
+        self.git_url = 'file://' + self.upstreams
+        self.mirror_dir = os.path.join(self.path, 'mirrors')
+        self.work = os.path.join(self.path, 'work')
+        self.archive = BundleArchive(os.path.join(self.path, 'archive'))
+        self.addCleanup(self.archive.close)
+
+        for name in ('preserve.mirror.logger', 'preserve.bundle.logger'):
+            logger_patcher = mock.patch(name)
+            logger_patcher.start()
+            self.addCleanup(logger_patcher.stop)
+
+    def add_upstream(self, org, repo, fork_of=None):
+        """ Create a bare upstream, either with a commit on master or as a
+            copy of another, and a work tree to push more to it from """
+        upstream = os.path.join(self.upstreams, org, repo + '.git')
+        work = os.path.join(self.work, org, repo)
+        if fork_of is None:
+            run_git(['init', '--quiet', '--bare', upstream])
+            run_git(['init', '--quiet', work])
+            run_git(['remote', 'add', 'origin', upstream], cwd=work)
+            self.commit(work, 'master')
+        else:
+            run_git(['clone', '--quiet', '--bare',
+                     os.path.join(self.upstreams, *fork_of) + '.git',
+                     upstream])
+            run_git(['clone', '--quiet', upstream, work])
+        return work
+
+    def commit(self, work, branch, message='commit'):
+        run_git(['checkout', '--quiet', '-B', branch], cwd=work)
+        with open(os.path.join(work, 'file'), 'a') as f:
+            f.write(branch + ' ' + message + '\n' * 1000)
+        run_git(['add', 'file'], cwd=work)
+        run_git(['-c', 'user.name=Someone', '-c', 'user.email=s@example.com',
+                 'commit', '--quiet', '-m', message], cwd=work)
+        run_git(['push', '--quiet', 'origin', branch], cwd=work)
+
+    def mirror(self, org, repo):
+        mirror_repository(org, Repository(repo), self.mirror_dir,
+                          git_url=self.git_url)
+
+    def archive_repository(self, org, repo):
+        self.mirror(org, repo)
+        return archive_repository(self.archive, org, repo, self.mirror_dir)
+
+    def bundle_heads(self, bundle):
+        output = run_git(['bundle', 'list-heads',
+                          self.archive.bundle_path(bundle)])
+        return sorted(line.split()[1] for line in output.splitlines())
+
+    def assert_restores(self, org, repo):
+        restored = os.path.join(self.path, 'restored', org, repo)
+        restore_repository(self.archive, org, repo, restored)
+        run_git(['fsck', '--connectivity-only'], cwd=restored)
+        self.assertEqual(
+            list_tips(restored),
+            list_tips(mirror_path(self.mirror_dir, org, repo)))
+
+    def test_archive_incrementally(self):
+        """ Each archive only bundles the commits since the last """
+        work = self.add_upstream('someone', 'one-repo')
+        run_git(['tag', 'v1.0'], cwd=work)
+        run_git(['push', '--quiet', 'origin', 'v1.0'], cwd=work)
+
+        self.assertEqual(self.archive_repository('someone', 'one-repo'),
+                         'archived')
+        first, = self.archive.dependencies('someone', 'one-repo')
+        self.assertEqual(self.bundle_heads(first),
+                         ['refs/heads/master', 'refs/tags/v1.0'])
+
+        self.assertEqual(self.archive_repository('someone', 'one-repo'),
+                         'unchanged')
+
+        self.commit(work, 'master', 'second')
+        self.assertEqual(self.archive_repository('someone', 'one-repo'),
+                         'archived')
+        bundles = self.archive.dependencies('someone', 'one-repo')
+        self.assertEqual(bundles[0], first)
+        second = bundles[1]
+        self.assertEqual(self.bundle_heads(second), ['refs/heads/master'])
+        # The second bundle needs the first
+        self.assertIn('requires this ref', run_git(
+            ['bundle', 'verify', self.archive.bundle_path(second)],
+            cwd=mirror_path(self.mirror_dir, 'someone', 'one-repo')))
+
+        self.assert_restores('someone', 'one-repo')
+
+    def test_archive_forks(self):
+        """ Forks of an archived upstream only bundle their own commits """
+        self.add_upstream('someone', 'one-repo')
+        self.assertEqual(self.archive_repository('someone', 'one-repo'),
+                         'archived')
+        upstream, = self.archive.dependencies('someone', 'one-repo')
+
+        fork = self.add_upstream('another', 'one-repo',
+                                 fork_of=('someone', 'one-repo'))
+        self.commit(fork, 'feature')
+        self.add_upstream('third', 'one-repo',
+                          fork_of=('someone', 'one-repo'))
+
+        self.assertEqual(self.archive_repository('another', 'one-repo'),
+                         'archived')
+        self.assertEqual(self.archive_repository('third', 'one-repo'),
+                         'updated')
+
+        upstream_bundle, fork_bundle = self.archive.dependencies(
+            'another', 'one-repo')
+        self.assertEqual(upstream_bundle, upstream)
+        self.assertEqual(self.bundle_heads(fork_bundle),
+                         ['refs/heads/feature'])
+        self.assertEqual(self.archive.dependencies('third', 'one-repo'),
+                         [upstream])
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(
+            os.path.join(self.archive.path, 'bundles'))), 2)
+
+        self.assert_restores('another', 'one-repo')
+        self.assert_restores('third', 'one-repo')
+
+    def test_add_bundle_deduplicates(self):
+        """ Identical bundles are stored once """
+        paths = []
+        for i in range(2):
+            paths.append(os.path.join(self.path, str(i) + '.bundle'))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'the same bundle')
+
+        first = self.archive.add_bundle(paths[0], [])
+        second = self.archive.add_bundle(paths[1], [])
+
+        self.assertEqual(first, second)
+        self.assertTrue(os.path.exists(self.archive.bundle_path(first)))
+        self.assertFalse(os.path.exists(paths[1]))
+
+    def test_archive_locked(self):
+        """ A mirror that is being refreshed is skipped """
+        self.add_upstream('someone', 'one-repo')
+        self.mirror('someone', 'one-repo')
+
+        with mirror_lock(mirror_path(self.mirror_dir, 'someone',
+                                     'one-repo')):
+            self.assertEqual(archive_repository(
+                self.archive, 'someone', 'one-repo', self.mirror_dir),
+                'skipped')
+        self.assertIsNone(self.archive.refs('someone', 'one-repo'))
+
+    def test_archive_mirrors(self):
+        self.add_upstream('someone', 'one-repo')
+        self.add_upstream('someone', 'two-repo')
+        self.mirror('someone', 'one-repo')
+        self.mirror('someone', 'two-repo')
+
+        results = archive_mirrors(self.archive, self.mirror_dir,
+                                  ['someone', 'another'], workers=2)
+
+        self.assertEqual(results, {'someone': ['archived', 'archived']})
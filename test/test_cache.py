@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+import requests
+
+from preserve.cache import (
+    ResponseCache,
+)
+from preserve.github import (
+    GitHubClient,
+)
+
+
+def make_response(status_code, content=b'', headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.headers.update(headers or {})
+    return response
+
+
+class ResponseCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store_lookup(self):
+        """ Responses with an ETag are stored and revalidated """
+        cache = ResponseCache(self.path)
+        cache.store('https://test/url', make_response(
+            200, b'[{"name": "one-repo"}]',
+            {'ETag': '"abc"', 'Link': '<https://test/url?page=2>; '
+                                      'rel="next"'}))
+
+        entry = cache.lookup('https://test/url')
+        self.assertEqual(cache.conditional_headers(entry),
+                         {'If-None-Match': '"abc"'})
+
+        response = cache.response(entry, make_response(
+            304, headers={'X-RateLimit-Remaining': '4999'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [{'name': 'one-repo'}])
+        self.assertEqual(response.links['next']['url'],
+                         'https://test/url?page=2')
+        self.assertEqual(response.headers['X-RateLimit-Remaining'], '4999')
+
+    def test_store_shared(self):
+        """ Caches sharing a directory, as those of separate processes do,
+            can store the same URL at once """
+        caches = [ResponseCache(self.path), ResponseCache(self.path)]
+        replace = os.replace
+
+        def interleaved_replace(src, dst):
+            # The other cache stores the URL while the first is mid-write
+            os.replace = replace
+            store(caches[1], b'[{"name": "two-repo"}]')
+            replace(src, dst)
+
+        def store(cache, content):
+            cache.store('https://test/url', make_response(
+                200, content, {'ETag': '"abc"'}))
+
+        with mock.patch('os.replace', interleaved_replace):
+            store(caches[0], b'[{"name": "one-repo"}]')
+
+        self.assertEqual(os.listdir(self.path),
+                         [os.path.basename(caches[0].entry_path(
+                             'https://test/url'))])
+        self.assertIsNotNone(caches[0].lookup('https://test/url'))
+
+    def test_store_not_cacheable(self):
+        """ Errors and responses without validators aren't stored """
+        cache = ResponseCache(self.path)
+        cache.store('https://test/url', make_response(404, b'{}',
+                                                      {'ETag': '"abc"'}))
+        cache.store('https://test/other', make_response(200, b'{}'))
+        self.assertIsNone(cache.lookup('https://test/url'))
+        self.assertIsNone(cache.lookup('https://test/other'))
+
+    def test_store_last_modified(self):
+        cache = ResponseCache(self.path)
+        cache.store('https://test/url', make_response(
+            200, b'{}', {'Last-Modified': 'Thu, 05 Jul 2012 15:31:30 GMT'}))
+        entry = cache.lookup('https://test/url')
+        self.assertEqual(cache.conditional_headers(entry), {
+            'If-Modified-Since': 'Thu, 05 Jul 2012 15:31:30 GMT'})
+
+    def test_evict(self):
+        """ The least recently used entries are evicted past max_size """
+        cache = ResponseCache(self.path, max_size=1000)
+        for i in range(10):
+            url = 'https://test/url?page=' + str(i)
+            cache.store(url, make_response(200, b'x' * 100,
+                                           {'ETag': '"' + str(i) + '"'}))
+            # Make sure every entry has a distinct, increasing mtime
+            os.utime(cache.entry_path(url), (i, i))
+
+        self.assertLessEqual(cache.size, 1000)
+        self.assertIsNone(cache.lookup('https://test/url?page=0'))
+        self.assertIsNotNone(cache.lookup('https://test/url?page=9'))
+
+
+class CachedClientTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.client = GitHubClient(headers={}, cache=ResponseCache(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_client_not_modified(self):
+        """ A 304 is answered from the cache """
+        with mock.patch.object(self.client.session,
+                               'request') as mock_request:
+            mock_request.side_effect = [
+                make_response(200, b'["first"]', {'ETag': '"abc"'}),
+                make_response(304),
+            ]
+            first = self.client.get('https://test/url')
+            second = self.client.get('https://test/url')
+
+        self.assertEqual(first.json(), ['first'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json(), ['first'])
+        mock_request.assert_called_with(
+            'GET', 'https://test/url', timeout=self.client.timeout,
+            headers={'If-None-Match': '"abc"'})
+
+    def test_client_modified(self):
+        """ A changed resource replaces the cached entry """
+        with mock.patch.object(self.client.session,
+                               'request') as mock_request:
+            mock_request.side_effect = [
+                make_response(200, b'["first"]', {'ETag': '"abc"'}),
+                make_response(200, b'["second"]', {'ETag': '"def"'}),
+            ]
+            self.client.get('https://test/url')
+            second = self.client.get('https://test/url')
+
+        self.assertEqual(second.json(), ['second'])
+        entry = self.client.cache.lookup('https://test/url')
+        self.assertEqual(entry['headers']['ETag'], '"def"')
+
+    def test_client_post_not_cached(self):
+        with mock.patch.object(self.client.session,
+                               'request') as mock_request:
+            mock_request.return_value = make_response(
+                202, b'{}', {'ETag': '"abc"'})
+            self.client.post('https://test/url')
+        self.assertIsNone(self.client.cache.lookup('https://test/url'))
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 from unittest import mock
 
 from click.testing import CliRunner
 
+from preserve import github
 from preserve.command_line import (
     main,
 )
@@ -26,3 +31,319 @@ class TestCommandLine(TestCase):
         self.assertEqual(len(mock_logger.error.mock_calls), 1)
         self.assertEqual(len(mock_preserve_organization.mock_calls), 0)
         self.assertEqual(result.exit_code, 1)
+
+    @mock.patch('preserve.command_line.preserve_organization')
+    def test_main_workers(self, mock_preserve_organization):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--workers=8', '--graphql',
+                                      '--no-index'])
+        mock_preserve_organization.assert_called_once_with(
+            'someone', 'codepreservetest', workers=8, graphql=True,
+            state=None, reconcile=False, stream=False, index=None,
+            async_forks=False, journal=None)
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.preserve_organization')
+    @mock.patch('preserve.command_line.github.configure')
+    def test_main_configures_client(self, mock_configure,
+                                    mock_preserve_organization):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--workers=32',
+                                      '--timeout=5', '--no-cache'])
+        # Room for each worker's concurrent page or ref requests
+        mock_configure.assert_called_once_with(pool_size=32 * 9, timeout=5,
+                                               cache=None,
+                                               rate_limiter=mock.ANY,
+                                               metrics=None)
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.preserve_organization')
+    @mock.patch('preserve.command_line.github.configure')
+    def test_main_cache_dir(self, mock_configure,
+                            mock_preserve_organization):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--cache-dir=/tmp/cache'])
+        cache = mock_configure.call_args[1]['cache']
+        self.assertEqual(cache.path, '/tmp/cache')
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.preserve_organization')
+    @mock.patch('preserve.command_line.StateStore')
+    def test_main_state(self, mock_state_store, mock_preserve_organization):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--state=state.db'])
+        mock_state_store.assert_called_once_with('state.db')
+        self.assertIs(mock_preserve_organization.call_args[1]['state'],
+                      mock_state_store.return_value)
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.preserve_organization')
+    def test_main_shared_index(self, mock_preserve_organization):
+        """ One index of the destination is shared between orgs """
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', 'another'])
+        first, second = mock_preserve_organization.call_args_list
+        self.assertIs(first[1]['index'], second[1]['index'])
+        self.assertEqual(first[1]['index'].destination_org,
+                         'codepreservetest')
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.preserve_organizations')
+    @mock.patch('preserve.command_line.preserve_organization')
+    @mock.patch('preserve.command_line.logger')
+    def test_main_org_file(self, mock_logger, mock_preserve_organization,
+                           mock_preserve_organizations):
+        """ Orgs from stdin are scheduled together with those given """
+        orgs = []
+        mock_preserve_organizations.side_effect = (
+            lambda organizations, *args, **kwargs: orgs.extend(organizations))
+        runner = CliRunner()
+        result = runner.invoke(
+            main, ['someone', '--org-file=-', '--dest-org=myorg'],
+            input='another\n\n# a comment\nmyorg\nthird  # trailing\n')
+
+        self.assertEqual(orgs, ['someone', 'another', 'third'])
+        self.assertEqual(len(mock_logger.error.mock_calls), 1)
+        mock_preserve_organization.assert_not_called()
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.aio.preserve_organizations')
+    @mock.patch('preserve.command_line.preserve_organization')
+    def test_main_async_client(self, mock_preserve_organization,
+                               mock_aio_preserve_organizations):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', 'another', '--client=async',
+                                      '--workers=50', '--no-cache'])
+        mock_aio_preserve_organizations.assert_called_once_with(
+            ('someone', 'another'), 'codepreservetest', workers=50,
+            pool_size=50, timeout=github.DEFAULT_TIMEOUT, cache=None,
+            rate_limiter=mock.ANY, metrics=None)
+        mock_preserve_organization.assert_not_called()
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.aio.preserve_organizations')
+    @mock.patch('preserve.command_line.logger')
+    def test_main_async_client_unsupported(self, mock_logger,
+                                           mock_aio_preserve_organizations):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--client=async',
+                                      '--graphql'])
+        self.assertEqual(len(mock_logger.error.mock_calls), 1)
+        mock_aio_preserve_organizations.assert_not_called()
+        self.assertEqual(result.exit_code, 1)
+
+    @mock.patch('preserve.command_line.preserve_organization')
+    @mock.patch('preserve.command_line.github.configure')
+    def test_main_metrics(self, mock_configure, mock_preserve_organization):
+        """ Metrics are written at the end of the run """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        json_path = os.path.join(path, 'metrics.json')
+        prom_path = os.path.join(path, 'preserve.prom')
+        mock_preserve_organization.side_effect = [['forked', 'updated'],
+                                                  ['updated']]
+
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', 'another',
+                                      '--metrics-json=' + json_path,
+                                      '--metrics-prom=' + prom_path])
+
+        metrics = mock_configure.call_args[1]['metrics']
+        self.assertEqual(metrics.outcomes, {'forked': 1, 'updated': 2})
+        with open(json_path) as f:
+            self.assertEqual(json.load(f)['outcomes'],
+                             {'forked': 1, 'updated': 2})
+        with open(prom_path) as f:
+            self.assertIn('preserve_repositories_total{outcome="updated"} 2',
+                          f.read())
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.run_worker')
+    @mock.patch('preserve.command_line.enqueue_organizations')
+    @mock.patch('preserve.command_line.WorkQueue')
+    @mock.patch('preserve.command_line.preserve_organization')
+    def test_main_queue(self, mock_preserve_organization, mock_work_queue,
+                        mock_enqueue_organizations, mock_run_worker):
+        """ Orgs given with a queue are queued, not preserved """
+        orgs = []
+        mock_enqueue_organizations.side_effect = (
+            lambda queue, organizations, dest_org: orgs.extend(
+                organizations))
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--queue=queue.db'])
+
+        mock_work_queue.assert_called_once_with('queue.db')
+        self.assertEqual(orgs, ['someone'])
+        mock_run_worker.assert_not_called()
+        mock_preserve_organization.assert_not_called()
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.run_worker')
+    @mock.patch('preserve.command_line.WorkQueue')
+    def test_main_queue_worker(self, mock_work_queue, mock_run_worker):
+        runner = CliRunner()
+        result = runner.invoke(main, ['--queue=queue.db', '--worker',
+                                      '--workers=4', '--no-index'])
+        mock_run_worker.assert_called_once_with(
+            mock_work_queue.return_value, workers=4, state=None,
+            reconcile=False, index=False)
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.run_worker')
+    @mock.patch('preserve.command_line.logger')
+    def test_main_worker_without_queue(self, mock_logger, mock_run_worker):
+        runner = CliRunner()
+        result = runner.invoke(main, ['--worker'])
+        self.assertEqual(len(mock_logger.error.mock_calls), 1)
+        mock_run_worker.assert_not_called()
+        self.assertEqual(result.exit_code, 1)
+
+    @mock.patch('preserve.command_line.preserve_organization')
+    @mock.patch('preserve.command_line.Journal')
+    def test_main_journal(self, mock_journal, mock_preserve_organization):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--journal=run.jsonl',
+                                      '--resume'])
+        mock_journal.assert_called_once_with('run.jsonl', resume=True)
+        self.assertIs(mock_preserve_organization.call_args[1]['journal'],
+                      mock_journal.return_value)
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.preserve_organization')
+    @mock.patch('preserve.command_line.logger')
+    def test_main_resume_without_journal(self, mock_logger,
+                                         mock_preserve_organization):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--resume'])
+        self.assertEqual(len(mock_logger.error.mock_calls), 1)
+        mock_preserve_organization.assert_not_called()
+        self.assertEqual(result.exit_code, 1)
+
+    @mock.patch('preserve.command_line.mirror.mirror_organization')
+    @mock.patch('preserve.command_line.preserve_organization')
+    def test_main_mirror(self, mock_preserve_organization,
+                         mock_mirror_organization):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--backend=mirror',
+                                      '--mirror-dir=/srv/mirrors',
+                                      '--workers=4'])
+        mock_mirror_organization.assert_called_once_with(
+            'someone', '/srv/mirrors', workers=4, stream=False)
+        mock_preserve_organization.assert_not_called()
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.mirror.mirror_organization')
+    @mock.patch('preserve.command_line.logger')
+    def test_main_mirror_unsupported(self, mock_logger,
+                                     mock_mirror_organization):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--backend=mirror',
+                                      '--graphql'])
+        self.assertEqual(len(mock_logger.error.mock_calls), 1)
+        mock_mirror_organization.assert_not_called()
+        self.assertEqual(result.exit_code, 1)
+
+    @mock.patch('preserve.command_line.bundle.archive_mirrors')
+    @mock.patch('preserve.command_line.bundle.BundleArchive')
+    @mock.patch('preserve.command_line.mirror.mirror_organization')
+    def test_main_mirror_archive(self, mock_mirror_organization,
+                                 mock_bundle_archive, mock_archive_mirrors):
+        """ The mirrors of the orgs are archived once they are refreshed """
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', 'another',
+                                      '--backend=mirror',
+                                      '--archive-dir=/srv/archive'])
+        self.assertEqual(mock_mirror_organization.call_count, 2)
+        mock_bundle_archive.assert_called_once_with('/srv/archive')
+        mock_archive_mirrors.assert_called_once_with(
+            mock_bundle_archive.return_value, 'mirrors',
+            ['someone', 'another'], workers=1)
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.bundle.archive_mirrors')
+    @mock.patch('preserve.command_line.logger')
+    def test_main_archive_without_mirror(self, mock_logger,
+                                         mock_archive_mirrors):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--archive-dir=archive'])
+        self.assertEqual(len(mock_logger.error.mock_calls), 1)
+        mock_archive_mirrors.assert_not_called()
+        self.assertEqual(result.exit_code, 1)
+
+    @mock.patch('preserve.command_line.Watcher')
+    @mock.patch('preserve.command_line.preserve_organization')
+    def test_main_watch(self, mock_preserve_organization, mock_watcher):
+        mock_watcher.return_value.run.return_value = iter([{}, {}])
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', 'another', '--watch',
+                                      '--watch-interval=300', '--no-index'])
+        mock_watcher.assert_called_once_with(
+            ['someone', 'another'], 'codepreservetest', workers=1,
+            state=None, index=None, interval=300)
+        mock_watcher.return_value.run.assert_called_once_with()
+        mock_preserve_organization.assert_not_called()
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.Watcher')
+    @mock.patch('preserve.command_line.logger')
+    def test_main_watch_unsupported(self, mock_logger, mock_watcher):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--watch', '--queue=q.db'])
+        self.assertEqual(len(mock_logger.error.mock_calls), 1)
+        mock_watcher.assert_not_called()
+        self.assertEqual(result.exit_code, 1)
+
+    @mock.patch('preserve.command_line.WebhookServer')
+    @mock.patch('preserve.command_line.preserve_organization')
+    def test_main_webhook(self, mock_preserve_organization,
+                          mock_webhook_server):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--webhook',
+                                      '--webhook-port=9000', '--workers=2'],
+                               env={'PRESERVE_WEBHOOK_SECRET': 'secret'})
+        (receiver,), kwargs = mock_webhook_server.call_args
+        self.assertEqual(kwargs, {'host': '127.0.0.1', 'port': 9000})
+        self.assertEqual(receiver.secret, 'secret')
+        self.assertEqual(receiver.orgs, {'someone'})
+        self.assertEqual(receiver.queue.workers, 2)
+        mock_webhook_server.return_value.serve_forever.assert_called_once_with()  # noqa
+        mock_preserve_organization.assert_not_called()
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.WebhookServer')
+    @mock.patch('preserve.command_line.logger')
+    def test_main_webhook_without_secret(self, mock_logger,
+                                         mock_webhook_server):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--webhook'],
+                               env={'PRESERVE_WEBHOOK_SECRET': ''})
+        self.assertEqual(len(mock_logger.error.mock_calls), 1)
+        mock_webhook_server.assert_not_called()
+        self.assertEqual(result.exit_code, 1)
+
+    @mock.patch('preserve.command_line.StateStore')
+    @mock.patch('preserve.command_line.preserve_by_priority')
+    @mock.patch('preserve.command_line.preserve_organization')
+    def test_main_priority(self, mock_preserve_organization,
+                           mock_preserve_by_priority, mock_state_store):
+        mock_preserve_by_priority.return_value = {}
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', 'another', '--priority',
+                                      '--state=state.db', '--budget=100',
+                                      '--no-index'])
+        (orgs, dest_org, state), kwargs = mock_preserve_by_priority.call_args
+        self.assertEqual(list(orgs), ['someone', 'another'])
+        self.assertEqual(state, mock_state_store.return_value)
+        self.assertEqual(kwargs['budget'], 100)
+        mock_preserve_organization.assert_not_called()
+        self.assertEqual(result.exit_code, 0)
+
+    @mock.patch('preserve.command_line.preserve_by_priority')
+    @mock.patch('preserve.command_line.logger')
+    def test_main_priority_without_state(self, mock_logger,
+                                         mock_preserve_by_priority):
+        runner = CliRunner()
+        result = runner.invoke(main, ['someone', '--priority'])
+        self.assertEqual(len(mock_logger.error.mock_calls), 1)
+        mock_preserve_by_priority.assert_not_called()
+        self.assertEqual(result.exit_code, 1)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+from unittest import mock
+
+from preserve.forks import (
+    ForkPipeline,
+)
+from preserve.github import GitHubError
+
+
+class ForkPipelineTestCase(TestCase):
+
+    def test_when_ready(self):
+        """ Forks are polled with backoff until ready, then completed """
+        ready = mock.MagicMock(side_effect=[False, False, True])
+        callback = mock.MagicMock(return_value='forked')
+        forks = ForkPipeline(initial_delay=0.001, max_delay=0.004,
+                             ready=ready)
+
+        future = forks.when_ready('myorg', 'one-repo', callback)
+        forks.close()
+
+        self.assertEqual(future.result(), 'forked')
+        self.assertEqual(ready.call_count, 3)
+        ready.assert_called_with('myorg', 'one-repo')
+        callback.assert_called_once_with()
+
+    def test_when_ready_many(self):
+        """ Many forks can be waiting at once """
+        ready_after = {'repo-' + str(i): i % 3 for i in range(20)}
+
+        def ready(destination_org, repository):
+            ready_after[repository] -= 1
+            return ready_after[repository] < 0
+
+        forks = ForkPipeline(initial_delay=0.001, max_delay=0.002,
+                             ready=ready)
+        futures = [forks.when_ready('myorg', repository,
+                                    lambda repository=repository: repository)
+                   for repository in sorted(ready_after)]
+        forks.close()
+
+        self.assertEqual([future.result() for future in futures],
+                         sorted(ready_after))
+
+    @mock.patch('preserve.forks.logger')
+    def test_when_ready_timeout(self, mock_logger):
+        """ A fork that never becomes ready is completed after the timeout """
+        forks = ForkPipeline(initial_delay=0.001, max_delay=0.002,
+                             timeout=0.01, ready=lambda *args: False)
+        future = forks.when_ready('myorg', 'one-repo', lambda: 'forked')
+        forks.close()
+
+        self.assertEqual(future.result(), 'forked')
+        self.assertEqual(mock_logger.warning.call_count, 1)
+
+    def test_when_ready_error(self):
+        """ Errors from the callback are raised from the future """
+        forks = ForkPipeline(initial_delay=0.001, ready=lambda *args: True)
+        callback = mock.MagicMock(side_effect=GitHubError('failure'))
+        future = forks.when_ready('myorg', 'one-repo', callback)
+        forks.close()
+
+        with self.assertRaises(GitHubError):
+            future.result()
@@ -1,26 +1,106 @@
 # -*- coding: utf-8 -*-
+import json
+import threading
 from unittest import TestCase
 from unittest import mock
+from urllib.parse import parse_qsl, urlsplit
 
+from preserve.state import StateStore
 from preserve.github import (
+    BatchForkUpdater,
+    ForkUpdateError,
+    DestinationIndex,
+    GitHubClient,
     GitHubError,
+    Ref,
+    RefSyncError,
+    Repository,
+    configure,
     github_api_all,
+    github_api_iter,
     fork_exists,
+    fork_ready,
     fork_repository,
+    iter_repository_details,
+    list_refs,
+    list_refs_batch,
     list_repositories,
+    list_repository_details,
     rate_limit,
+    ref_details,
     rename_repository,
+    repository_details,
+    sync_refs,
     update_fork,
+    update_forks,
 )
 
 
+def refs_response(*refs):
+    """ A page of git/matching-refs results for (ref, sha) pairs """
+    response = mock.MagicMock()
+    response.status_code = 200
+    response.links = {}
+    response.json.return_value = [
+        {'ref': ref, 'object': {'sha': sha, 'type': 'commit'}}
+        for ref, sha in refs]
+    return response
+
+
+def graphql_refs(refs, cursor=None):
+    return {
+        'refs': {
+            'pageInfo': {'hasNextPage': cursor is not None,
+                         'endCursor': cursor},
+            'nodes': [{'name': name, 'target': {'oid': sha}}
+                      for name, sha in refs],
+        }
+    }
+
+
+class GitHubClientTestCase(TestCase):
+
+    def test_client_session(self):
+        """ The client's session is pooled and carries default headers """
+        client = GitHubClient(headers={'Authorization': 'token abc'},
+                              pool_size=25)
+        self.assertEqual(client.session.headers['Authorization'],
+                         'token abc')
+        adapter = client.session.get_adapter('https://api.github.com')
+        self.assertEqual(adapter._pool_maxsize, 25)
+
+    def test_client_request_timeout(self):
+        """ Requests are made through the session with a timeout """
+        client = GitHubClient(timeout=5)
+        with mock.patch.object(client.session, 'request') as mock_request:
+            client.get('https://test/url')
+            client.post('https://test/url', data='{}')
+            client.patch('https://test/url', data='{}', timeout=1)
+        mock_request.assert_has_calls([
+            mock.call('GET', 'https://test/url', timeout=5),
+            mock.call('POST', 'https://test/url', data='{}', timeout=5),
+            mock.call('PATCH', 'https://test/url', data='{}', timeout=1),
+        ])
+
+    def test_configure(self):
+        """ configure replaces the shared client """
+        import preserve.github
+        original = preserve.github.client
+        try:
+            client = configure(pool_size=50, timeout=10)
+            self.assertIs(preserve.github.client, client)
+            self.assertEqual(client.timeout, 10)
+        finally:
+            preserve.github.client = original
+
+
 class GitHubTestCase(TestCase):
 
     def setUp(self):
         import preserve.github
         preserve.github.HEADERS = {}
 
-    @mock.patch('requests.get')
+    @mock.patch('preserve.github.client.get')
     def test_rate_limit(self, mock_requests_get):
         mock_rate_limit = mock.MagicMock()
         mock_rate_limit.json.return_value = {
@@ -34,7 +114,7 @@ class GitHubTestCase(TestCase):
         response_json = rate_limit()
         self.assertEqual(response_json, (5000, 4999, 1372700873))
 
-    @mock.patch('requests.get')
+    @mock.patch('preserve.github.client.get')
     def test_github_api_all(self, mock_requests_get):
         """ github_api_all uses the Link header in a GitHub API reasponse to
             get all paginated results for a query before returning. """
@@ -71,12 +151,90 @@ class GitHubTestCase(TestCase):
 
         github_api_all('https://test/url')
         mock_requests_get.assert_has_calls([
-            mock.call('https://test/url', headers={}),
-            mock.call('https://test/url?page=2', headers={}),
-            mock.call('https://test/url?page=3', headers={})
+            mock.call('https://test/url?per_page=100'),
+            mock.call('https://test/url?page=2'),
+            mock.call('https://test/url?page=3')
         ])
 
-    @mock.patch('requests.get')
+    @mock.patch('preserve.github.client.get')
+    def test_github_api_all_concurrent(self, mock_requests_get):
+        """ github_api_all reads the number of pages from the 'last' link of
+            the first page and fetches the rest at once, in order. """
+        pages = {}
+        for page in range(1, 6):
+            response = mock.MagicMock()
+            response.status_code = 200
+            response.json.return_value = [{'page': page}]
+            response.links = {}
+            pages[page] = response
+        pages[1].links = {
+            'next': {'url': 'https://test/url?per_page=100&page=2'},
+            'last': {'url': 'https://test/url?per_page=100&page=5'},
+        }
+        mock_requests_get.side_effect = lambda url: pages[
+            int(dict(parse_qsl(urlsplit(url).query)).get('page', 1))]
+
+        result = github_api_all('https://test/url?type=public')
+
+        self.assertEqual(result, [{'page': page} for page in range(1, 6)])
+        mock_requests_get.assert_any_call(
+            'https://test/url?type=public&per_page=100')
+        mock_requests_get.assert_any_call(
+            'https://test/url?per_page=100&page=5')
+        self.assertEqual(mock_requests_get.call_count, 5)
+
+    @mock.patch('preserve.github.client.get')
+    def test_github_api_all_concurrent_404(self, mock_requests_get):
+        """ A failed page fails the whole listing """
+        first_page = mock.MagicMock()
+        first_page.status_code = 200
+        first_page.json.return_value = []
+        first_page.links = {
+            'next': {'url': 'https://test/url?per_page=100&page=2'},
+            'last': {'url': 'https://test/url?per_page=100&page=2'},
+        }
+        mock_error = mock.MagicMock()
+        mock_error.status_code = 404
+        mock_error.json.return_value = {'message': 'failure'}
+        mock_requests_get.side_effect = [first_page, mock_error]
+
+        with self.assertRaises(GitHubError):
+            github_api_all('https://test/url')
+
+    @mock.patch('preserve.github.client.get')
+    def test_github_api_iter(self, mock_requests_get):
+        """ github_api_iter only fetches a page once the previous page's
+            results have been consumed. """
+        first_page = mock.MagicMock()
+        first_page.status_code = 200
+        first_page.json.return_value = [1, 2]
+        first_page.links = {
+            'next': {'url': 'https://test/url?per_page=100&page=2'}}
+        second_page = mock.MagicMock()
+        second_page.status_code = 200
+        second_page.json.return_value = [3]
+        second_page.links = {}
+        mock_requests_get.side_effect = [first_page, second_page]
+
+        results = github_api_iter('https://test/url')
+        self.assertEqual(next(results), 1)
+        self.assertEqual(next(results), 2)
+        mock_requests_get.assert_called_once_with(
+            'https://test/url?per_page=100')
+        self.assertEqual(list(results), [3])
+        mock_requests_get.assert_called_with(
+            'https://test/url?per_page=100&page=2')
+
+    @mock.patch('preserve.github.client.get')
+    def test_github_api_iter_404(self, mock_requests_get):
+        mock_error = mock.MagicMock()
+        mock_error.status_code = 404
+        mock_error.json.return_value = {'message': 'failure'}
+        mock_requests_get.return_value = mock_error
+        with self.assertRaises(GitHubError):
+            list(github_api_iter('https://test/url'))
+
+    @mock.patch('preserve.github.client.get')
     def test_github_api_all_404(self, mock_requests_get):
         """ github_api_all uses the Link header in a GitHub API reasponse to
             get all paginated results for a query before returning. """
@@ -90,12 +248,72 @@ class GitHubTestCase(TestCase):
     @mock.patch('preserve.github.github_api_all')
     def test_list_repositories(self, mock_github_api_all):
         mock_github_api_all.return_value = [
-            {'name': 'one-repo'},
-            {'name': 'another-repo'},
+            Repository('one-repo'),
+            Repository('another-repo'),
         ]
         result = list_repositories('someorg')
         self.assertIn('one-repo', result)
         self.assertIn('another-repo', result)
+        mock_github_api_all.assert_called_once_with(
+            'https://api.github.com/orgs/someorg/repos',
+            extract=repository_details)
+
+    @mock.patch('preserve.github.client.get')
+    def test_list_repository_details(self, mock_requests_get):
+        """ The listing keeps only the metadata used to skip unchanged
+            repos """
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 200
+        mock_response.links = {}
+        mock_response.json.return_value = [{
+            'name': 'one-repo',
+            'pushed_at': '2011-01-26T19:06:43Z',
+            'updated_at': '2011-01-26T19:14:43Z',
+            'description': 'dropped',
+            'fork': False,
+        }]
+        mock_requests_get.return_value = mock_response
+        result = list_repository_details('someorg')
+        self.assertEqual(result, [Repository(
+            'one-repo', pushed_at='2011-01-26T19:06:43Z',
+            updated_at='2011-01-26T19:14:43Z', fork=False)])
+
+    def test_repository_details(self):
+        repository = repository_details({'name': 'one-repo', 'fork': True,
+                                         'owner': {'login': 'someone'}})
+        self.assertEqual(repository.name, 'one-repo')
+        self.assertIsNone(repository.pushed_at)
+        self.assertTrue(repository.fork)
+        # Records have no __dict__ of their own
+        self.assertFalse(hasattr(repository, '__dict__'))
+
+    @mock.patch('preserve.github.client.get')
+    def test_github_api_all_extract(self, mock_requests_get):
+        """ Each page is converted as it arrives """
+        first_page = refs_response(('refs/heads/master', 'abc'))
+        first_page.links = {
+            'next': {'url': 'https://test/url?per_page=100&page=2'},
+            'last': {'url': 'https://test/url?per_page=100&page=2'},
+        }
+        mock_requests_get.side_effect = [
+            first_page, refs_response(('refs/heads/feature', 'def'))]
+
+        result = github_api_all('https://test/url', extract=ref_details)
+
+        self.assertEqual(result, [Ref('refs/heads/master', 'abc'),
+                                  Ref('refs/heads/feature', 'def')])
+
+    @mock.patch('preserve.github.github_api_iter')
+    def test_iter_repository_details(self, mock_github_api_iter):
+        mock_github_api_iter.return_value = iter([
+            Repository('one-repo', pushed_at='2011-01-26T19:06:43Z'),
+        ])
+        result = iter_repository_details('someorg')
+        self.assertEqual(list(result), [
+            Repository('one-repo', pushed_at='2011-01-26T19:06:43Z')])
+        mock_github_api_iter.assert_called_once_with(
+            'https://api.github.com/orgs/someorg/repos',
+            extract=repository_details)
 
     @mock.patch('preserve.github.github_api_all')
     def test_list_repositories_noorg(self, mock_github_api_all):
@@ -103,15 +321,15 @@ class GitHubTestCase(TestCase):
         mock_github_api_all.side_effect = [
             None,
             [
-                {'name': 'one-repo'},
-                {'name': 'another-repo'},
+                Repository('one-repo'),
+                Repository('another-repo'),
             ]
         ]
         result = list_repositories('someone')
         self.assertIn('one-repo', result)
         self.assertIn('another-repo', result)
 
-    @mock.patch('requests.get')
+    @mock.patch('preserve.github.client.get')
     def test_fork_exists(self, mock_requests_get):
         """ Test when a matching fork exists """
         existing = mock.MagicMock()
@@ -122,7 +340,7 @@ class GitHubTestCase(TestCase):
         result = fork_exists('someone', 'one-repo', 'myorg')
         self.assertTrue(result)
 
-    @mock.patch('requests.get')
+    @mock.patch('preserve.github.client.get')
     def test_fork_exists_not_fork(self, mock_requests_get):
         """ Test when a repo exists that's not a fork"""
         existing = mock.MagicMock()
@@ -133,7 +351,7 @@ class GitHubTestCase(TestCase):
         with self.assertRaises(GitHubError):
             fork_exists('someone', 'one-repo', 'myorg')
 
-    @mock.patch('requests.get')
+    @mock.patch('preserve.github.client.get')
     def test_fork_exists_doesnt(self, mock_requests_get):
         """ Test a fork doesn't exist """
         existing = mock.MagicMock()
@@ -143,20 +361,25 @@ class GitHubTestCase(TestCase):
         result = fork_exists('someone', 'one-repo', 'myorg')
         self.assertFalse(result)
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
+    @mock.patch('preserve.github.client.get')
+    @mock.patch('preserve.github.client.post')
     def test_fork_repository(self, mock_requests_post, mock_requests_get):
         """ Test our GitHub API call to fork """
         fork_response = mock.MagicMock()
         fork_response.status_code = 202
-        fork_response.json.return_value = {'message': 'Failed'}
+        fork_response.json.return_value = {'name': 'someone_one-repo'}
         mock_requests_post.return_value = fork_response
 
-        result = fork_repository('someone', 'one-repo', 'myorg')
+        result = fork_repository('someone', 'one-repo', 'myorg',
+                                 name='someone_one-repo')
 
-        self.assertTrue(result)
+        self.assertEqual(result, 'someone_one-repo')
+        mock_requests_post.assert_called_with(
+            'https://api.github.com/repos/someone/one-repo/forks',
+            data=json.dumps({'organization': 'myorg',
+                             'name': 'someone_one-repo'}))
 
-    @mock.patch('requests.post')
+    @mock.patch('preserve.github.client.post')
     def test_fork_repository_failure(self, mock_requests_post):
         """ Test our GitHub API call to fork """
         fork_response = mock.MagicMock()
@@ -167,7 +390,21 @@ class GitHubTestCase(TestCase):
         with self.assertRaises(GitHubError):
             fork_repository('someone', 'one-repo', 'myorg')
 
-    @mock.patch('requests.post')
+    @mock.patch('preserve.github.client.get')
+    def test_fork_ready(self, mock_requests_get):
+        """ A fork is ready once its commits can be listed """
+        not_ready = mock.MagicMock()
+        not_ready.status_code = 409
+        ready = mock.MagicMock()
+        ready.status_code = 200
+        mock_requests_get.side_effect = [not_ready, ready]
+
+        self.assertFalse(fork_ready('myorg', 'one-repo'))
+        self.assertTrue(fork_ready('myorg', 'one-repo'))
+        mock_requests_get.assert_called_with(
+            'https://api.github.com/repos/myorg/one-repo/commits?per_page=1')
+
+    @mock.patch('preserve.github.client.post')
     def test_rename_repository(self, mock_requests_post):
         """ Test renaming repository """
         edit_response = mock.MagicMock()
@@ -178,7 +415,7 @@ class GitHubTestCase(TestCase):
 
         self.assertTrue(result)
 
-    @mock.patch('requests.post')
+    @mock.patch('preserve.github.client.post')
     def test_rename_repository_failure(self, mock_requests_post):
         """ Test renaming repository """
         edit_response = mock.MagicMock()
@@ -189,33 +426,42 @@ class GitHubTestCase(TestCase):
         with self.assertRaises(GitHubError):
             rename_repository('myorg', 'one-repo', 'someone_one-repo')
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
-    @mock.patch('requests.patch')
+    @mock.patch('preserve.github.client.get')
+    def test_list_refs(self, mock_requests_get):
+        """ Test that branches and tags are listed by their full names """
+        mock_requests_get.side_effect = [
+            refs_response(('refs/heads/master', 'abc'),
+                          ('refs/heads/gh-pages', 'def')),
+            refs_response(('refs/tags/v1.0', '123')),
+        ]
+
+        self.assertEqual(list_refs('someone', 'one-repo'), {
+            'refs/heads/master': 'abc',
+            'refs/heads/gh-pages': 'def',
+            'refs/tags/v1.0': '123',
+        })
+        mock_requests_get.assert_has_calls([
+            mock.call('https://api.github.com/repos/someone/one-repo/git/matching-refs/heads?per_page=100'),  # noqa
+            mock.call('https://api.github.com/repos/someone/one-repo/git/matching-refs/tags?per_page=100'),  # noqa
+        ])
+
+    @mock.patch('preserve.github.client.get')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
     def test_update_fork_branch_exists_same_sha(self,
                                                 mock_requests_patch,
                                                 mock_requests_post,
                                                 mock_requests_get):
-        """ Test that we don't update a branch if the fork has the same sha """
-        mock_upstream_branches = mock.MagicMock()
-        mock_upstream_branches.status_code = 200
-        mock_upstream_branches.json.return_value = [{
-            "name": "master",
-            "commit": {
-                "sha": "6dcb09b5b57875f334f61aebed695e2e4193db5e",
-            },
-        }]
-        mock_fork_branches = mock.MagicMock()
-        mock_fork_branches.status_code = 200
-        mock_fork_branches.json.return_value = [{
-            "name": "master",
-            "commit": {
-                "sha": "6dcb09b5b57875f334f61aebed695e2e4193db5e",
-            },
-        }]
+        """ Test that we don't update a ref if the fork has the same sha """
         mock_requests_get.side_effect = [
-            mock_upstream_branches,
-            mock_fork_branches
+            refs_response(('refs/heads/master',
+                           '6dcb09b5b57875f334f61aebed695e2e4193db5e')),
+            refs_response(('refs/tags/v1.0',
+                           '7fd1a60b01f91b314f59955a4e4d4e80d8edf11d')),
+            refs_response(('refs/heads/master',
+                           '6dcb09b5b57875f334f61aebed695e2e4193db5e')),
+            refs_response(('refs/tags/v1.0',
+                           '7fd1a60b01f91b314f59955a4e4d4e80d8edf11d')),
         ]
 
         # Because the shas are the same, we shouldn't be making any other API
@@ -224,33 +470,21 @@ class GitHubTestCase(TestCase):
         mock_requests_post.assert_not_called()
         mock_requests_patch.assert_not_called()
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
-    @mock.patch('requests.patch')
+    @mock.patch('preserve.github.client.get')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
     def test_update_fork_branch_exists_diff_sha(self,
                                                 mock_requests_patch,
                                                 mock_requests_post,
                                                 mock_requests_get):
-        """ Test that we update a branch if the fork has the same sha """
-        mock_upstream_branches = mock.MagicMock()
-        mock_upstream_branches.status_code = 200
-        mock_upstream_branches.json.return_value = [{
-            "name": "master",
-            "commit": {
-                "sha": "6dcb09b5b57875f334f61aebed695e2e4193db5e",
-            },
-        }]
-        mock_fork_branches = mock.MagicMock()
-        mock_fork_branches.status_code = 200
-        mock_fork_branches.json.return_value = [{
-            "name": "master",
-            "commit": {
-                "sha": "7fd1a60b01f91b314f59955a4e4d4e80d8edf11d",
-            },
-        }]
+        """ Test that we update a branch if the fork has a different sha """
         mock_requests_get.side_effect = [
-            mock_upstream_branches,
-            mock_fork_branches
+            refs_response(('refs/heads/master',
+                           '6dcb09b5b57875f334f61aebed695e2e4193db5e')),
+            refs_response(),
+            refs_response(('refs/heads/master',
+                           '7fd1a60b01f91b314f59955a4e4d4e80d8edf11d')),
+            refs_response(),
         ]
 
         mock_response = mock.MagicMock()
@@ -265,33 +499,21 @@ class GitHubTestCase(TestCase):
                       data='{"sha": "6dcb09b5b57875f334f61aebed695e2e4193db5e"}')  # noqa
         ], any_order=True)
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
-    @mock.patch('requests.patch')
+    @mock.patch('preserve.github.client.get')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
     def test_update_fork_branch_exists_diff_sha_failure(self,
                                                         mock_requests_patch,
                                                         mock_requests_post,
                                                         mock_requests_get):
-        """ Test that we update a branch if the fork has the same sha """
-        mock_upstream_branches = mock.MagicMock()
-        mock_upstream_branches.status_code = 200
-        mock_upstream_branches.json.return_value = [{
-            "name": "master",
-            "commit": {
-                "sha": "6dcb09b5b57875f334f61aebed695e2e4193db5e",
-            },
-        }]
-        mock_fork_branches = mock.MagicMock()
-        mock_fork_branches.status_code = 200
-        mock_fork_branches.json.return_value = [{
-            "name": "master",
-            "commit": {
-                "sha": "7fd1a60b01f91b314f59955a4e4d4e80d8edf11d",
-            },
-        }]
+        """ Test that a failed update of a branch is raised """
         mock_requests_get.side_effect = [
-            mock_upstream_branches,
-            mock_fork_branches
+            refs_response(('refs/heads/master',
+                           '6dcb09b5b57875f334f61aebed695e2e4193db5e')),
+            refs_response(),
+            refs_response(('refs/heads/master',
+                           '7fd1a60b01f91b314f59955a4e4d4e80d8edf11d')),
+            refs_response(),
         ]
 
         mock_response = mock.MagicMock()
@@ -302,28 +524,20 @@ class GitHubTestCase(TestCase):
         with self.assertRaises(GitHubError):
             update_fork('someone', 'one-repo', 'myorg', 'someone_one-repo')
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
-    @mock.patch('requests.patch')
+    @mock.patch('preserve.github.client.get')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
     def test_update_fork_branch_doesnt_exist(self,
                                              mock_requests_patch,
                                              mock_requests_post,
                                              mock_requests_get):
         """ Test that we create a branch if the fork doesn't have it """
-        mock_upstream_branches = mock.MagicMock()
-        mock_upstream_branches.status_code = 200
-        mock_upstream_branches.json.return_value = [{
-            "name": "master",
-            "commit": {
-                "sha": "6dcb09b5b57875f334f61aebed695e2e4193db5e",
-            },
-        }]
-        mock_fork_branches = mock.MagicMock()
-        mock_fork_branches.status_code = 200
-        mock_fork_branches.json.return_value = []
         mock_requests_get.side_effect = [
-            mock_upstream_branches,
-            mock_fork_branches
+            refs_response(('refs/heads/master',
+                           '6dcb09b5b57875f334f61aebed695e2e4193db5e')),
+            refs_response(),
+            refs_response(),
+            refs_response(),
         ]
 
         mock_response = mock.MagicMock()
@@ -336,31 +550,75 @@ class GitHubTestCase(TestCase):
         mock_requests_patch.assert_not_called()
         mock_requests_post.assert_has_calls([
             mock.call('https://api.github.com/repos/myorg/someone_one-repo/git/refs',  # noqa
-                      data='{"sha": "6dcb09b5b57875f334f61aebed695e2e4193db5e"}')  # noqa
+                      data='{"ref": "refs/heads/master", "sha": "6dcb09b5b57875f334f61aebed695e2e4193db5e"}')  # noqa
         ])
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
-    @mock.patch('requests.patch')
+    @mock.patch('preserve.github.client.get')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
+    def test_update_fork_refs(self, mock_requests_patch, mock_requests_post,
+                              mock_requests_get):
+        """ Test that only the given refs are fetched and synced """
+        upstream_ref = mock.MagicMock()
+        upstream_ref.status_code = 200
+        upstream_ref.json.return_value = {'ref': 'refs/heads/feature',
+                                          'object': {'sha': 'abc'}}
+        missing_ref = mock.MagicMock()
+        missing_ref.status_code = 404
+        mock_requests_get.side_effect = [upstream_ref, missing_ref]
+        mock_requests_post.return_value.status_code = 201
+
+        update_fork('someone', 'one-repo', 'myorg', 'someone_one-repo',
+                    refs=['refs/heads/feature'])
+
+        mock_requests_get.assert_has_calls([
+            mock.call('https://api.github.com/repos/someone/one-repo/git/ref/heads/feature'),  # noqa
+            mock.call('https://api.github.com/repos/myorg/someone_one-repo/git/ref/heads/feature'),  # noqa
+        ])
+        mock_requests_patch.assert_not_called()
+        mock_requests_post.assert_called_once_with(
+            'https://api.github.com/repos/myorg/someone_one-repo/git/refs',
+            data='{"ref": "refs/heads/feature", "sha": "abc"}')
+
+    @mock.patch('preserve.github.client.get')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
+    def test_update_fork_tag_doesnt_exist(self,
+                                          mock_requests_patch,
+                                          mock_requests_post,
+                                          mock_requests_get):
+        """ Test that we create a tag if the fork doesn't have it """
+        mock_requests_get.side_effect = [
+            refs_response(('refs/heads/master', 'abc')),
+            refs_response(('refs/tags/v1.0', 'def')),
+            refs_response(('refs/heads/master', 'abc')),
+            refs_response(),
+        ]
+
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 201
+        mock_requests_post.return_value = mock_response
+
+        update_fork('someone', 'one-repo', 'myorg', 'someone_one-repo')
+        mock_requests_patch.assert_not_called()
+        mock_requests_post.assert_called_once_with(
+            'https://api.github.com/repos/myorg/someone_one-repo/git/refs',
+            data='{"ref": "refs/tags/v1.0", "sha": "def"}')
+
+    @mock.patch('preserve.github.client.get')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
     def test_update_fork_branch_doesnt_exist_failure(self,
                                                      mock_requests_patch,
                                                      mock_requests_post,
                                                      mock_requests_get):
-        """ Test that we create a branch if the fork doesn't have it """
-        mock_upstream_branches = mock.MagicMock()
-        mock_upstream_branches.status_code = 200
-        mock_upstream_branches.json.return_value = [{
-            "name": "master",
-            "commit": {
-                "sha": "6dcb09b5b57875f334f61aebed695e2e4193db5e",
-            },
-        }]
-        mock_fork_branches = mock.MagicMock()
-        mock_fork_branches.status_code = 200
-        mock_fork_branches.json.return_value = []
+        """ Test that a failed creation of a branch is raised """
         mock_requests_get.side_effect = [
-            mock_upstream_branches,
-            mock_fork_branches
+            refs_response(('refs/heads/master',
+                           '6dcb09b5b57875f334f61aebed695e2e4193db5e')),
+            refs_response(),
+            refs_response(),
+            refs_response(),
         ]
 
         mock_response = mock.MagicMock()
@@ -370,3 +628,338 @@ class GitHubTestCase(TestCase):
 
         with self.assertRaises(GitHubError):
             update_fork('someone', 'one-repo', 'myorg', 'someone_one-repo')
+
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
+    def test_sync_refs_concurrent(self, mock_requests_patch,
+                                  mock_requests_post):
+        """ A fork's refs are written at once """
+        # Each write waits for the others, so they must be concurrent
+        barrier = threading.Barrier(3, timeout=5)
+        response = mock.MagicMock()
+
+        def write(url, data):
+            barrier.wait()
+            response.status_code = 201 if url.endswith('/refs') else 200
+            return response
+
+        mock_requests_patch.side_effect = write
+        mock_requests_post.side_effect = write
+
+        sync_refs('myorg', 'someone_one-repo',
+                  {'refs/heads/master': 'abc', 'refs/heads/one': 'def',
+                   'refs/tags/two': '123'},
+                  {'refs/heads/master': 'old', 'refs/heads/one': 'old'})
+
+        self.assertEqual(mock_requests_patch.call_count, 2)
+        self.assertEqual(mock_requests_post.call_count, 1)
+
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
+    def test_sync_refs_failures(self, mock_requests_patch,
+                                mock_requests_post):
+        """ Every ref is tried, and all of the failures reported """
+        def patch(url, data):
+            response = mock.MagicMock()
+            response.status_code = 200
+            if url.endswith('/broken'):
+                response.status_code = 422
+                response.json.return_value = {'message': 'Not a commit'}
+            return response
+
+        mock_requests_patch.side_effect = patch
+        failed = mock.MagicMock()
+        failed.status_code = 422
+        failed.json.return_value = {'message': 'Reference already exists'}
+        mock_requests_post.return_value = failed
+        state = StateStore(':memory:')
+
+        with self.assertRaises(RefSyncError) as context:
+            sync_refs('myorg', 'someone_one-repo',
+                      {'refs/heads/master': 'abc', 'refs/heads/broken': 'def',
+                       'refs/tags/new': '123'},
+                      {'refs/heads/master': 'old',
+                       'refs/heads/broken': 'old'},
+                      state=state)
+
+        self.assertEqual(context.exception.failures, {
+            'refs/heads/broken': 'Not a commit',
+            'refs/tags/new': 'Reference already exists',
+        })
+        self.assertIn('2 of 3 refs of myorg/someone_one-repo',
+                      str(context.exception))
+        self.assertIsInstance(context.exception, GitHubError)
+        # The ref that was written is still recorded
+        self.assertEqual(state.refs('myorg', 'someone_one-repo'),
+                         {'refs/heads/master': 'abc'})
+
+    @mock.patch('preserve.github.client.post')
+    def test_list_refs_batch(self, mock_requests_post):
+        """ Refs for many repositories come from one GraphQL query, with
+            follow-up queries only for namespaces with more pages """
+        first_query = mock.MagicMock()
+        first_query.status_code = 200
+        first_query.json.return_value = {'data': {
+            'r0': graphql_refs([('master', 'abc')], cursor='next'),
+            'r1': graphql_refs([('v1.0', '456')]),
+            'r2': graphql_refs([('master', 'def')]),
+            'r3': graphql_refs([]),
+            'r4': None,
+            'r5': None,
+        }}
+        second_query = mock.MagicMock()
+        second_query.status_code = 200
+        second_query.json.return_value = {'data': {
+            'r0': graphql_refs([('gh-pages', '123')]),
+        }}
+        mock_requests_post.side_effect = [first_query, second_query]
+
+        result = list_refs_batch([('someone', 'one-repo'),
+                                  ('myorg', 'someone_one-repo'),
+                                  ('myorg', 'missing')])
+
+        self.assertEqual(result, {
+            ('someone', 'one-repo'): {'refs/heads/master': 'abc',
+                                      'refs/heads/gh-pages': '123',
+                                      'refs/tags/v1.0': '456'},
+            ('myorg', 'someone_one-repo'): {'refs/heads/master': 'def'},
+            ('myorg', 'missing'): None,
+        })
+        self.assertEqual(mock_requests_post.call_count, 2)
+        first_query_data = mock_requests_post.call_args_list[0][1]['data']
+        self.assertIn('refPrefix: \\"refs/tags/\\"', first_query_data)
+        second_query_data = mock_requests_post.call_args[1]['data']
+        self.assertIn('after: \\"next\\"', second_query_data)
+        self.assertNotIn('someone_one-repo', second_query_data)
+        self.assertNotIn('refs/tags/', second_query_data)
+
+    @mock.patch('preserve.github.client.post')
+    def test_list_refs_batch_failure(self, mock_requests_post):
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 401
+        mock_response.json.return_value = {'message': 'Bad credentials'}
+        mock_requests_post.return_value = mock_response
+
+        with self.assertRaises(GitHubError):
+            list_refs_batch([('someone', 'one-repo')])
+
+    @mock.patch('preserve.github.list_refs_batch')
+    @mock.patch('preserve.github.sync_refs')
+    @mock.patch('preserve.github.update_fork')
+    def test_update_forks(self, mock_update_fork, mock_sync_refs,
+                          mock_list_refs_batch):
+        """ Forks are synced from the batch, falling back to REST for
+            repositories GraphQL couldn't resolve """
+        mock_list_refs_batch.return_value = {
+            ('someone', 'one-repo'): {'refs/heads/master': 'abc'},
+            ('myorg', 'someone_one-repo'): {'refs/heads/master': 'def'},
+            ('someone', 'new-repo'): {'refs/heads/master': 'abc'},
+            ('myorg', 'someone_new-repo'): None,
+        }
+
+        update_forks([
+            ('someone', 'one-repo', 'myorg', 'someone_one-repo'),
+            ('someone', 'new-repo', 'myorg', 'someone_new-repo'),
+        ])
+
+        mock_sync_refs.assert_called_once_with(
+            'myorg', 'someone_one-repo', {'refs/heads/master': 'abc'},
+            {'refs/heads/master': 'def'}, state=None)
+        mock_update_fork.assert_called_once_with(
+            'someone', 'new-repo', 'myorg', 'someone_new-repo',
+            state=None, reconcile=False)
+
+    @mock.patch('preserve.github.list_refs_batch')
+    @mock.patch('preserve.github.sync_refs')
+    @mock.patch('preserve.github.logger')
+    def test_update_forks_failure(self, mock_logger, mock_sync_refs,
+                                  mock_list_refs_batch):
+        """ A fork that fails doesn't stop the rest of its batch """
+        mock_list_refs_batch.return_value = {
+            ('someone', 'one-repo'): {'refs/heads/master': 'abc'},
+            ('myorg', 'someone_one-repo'): {'refs/heads/master': 'def'},
+            ('someone', 'two-repo'): {'refs/heads/master': 'abc'},
+            ('myorg', 'someone_two-repo'): {'refs/heads/master': 'def'},
+        }
+        mock_sync_refs.side_effect = [GitHubError('Not Found'), None]
+
+        with self.assertRaises(ForkUpdateError) as context:
+            update_forks([
+                ('someone', 'one-repo', 'myorg', 'someone_one-repo'),
+                ('someone', 'two-repo', 'myorg', 'someone_two-repo'),
+            ])
+
+        self.assertEqual(len(mock_sync_refs.mock_calls), 2)
+        self.assertEqual(context.exception.failures,
+                         {('myorg', 'someone_one-repo'): 'Not Found'})
+        self.assertIn('1 of 2 forks', str(context.exception))
+
+    @mock.patch('preserve.github.update_forks')
+    def test_batch_fork_updater(self, mock_update_forks):
+        """ Forks are updated once a batch fills up and on flush """
+        updater = BatchForkUpdater(batch_size=2)
+        updater('someone', 'one-repo', 'myorg', 'someone_one-repo')
+        mock_update_forks.assert_not_called()
+        updater('someone', 'two-repo', 'myorg', 'someone_two-repo')
+        updater('someone', 'three-repo', 'myorg', 'someone_three-repo')
+        updater.flush()
+        updater.flush()
+
+        mock_update_forks.assert_has_calls([
+            mock.call([('someone', 'one-repo', 'myorg', 'someone_one-repo'),
+                       ('someone', 'two-repo', 'myorg', 'someone_two-repo')],
+                      state=None, reconcile=False),
+            mock.call([('someone', 'three-repo',
+                        'myorg', 'someone_three-repo')],
+                      state=None, reconcile=False),
+        ])
+        self.assertEqual(len(mock_update_forks.mock_calls), 2)
+
+    @mock.patch('preserve.github.update_forks')
+    def test_batch_fork_updater_on_updated(self, mock_update_forks):
+        on_updated = mock.MagicMock()
+        updater = BatchForkUpdater(on_updated=on_updated)
+        updater('someone', 'one-repo', 'myorg', 'someone_one-repo')
+        on_updated.assert_not_called()
+        updater.flush()
+        on_updated.assert_called_once_with(
+            'someone', 'one-repo', 'myorg', 'someone_one-repo')
+
+    @mock.patch('preserve.github.update_forks')
+    def test_batch_fork_updater_failure(self, mock_update_forks):
+        """ Only the forks that were updated are passed to on_updated """
+        mock_update_forks.side_effect = ForkUpdateError(
+            {('myorg', 'someone_one-repo'): 'Not Found'}, 2)
+        on_updated = mock.MagicMock()
+        updater = BatchForkUpdater(on_updated=on_updated)
+        updater('someone', 'one-repo', 'myorg', 'someone_one-repo')
+        updater('someone', 'two-repo', 'myorg', 'someone_two-repo')
+
+        with self.assertRaises(ForkUpdateError):
+            updater.flush()
+        on_updated.assert_called_once_with(
+            'someone', 'two-repo', 'myorg', 'someone_two-repo')
+
+    @mock.patch('preserve.github.list_refs')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
+    def test_update_fork_state(self, mock_requests_patch, mock_requests_post,
+                               mock_list_refs):
+        """ Test that the fork's refs come from the state store """
+        state = StateStore(':memory:')
+        state.replace_refs('myorg', 'someone_one-repo',
+                           {'refs/heads/master': 'abc',
+                            'refs/heads/old': '123'})
+        mock_list_refs.return_value = {'refs/heads/master': 'def',
+                                       'refs/heads/old': '123'}
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 200
+        mock_requests_patch.return_value = mock_response
+
+        update_fork('someone', 'one-repo', 'myorg', 'someone_one-repo',
+                    state=state)
+
+        # Only the upstream is listed
+        mock_list_refs.assert_called_once_with('someone', 'one-repo')
+        self.assertEqual(mock_requests_patch.call_count, 1)
+        mock_requests_post.assert_not_called()
+        self.assertEqual(state.refs('myorg', 'someone_one-repo'),
+                         {'refs/heads/master': 'def', 'refs/heads/old': '123'})
+
+    @mock.patch('preserve.github.list_refs')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
+    def test_update_fork_state_unknown(self, mock_requests_patch,
+                                       mock_requests_post,
+                                       mock_list_refs):
+        """ Test that a fork missing from the store is listed and recorded """
+        state = StateStore(':memory:')
+        mock_list_refs.side_effect = [
+            {'refs/heads/master': 'abc'},
+            {'refs/heads/master': 'abc'},
+        ]
+
+        update_fork('someone', 'one-repo', 'myorg', 'someone_one-repo',
+                    state=state)
+
+        mock_list_refs.assert_called_with('myorg', 'someone_one-repo')
+        mock_requests_patch.assert_not_called()
+        self.assertEqual(state.refs('myorg', 'someone_one-repo'),
+                         {'refs/heads/master': 'abc'})
+
+    @mock.patch('preserve.github.list_refs')
+    @mock.patch('preserve.github.client.post')
+    @mock.patch('preserve.github.client.patch')
+    @mock.patch('preserve.github.logger')
+    def test_update_fork_state_drift(self, mock_logger, mock_requests_patch,
+                                     mock_requests_post, mock_list_refs):
+        """ Test that a failed write from stale state reconciles and
+            retries """
+        state = StateStore(':memory:')
+        state.replace_refs('myorg', 'someone_one-repo',
+                           {'refs/heads/master': 'abc'})
+        mock_list_refs.side_effect = [
+            {'refs/heads/master': 'def', 'refs/heads/new': '123'},
+            # The fork already has the new branch
+            {'refs/heads/master': 'abc', 'refs/heads/new': '123'},
+        ]
+        already_exists = mock.MagicMock()
+        already_exists.status_code = 422
+        already_exists.json.return_value = {
+            'message': 'Reference already exists'}
+        mock_requests_post.return_value = already_exists
+        updated = mock.MagicMock()
+        updated.status_code = 200
+        mock_requests_patch.return_value = updated
+
+        update_fork('someone', 'one-repo', 'myorg', 'someone_one-repo',
+                    state=state)
+
+        self.assertEqual(mock_requests_post.call_count, 1)
+        self.assertEqual(mock_requests_patch.call_count, 2)
+        self.assertEqual(mock_logger.warning.call_count, 1)
+        self.assertEqual(state.refs('myorg', 'someone_one-repo'),
+                         {'refs/heads/master': 'def', 'refs/heads/new': '123'})
+
+    @mock.patch('preserve.github.list_refs')
+    def test_update_fork_state_reconcile(self, mock_list_refs):
+        """ Test that reconcile refreshes the store from GitHub """
+        state = StateStore(':memory:')
+        state.replace_refs('myorg', 'someone_one-repo',
+                           {'refs/heads/master': 'old'})
+        mock_list_refs.side_effect = [
+            {'refs/heads/master': 'abc'},
+            {'refs/heads/master': 'abc'},
+        ]
+
+        update_fork('someone', 'one-repo', 'myorg', 'someone_one-repo',
+                    state=state, reconcile=True)
+
+        self.assertEqual(len(mock_list_refs.mock_calls), 2)
+        self.assertEqual(state.refs('myorg', 'someone_one-repo'),
+                         {'refs/heads/master': 'abc'})
+
+    @mock.patch('preserve.github.github_api_all')
+    def test_destination_index(self, mock_github_api_all):
+        """ The destination org is listed once and looked up in memory """
+        mock_github_api_all.return_value = [
+            Repository('someone_one-repo', fork=True),
+            Repository('someone_not-fork', fork=False),
+        ]
+        index = DestinationIndex('myorg')
+
+        self.assertTrue(fork_exists('someone', 'one-repo', 'myorg',
+                                    fork_name='someone_one-repo',
+                                    index=index))
+        self.assertFalse(fork_exists('someone', 'new-repo', 'myorg',
+                                     fork_name='someone_new-repo',
+                                     index=index))
+        with self.assertRaises(GitHubError):
+            fork_exists('someone', 'not-fork', 'myorg',
+                        fork_name='someone_not-fork', index=index)
+
+        index.add('someone_new-repo')
+        self.assertTrue(index.fork_exists('someone_new-repo'))
+        mock_github_api_all.assert_called_once_with(
+            'https://api.github.com/orgs/myorg/repos',
+            extract=repository_details)
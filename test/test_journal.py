@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import Future
+from unittest import TestCase
+from unittest import mock
+
+from preserve.github import GitHubClient
+from preserve.journal import Journal
+from preserve.orgs import preserve_organization
+from preserve.testing import FakeGitHub, FakeGitHubServer
+
+
+class JournalTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.journal_path = os.path.join(self.path, 'run.jsonl')
+
+    def read(self):
+        with open(self.journal_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_record(self):
+        journal = Journal(self.journal_path, clock=lambda: 1000)
+        journal.record('someone', 'one-repo', 'myorg', 'start')
+        journal.record('someone', 'one-repo', 'myorg', 'done',
+                       outcome='updated')
+
+        self.assertEqual(self.read(), [
+            {'time': 1000, 'org': 'someone', 'repository': 'one-repo',
+             'dest_org': 'myorg', 'event': 'start'},
+            {'time': 1000, 'org': 'someone', 'repository': 'one-repo',
+             'dest_org': 'myorg', 'event': 'done', 'outcome': 'updated'},
+        ])
+        self.assertTrue(journal.done('someone', 'one-repo', 'myorg'))
+
+    def test_resume(self):
+        journal = Journal(self.journal_path)
+        journal.record('someone', 'one-repo', 'myorg', 'done')
+        journal.record('someone', 'new-repo', 'myorg', 'forked')
+        journal.close()
+        # The run died while writing a line
+        with open(self.journal_path, 'a') as f:
+            f.write('{"org": "some')
+
+        journal = Journal(self.journal_path, resume=True)
+
+        self.assertTrue(journal.done('someone', 'one-repo', 'myorg'))
+        self.assertEqual(journal.stage('someone', 'new-repo', 'myorg'),
+                         'forked')
+        self.assertIsNone(journal.stage('someone', 'new-repo', 'another'))
+
+    def test_no_resume(self):
+        """ Without resume, a new run starts a new journal """
+        journal = Journal(self.journal_path)
+        journal.record('someone', 'one-repo', 'myorg', 'done')
+        journal.close()
+
+        journal = Journal(self.journal_path)
+        self.assertIsNone(journal.stage('someone', 'one-repo', 'myorg'))
+        self.assertEqual(self.read(), [])
+
+    def test_finish(self):
+        journal = Journal(self.journal_path)
+        journal.finish('someone', 'failed-repo', 'myorg', 'failed')
+        future = Future()
+        journal.finish('someone', 'new-repo', 'myorg', future)
+        self.assertIsNone(journal.stage('someone', 'new-repo', 'myorg'))
+
+        future.set_result('forked')
+
+        self.assertIsNone(journal.stage('someone', 'failed-repo', 'myorg'))
+        self.assertTrue(journal.done('someone', 'new-repo', 'myorg'))
+
+
+class ResumeTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.journal_path = os.path.join(self.path, 'run.jsonl')
+
+        self.fake = FakeGitHub()
+        self.server = FakeGitHubServer(self.fake).start()
+        self.addCleanup(self.server.stop)
+        for patcher in [
+                mock.patch('preserve.github.GITHUB_API_URL', self.server.url),
+                mock.patch('preserve.github.client',
+                           GitHubClient(headers={})),
+                mock.patch('preserve.orgs.logger')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_resume(self):
+        """ A resumed run only does the work that is left """
+        names = ('done-repo', 'forked-repo', 'upstream-repo', 'missing-repo',
+                 'new-repo')
+        for name in names:
+            self.fake.add_repository('someone', name,
+                                     branches={'master': 'abc'})
+        # The interrupted run had asked for three forks: one was made under
+        # its final name, one under its upstream's name by an older version,
+        # and one never got made at all
+        self.fake.add_repository('myorg', 'someone_forked-repo',
+                                 branches={'master': 'abc'}, fork=True)
+        self.fake.create_fork(query={'org': 'myorg'}, data={},
+                              owner='someone', repo='upstream-repo')
+        journal = Journal(self.journal_path)
+        journal.record('someone', 'done-repo', 'myorg', 'done')
+        for name in ('forked-repo', 'upstream-repo', 'missing-repo'):
+            journal.record('someone', name, 'myorg', 'forked')
+        journal.close()
+
+        journal = Journal(self.journal_path, resume=True)
+        outcomes = preserve_organization('someone', 'myorg', journal=journal)
+
+        self.assertEqual(outcomes, ['skipped'] + ['forked'] * 4)
+        # The forks that weren't found under their final name were asked for
+        # again, and only the one under its upstream's name was renamed
+        self.assertEqual(self.fake.requests[('POST', 'create_fork')], 3)
+        self.assertEqual(self.fake.requests[('POST', 'edit_repository')], 1)
+        for name in names[1:]:
+            self.assertEqual(self.fake.branches('myorg', 'someone_' + name),
+                             {'master': 'abc'})
+        self.assertIsNone(self.fake.repository('myorg', 'upstream-repo'))
+        for name in names:
+            self.assertTrue(journal.done('someone', name, 'myorg'))
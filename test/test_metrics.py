@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+import requests
+
+from preserve.cache import ResponseCache
+from preserve.github import GitHubClient, list_repositories
+from preserve.metrics import Metrics, endpoint, write_atomically
+from preserve.testing import FakeGitHub, FakeGitHubServer
+
+
+def make_response(status_code, content=b'', remaining=None, reset=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    if remaining is not None:
+        response.headers['X-RateLimit-Remaining'] = str(remaining)
+        response.headers['X-RateLimit-Reset'] = str(reset)
+    return response
+
+
+class EndpointTestCase(TestCase):
+
+    def test_endpoint(self):
+        base = 'https://api.github.com'
+        self.assertEqual(endpoint(base + '/orgs/someone/repos?per_page=100'),
+                         '/orgs/{org}/repos')
+        self.assertEqual(endpoint(base + '/users/someone/repos'),
+                         '/users/{user}/repos')
+        self.assertEqual(endpoint(base + '/repos/someone/one-repo'),
+                         '/repos/{owner}/{repo}')
+        self.assertEqual(endpoint(base + '/repos/someone/one-repo/forks'
+                                         '?org=myorg'),
+                         '/repos/{owner}/{repo}/forks')
+        self.assertEqual(endpoint(base + '/repos/someone/one-repo/git/refs'),
+                         '/repos/{owner}/{repo}/git/refs')
+        self.assertEqual(endpoint(base + '/repos/someone/one-repo/git/refs/'
+                                         'heads/feature/x'),
+                         '/repos/{owner}/{repo}/git/refs/{ref}')
+        self.assertEqual(endpoint(base + '/graphql'), '/graphql')
+
+    def test_endpoint_other_host(self):
+        self.assertEqual(endpoint('http://127.0.0.1:8000/repos/a/b/branches'),
+                         '/repos/{owner}/{repo}/branches')
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 1.0), clock=lambda: 100)
+
+    def test_record_request(self):
+        url = 'https://api.github.com/repos/someone/one-repo'
+        self.metrics.record_request('GET', url, make_response(200, b'{}'),
+                                    0.05)
+        self.metrics.record_request('GET', url, make_response(404, b'{}'),
+                                    0.5)
+        self.metrics.record_request('POST', url, make_response(200), 2.0,
+                                    data='{"name": "x"}')
+        self.metrics.record_retry('POST', url)
+
+        metrics = self.metrics.to_dict()
+        self.assertEqual(metrics['requests'], 3)
+        self.assertEqual(metrics['retries'], 1)
+        self.assertEqual(metrics['bytes_sent'], 13)
+        self.assertEqual(metrics['bytes_received'], 4)
+        get = metrics['endpoints']['GET /repos/{owner}/{repo}']
+        self.assertEqual(get['requests'], {'200': 1, '404': 1})
+        self.assertEqual(get['latency'],
+                         {'buckets': [1, 2], 'sum': 0.55, 'count': 2})
+        post = metrics['endpoints']['POST /repos/{owner}/{repo}']
+        self.assertEqual(post['latency']['buckets'], [0, 0])
+        self.assertEqual(post['retries'], 1)
+
+    def test_rate_limit_used(self):
+        """ Use is counted from the headers, whatever order responses
+            arrive in, and cached responses are free """
+        url = 'https://api.github.com/rate_limit'
+        for remaining in (4998, 4999, 4997):
+            self.metrics.record_request(
+                'GET', url, make_response(200, remaining=remaining,
+                                          reset=1000), 0.1)
+        cached = make_response(200, b'[]', remaining=4997, reset=1000)
+        cached.from_cache = True
+        self.metrics.record_request('GET', url, cached, 0.1)
+
+        # A new window
+        self.metrics.record_request(
+            'GET', url, make_response(200, remaining=4999, reset=5000), 0.1)
+
+        self.assertEqual(self.metrics.rate_limit_used, {'core': 4})
+        self.assertEqual(self.metrics.rate_limit_remaining, {'core': 4999})
+        self.assertEqual(self.metrics.cache_hits, 1)
+        self.assertEqual(
+            self.metrics.to_dict()['endpoints']['GET /rate_limit'][
+                'requests'], {'200': 4, '304': 1})
+
+    def test_rate_limit_resources(self):
+        """ GraphQL use is counted apart from the core limit's, in windows
+            of its own """
+        base = 'https://api.github.com'
+        for url, remaining in [('/rate_limit', 4998),
+                               ('/graphql', 4990),
+                               ('/rate_limit', 4997),
+                               ('/graphql', 4980)]:
+            self.metrics.record_request(
+                'GET', base + url, make_response(200, remaining=remaining,
+                                                 reset=1000), 0.1)
+
+        self.assertEqual(self.metrics.rate_limit_used,
+                         {'core': 2, 'graphql': 11})
+        self.assertEqual(self.metrics.rate_limit_remaining,
+                         {'core': 4997, 'graphql': 4980})
+        lines = self.metrics.to_prometheus().splitlines()
+        self.assertIn('preserve_github_rate_limit_used{resource="graphql"} 11',
+                      lines)
+        self.assertIn('preserve_github_rate_limit_remaining{'
+                      'resource="core"} 4997', lines)
+
+    def test_to_prometheus(self):
+        url = 'https://api.github.com/repos/someone/one-repo'
+        self.metrics.record_request('GET', url, make_response(200), 0.5)
+        self.metrics.record_outcomes(['forked', 'updated', 'updated'])
+
+        lines = self.metrics.to_prometheus().splitlines()
+
+        self.assertIn('# TYPE preserve_github_requests_total counter', lines)
+        self.assertIn('preserve_github_requests_total{method="GET",'
+                      'endpoint="/repos/{owner}/{repo}",status="200"} 1',
+                      lines)
+        self.assertIn('preserve_github_request_duration_seconds_bucket{'
+                      'method="GET",endpoint="/repos/{owner}/{repo}",'
+                      'le="0.1"} 0', lines)
+        self.assertIn('preserve_github_request_duration_seconds_bucket{'
+                      'method="GET",endpoint="/repos/{owner}/{repo}",'
+                      'le="+Inf"} 1', lines)
+        self.assertIn('preserve_github_request_duration_seconds_sum{'
+                      'method="GET",endpoint="/repos/{owner}/{repo}"} 0.5',
+                      lines)
+        self.assertIn('preserve_repositories_total{outcome="updated"} 2',
+                      lines)
+
+    def test_write(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.metrics.record_outcomes(['skipped'])
+
+        self.metrics.write_json(os.path.join(path, 'metrics.json'))
+        self.metrics.write_prometheus(os.path.join(path, 'metrics.prom'))
+
+        self.assertEqual(sorted(os.listdir(path)),
+                         ['metrics.json', 'metrics.prom'])
+        with open(os.path.join(path, 'metrics.json')) as f:
+            self.assertEqual(json.load(f)['outcomes'], {'skipped': 1})
+
+    def test_write_concurrently(self):
+        """ Runs writing the same file never share a temporary file """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        metrics_path = os.path.join(path, 'metrics.json')
+        temporary_paths = []
+        replace = os.replace
+
+        def interleave(source, destination):
+            # Another run writes its metrics before this one's are in place
+            temporary_paths.append(source)
+            if len(temporary_paths) == 1:
+                write_atomically(metrics_path, 'second\n')
+            replace(source, destination)
+
+        with mock.patch('preserve.metrics.os.replace', interleave):
+            write_atomically(metrics_path, 'first\n')
+
+        self.assertNotEqual(temporary_paths[0], temporary_paths[1])
+        self.assertEqual(os.listdir(path), ['metrics.json'])
+        with open(metrics_path) as f:
+            self.assertEqual(f.read(), 'first\n')
+
+
+class MetricsClientTestCase(TestCase):
+
+    def test_client_records_requests(self):
+        """ Every request the client makes is recorded """
+        fake = FakeGitHub()
+        for i in range(150):
+            fake.add_repository('someone', 'repo-{:03d}'.format(i))
+        cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_path)
+        metrics = Metrics()
+        client = GitHubClient(headers={}, cache=ResponseCache(cache_path),
+                              metrics=metrics)
+
+        with FakeGitHubServer(fake) as server, \
+                mock.patch('preserve.github.GITHUB_API_URL', server.url), \
+                mock.patch('preserve.github.client', client):
+            list_repositories('someone')
+            list_repositories('someone')
+
+        listing = metrics.to_dict()['endpoints']['GET /orgs/{org}/repos']
+        self.assertEqual(listing['requests'], {'200': 2, '304': 2})
+        self.assertEqual(listing['latency']['count'], 4)
+        self.assertEqual(metrics.rate_limit_used, {'core': 2})
+        self.assertEqual(metrics.cache_hits, 2)
+        self.assertGreater(metrics.bytes_received, 0)
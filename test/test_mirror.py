@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+from preserve.github import Repository
+from preserve.mirror import (
+    mirror_lock,
+    mirror_organization,
+    mirror_organizations,
+    mirror_path,
+    mirror_repository,
+    run_git,
+)
+
+
+def repositories(*names):
+    return [Repository(name) for name in names]
+
+
+class MirrorTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.upstreams = os.path.join(self.path, 'upstreams')
+        self.git_url = 'file://' + self.upstreams
+        self.mirror_dir = os.path.join(self.path, 'mirrors')
+        self.work = os.path.join(self.path, 'work')
+
+        logger_patcher = mock.patch('preserve.mirror.logger')
+        logger_patcher.start()
+        self.addCleanup(logger_patcher.stop)
+
+    def add_upstream(self, org, repo):
+        """ Create a bare upstream with a commit on master, and a work tree
+            to push more to it from """
+        upstream = os.path.join(self.upstreams, org, repo + '.git')
+        run_git(['init', '--quiet', '--bare', upstream])
+        work = os.path.join(self.work, org, repo)
+        run_git(['init', '--quiet', work])
+        run_git(['remote', 'add', 'origin', upstream], cwd=work)
+        self.commit(work, 'master')
+        return work
+
+    def commit(self, work, branch):
+        run_git(['checkout', '--quiet', '-B', branch], cwd=work)
+        run_git(['-c', 'user.name=Someone', '-c', 'user.email=s@example.com',
+                 'commit', '--quiet', '--allow-empty', '-m', branch],
+                cwd=work)
+        run_git(['push', '--quiet', '--force', 'origin', branch], cwd=work)
+        return run_git(['rev-parse', 'HEAD'], cwd=work).strip()
+
+    def refs(self, org, repo):
+        output = run_git(['for-each-ref', '--format=%(refname) %(objectname)'],
+                         cwd=mirror_path(self.mirror_dir, org, repo))
+        return dict(line.split() for line in output.splitlines())
+
+    def test_mirror_repository(self):
+        """ A new repository is cloned, then refreshed, pruning refs that
+            the upstream has deleted """
+        work = self.add_upstream('someone', 'one-repo')
+        old = self.commit(work, 'old')
+        repository, = repositories('one-repo')
+
+        self.assertEqual(mirror_repository('someone', repository,
+                                           self.mirror_dir,
+                                           git_url=self.git_url), 'cloned')
+        master = run_git(['rev-parse', 'master'], cwd=work).strip()
+        self.assertEqual(self.refs('someone', 'one-repo'),
+                         {'refs/heads/master': master,
+                          'refs/heads/old': old})
+
+        feature = self.commit(work, 'feature')
+        run_git(['tag', 'v1.0'], cwd=work)
+        run_git(['push', '--quiet', 'origin', 'v1.0'], cwd=work)
+        run_git(['push', '--quiet', 'origin', ':old'], cwd=work)
+
+        self.assertEqual(mirror_repository('someone', repository,
+                                           self.mirror_dir,
+                                           git_url=self.git_url), 'updated')
+        self.assertEqual(self.refs('someone', 'one-repo'),
+                         {'refs/heads/master': master,
+                          'refs/heads/feature': feature,
+                          'refs/tags/v1.0': feature})
+
+    def test_mirror_repository_failure(self):
+        """ A clone that fails leaves nothing behind """
+        repository, = repositories('missing')
+        self.assertEqual(mirror_repository('someone', repository,
+                                           self.mirror_dir,
+                                           git_url=self.git_url), 'failed')
+        self.assertEqual(os.listdir(os.path.join(self.mirror_dir, 'someone')),
+                         ['missing.git.lock'])
+
+    def test_mirror_repository_locked(self):
+        """ A mirror being refreshed elsewhere is skipped """
+        self.add_upstream('someone', 'one-repo')
+        repository, = repositories('one-repo')
+        path = mirror_path(self.mirror_dir, 'someone', 'one-repo')
+
+        with mirror_lock(path) as locked:
+            self.assertTrue(locked)
+            self.assertEqual(mirror_repository('someone', repository,
+                                               self.mirror_dir,
+                                               git_url=self.git_url),
+                             'skipped')
+        self.assertFalse(os.path.exists(path))
+
+    @mock.patch('preserve.mirror.list_repository_details')
+    def test_mirror_organization(self, mock_list_repository_details):
+        for repo in ('one-repo', 'two-repo', 'three-repo'):
+            self.add_upstream('someone', repo)
+        mock_list_repository_details.return_value = repositories(
+            'one-repo', 'two-repo', 'three-repo')
+        mirror_repository('someone', Repository('two-repo'), self.mirror_dir,
+                          git_url=self.git_url)
+
+        outcomes = mirror_organization('someone', self.mirror_dir,
+                                       workers=2, git_url=self.git_url)
+
+        self.assertEqual(outcomes, ['cloned', 'updated', 'cloned'])
+        mock_list_repository_details.assert_called_once_with('someone')
+
+    @mock.patch('preserve.orgs.iter_repository_details')
+    @mock.patch('preserve.orgs.logger')
+    def test_mirror_organizations(self, mock_orgs_logger,
+                                  mock_iter_repository_details):
+        self.add_upstream('someone', 'one-repo')
+        self.add_upstream('another', 'two-repo')
+        names = {'someone': 'one-repo', 'another': 'two-repo'}
+        mock_iter_repository_details.side_effect = (
+            lambda org: iter(repositories(names[org])))
+
+        results = mirror_organizations(['someone', 'another'],
+                                       self.mirror_dir, workers=2,
+                                       git_url=self.git_url)
+
+        self.assertEqual(results, {'someone': ['cloned'],
+                                   'another': ['cloned']})
@@ -1,15 +1,36 @@
 # -*- coding: utf-8 -*-
+import functools
 from unittest import TestCase
 from unittest import mock
 
+from preserve.forks import ForkPipeline
+from preserve.github import (
+    DestinationIndex,
+    GitHubClient,
+    GitHubError,
+    Repository,
+    pool_size,
+)
 from preserve.orgs import (
+    group_by_org,
+    interleave_organizations,
+    map_bounded,
     preserve_organization,
+    preserve_organizations,
 )
+from preserve.state import StateStore
+from preserve.testing import FakeGitHub, FakeGitHubServer
+
+
+def upstream_name(org, repo, dest_org, name=None):
+    """ Fork a repository as GitHub does when the org already has a fork of
+        it under the upstream's name """
+    return repo
 
 
 class TestCommandLine(TestCase):
 
-    @mock.patch('preserve.orgs.list_repositories')
+    @mock.patch('preserve.orgs.list_repository_details')
     @mock.patch('preserve.orgs.fork_exists')
     @mock.patch('preserve.orgs.fork_repository')
     @mock.patch('preserve.orgs.rename_repository')
@@ -17,22 +38,24 @@ class TestCommandLine(TestCase):
     @mock.patch('preserve.orgs.logger')
     def test_preserve_organization_no_fork(
             self, mock_logger, mock_update_fork, mock_rename_repository,
-            mock_fork_repository, mock_fork_exists, mock_list_repositories):
+            mock_fork_repository, mock_fork_exists,
+            mock_list_repository_details):
         """ Test preserving an org when no fork exists """
-        mock_list_repositories.return_value = ['one-rep']
+        mock_list_repository_details.return_value = [
+            Repository('one-rep')]
         mock_fork_exists.return_value = False
-        mock_fork_repository.return_value = True
-        mock_rename_repository.return_value = True
+        mock_fork_repository.return_value = 'someone_one-rep'
 
-        preserve_organization('someone', 'myorg')
+        result = preserve_organization('someone', 'myorg')
 
+        self.assertEqual(result, ['forked'])
         mock_fork_repository.assert_called_with(
-            'someone', 'one-rep', 'myorg')
-        mock_rename_repository.assert_called_with(
-            'myorg', 'one-rep', 'someone_one-rep')
+            'someone', 'one-rep', 'myorg', name='someone_one-rep')
+        # The fork was made under its final name
+        mock_rename_repository.assert_not_called()
         mock_update_fork.assert_not_called()
 
-    @mock.patch('preserve.orgs.list_repositories')
+    @mock.patch('preserve.orgs.list_repository_details')
     @mock.patch('preserve.orgs.fork_exists')
     @mock.patch('preserve.orgs.fork_repository')
     @mock.patch('preserve.orgs.rename_repository')
@@ -40,22 +63,24 @@ class TestCommandLine(TestCase):
     @mock.patch('preserve.orgs.logger')
     def test_preserve_organization_no_fork_fork_failed(
             self, mock_logger, mock_update_fork, mock_rename_repository,
-            mock_fork_repository, mock_fork_exists, mock_list_repositories):
+            mock_fork_repository, mock_fork_exists,
+            mock_list_repository_details):
         """ Test preserving an org when no fork exists """
-        mock_list_repositories.return_value = ['one-rep']
+        mock_list_repository_details.return_value = [
+            Repository('one-rep')]
         mock_fork_exists.return_value = False
         mock_fork_repository.return_value = False
 
         preserve_organization('someone', 'myorg')
 
         mock_fork_repository.assert_called_with(
-            'someone', 'one-rep', 'myorg')
+            'someone', 'one-rep', 'myorg', name='someone_one-rep')
         mock_rename_repository.assert_not_called()
         mock_update_fork.assert_not_called()
 
         self.assertEqual(len(mock_logger.error.mock_calls), 1)
 
-    @mock.patch('preserve.orgs.list_repositories')
+    @mock.patch('preserve.orgs.list_repository_details')
     @mock.patch('preserve.orgs.fork_exists')
     @mock.patch('preserve.orgs.fork_repository')
     @mock.patch('preserve.orgs.rename_repository')
@@ -63,24 +88,26 @@ class TestCommandLine(TestCase):
     @mock.patch('preserve.orgs.logger')
     def test_preserve_organization_no_fork_rename_failed(
             self, mock_logger, mock_update_fork, mock_rename_repository,
-            mock_fork_repository, mock_fork_exists, mock_list_repositories):
+            mock_fork_repository, mock_fork_exists,
+            mock_list_repository_details):
         """ Test preserving an org when no fork exists """
-        mock_list_repositories.return_value = ['one-rep']
+        mock_list_repository_details.return_value = [
+            Repository('one-rep')]
         mock_fork_exists.return_value = False
-        mock_fork_repository.return_value = True
+        mock_fork_repository.side_effect = upstream_name
         mock_rename_repository.return_value = False
 
         preserve_organization('someone', 'myorg')
 
         mock_fork_repository.assert_called_with(
-            'someone', 'one-rep', 'myorg')
+            'someone', 'one-rep', 'myorg', name='someone_one-rep')
         mock_rename_repository.assert_called_with(
             'myorg', 'one-rep', 'someone_one-rep')
         mock_update_fork.assert_not_called()
 
         self.assertEqual(len(mock_logger.error.mock_calls), 1)
 
-    @mock.patch('preserve.orgs.list_repositories')
+    @mock.patch('preserve.orgs.list_repository_details')
     @mock.patch('preserve.orgs.fork_exists')
     @mock.patch('preserve.orgs.fork_repository')
     @mock.patch('preserve.orgs.rename_repository')
@@ -88,8 +115,10 @@ class TestCommandLine(TestCase):
     @mock.patch('preserve.orgs.logger')
     def test_preserve_organization_fork_exists(
             self, mock_logger, mock_update_fork, mock_rename_repository,
-            mock_fork_repository, mock_fork_exists, mock_list_repositories):
-        mock_list_repositories.return_value = ['one-rep']
+            mock_fork_repository, mock_fork_exists,
+            mock_list_repository_details):
+        mock_list_repository_details.return_value = [
+            Repository('one-rep')]
         mock_fork_exists.return_value = True
 
         preserve_organization('someone', 'myorg')
@@ -98,3 +127,409 @@ class TestCommandLine(TestCase):
         mock_rename_repository.assert_not_called()
         mock_update_fork.assert_called_with(
             'someone', 'one-rep', 'myorg', 'someone_one-rep')
+
+    @mock.patch('preserve.orgs.list_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.fork_repository')
+    @mock.patch('preserve.orgs.rename_repository')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organization_workers(
+            self, mock_logger, mock_update_fork, mock_rename_repository,
+            mock_fork_repository, mock_fork_exists,
+            mock_list_repository_details):
+        """ Test that a concurrent run has the same outcome as a serial one """
+        repositories = [Repository('repo-' + str(i)) for i in range(20)]
+        mock_list_repository_details.return_value = repositories
+        mock_fork_exists.side_effect = lambda org, repo, *a, **kw: (
+            int(repo.split('-')[1]) % 2 == 0)
+        mock_fork_repository.side_effect = upstream_name
+        mock_rename_repository.return_value = True
+
+        serial = preserve_organization('someone', 'myorg')
+        concurrent = preserve_organization('someone', 'myorg', workers=4)
+
+        self.assertEqual(serial, concurrent)
+        self.assertEqual(concurrent[:2], ['updated', 'forked'])
+        self.assertEqual(len(mock_update_fork.mock_calls), 20)
+        self.assertEqual(len(mock_rename_repository.mock_calls), 20)
+
+    @mock.patch('preserve.orgs.list_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organization_workers_error(
+            self, mock_logger, mock_update_fork, mock_fork_exists,
+            mock_list_repository_details):
+        """ Test that errors in a concurrent run are raised """
+        mock_list_repository_details.return_value = [
+            Repository('one-rep'), Repository('two-rep')]
+        mock_fork_exists.return_value = True
+        mock_update_fork.side_effect = [None, GitHubError('failure')]
+
+        with self.assertRaises(GitHubError):
+            preserve_organization('someone', 'myorg', workers=2)
+
+    @mock.patch('preserve.orgs.list_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.github.update_forks')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organization_graphql(
+            self, mock_logger, mock_update_forks, mock_update_fork,
+            mock_fork_exists, mock_list_repository_details):
+        """ Test that existing forks are updated in GraphQL batches """
+        mock_list_repository_details.return_value = [
+            Repository('one-rep'), Repository('two-rep')]
+        mock_fork_exists.return_value = True
+
+        result = preserve_organization('someone', 'myorg', graphql=True)
+
+        self.assertEqual(result, ['updated', 'updated'])
+        mock_update_fork.assert_not_called()
+        mock_update_forks.assert_called_once_with([
+            ('someone', 'one-rep', 'myorg', 'someone_one-rep'),
+            ('someone', 'two-rep', 'myorg', 'someone_two-rep'),
+        ], state=None, reconcile=False)
+
+    @mock.patch('preserve.orgs.list_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.fork_repository')
+    @mock.patch('preserve.orgs.rename_repository')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organization_skip_unchanged(
+            self, mock_logger, mock_update_fork, mock_rename_repository,
+            mock_fork_repository, mock_fork_exists,
+            mock_list_repository_details):
+        """ Test that repos not pushed to since the last sync are skipped """
+        state = StateStore(':memory:')
+        state.record_sync('myorg', 'someone_idle-rep', '2017-01-01T00:00:00Z')
+        state.record_sync('myorg', 'someone_busy-rep', '2017-01-01T00:00:00Z')
+        mock_list_repository_details.return_value = [
+            Repository('idle-rep', pushed_at='2017-01-01T00:00:00Z'),
+            Repository('busy-rep', pushed_at='2017-02-01T00:00:00Z'),
+            Repository('new-rep', pushed_at='2017-02-01T00:00:00Z'),
+        ]
+        mock_fork_exists.side_effect = lambda org, repo, *a, **kw: (
+            repo != 'new-rep')
+        mock_fork_repository.side_effect = upstream_name
+        mock_rename_repository.return_value = True
+
+        result = preserve_organization('someone', 'myorg', state=state)
+
+        self.assertEqual(result, ['skipped', 'updated', 'forked'])
+        mock_update_fork.assert_called_once_with(
+            'someone', 'busy-rep', 'myorg', 'someone_busy-rep',
+            state=state, reconcile=False)
+        self.assertEqual(len(mock_fork_exists.mock_calls), 2)
+        self.assertEqual(state.pushed_at('myorg', 'someone_busy-rep'),
+                         '2017-02-01T00:00:00Z')
+        self.assertEqual(state.pushed_at('myorg', 'someone_new-rep'),
+                         '2017-02-01T00:00:00Z')
+
+    @mock.patch('preserve.orgs.list_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organization_failed_update_not_recorded(
+            self, mock_logger, mock_update_fork, mock_fork_exists,
+            mock_list_repository_details):
+        """ Test that a failed update isn't recorded as a sync """
+        state = StateStore(':memory:')
+        mock_list_repository_details.return_value = [
+            Repository('one-rep', pushed_at='2017-02-01T00:00:00Z')]
+        mock_fork_exists.return_value = True
+        mock_update_fork.side_effect = GitHubError('failure')
+
+        with self.assertRaises(GitHubError):
+            preserve_organization('someone', 'myorg', state=state)
+        self.assertIsNone(state.pushed_at('myorg', 'someone_one-rep'))
+
+    @mock.patch('preserve.orgs.list_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organization_reconcile(
+            self, mock_logger, mock_update_fork, mock_fork_exists,
+            mock_list_repository_details):
+        """ Test that reconcile doesn't skip unchanged repos """
+        state = StateStore(':memory:')
+        state.record_sync('myorg', 'someone_one-rep', '2017-01-01T00:00:00Z')
+        mock_list_repository_details.return_value = [
+            Repository('one-rep', pushed_at='2017-01-01T00:00:00Z')]
+        mock_fork_exists.return_value = True
+
+        result = preserve_organization('someone', 'myorg', state=state,
+                                       reconcile=True)
+
+        self.assertEqual(result, ['updated'])
+        mock_update_fork.assert_called_once_with(
+            'someone', 'one-rep', 'myorg', 'someone_one-rep',
+            state=state, reconcile=True)
+
+    def test_map_bounded(self):
+        """ Test that items are taken only as results are consumed """
+        taken = []
+
+        def items():
+            for i in range(100):
+                taken.append(i)
+                yield i
+
+        results = map_bounded(lambda i: i * 2, items(), 2, 4)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(taken), 5)
+        self.assertEqual(list(results), [i * 2 for i in range(1, 100)])
+
+    def test_map_bounded_error(self):
+        """ Test that the first error stops further items """
+        taken = []
+
+        def items():
+            for i in range(100):
+                taken.append(i)
+                yield i
+
+        def function(i):
+            if i == 3:
+                raise GitHubError('failure')
+            return i
+
+        with self.assertRaises(GitHubError):
+            list(map_bounded(function, items(), 2, 4))
+        self.assertLess(len(taken), 10)
+
+    @mock.patch('preserve.orgs.iter_repository_details')
+    @mock.patch('preserve.orgs.list_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organization_stream(
+            self, mock_logger, mock_update_fork, mock_fork_exists,
+            mock_list_repository_details, mock_iter_repository_details):
+        """ Test that streaming consumes the listing as repos are done """
+        mock_iter_repository_details.return_value = iter(
+            [Repository('repo-' + str(i)) for i in range(10)])
+        mock_fork_exists.return_value = True
+
+        result = preserve_organization('someone', 'myorg', workers=3,
+                                       stream=True)
+
+        self.assertEqual(result, ['updated'] * 10)
+        mock_list_repository_details.assert_not_called()
+        mock_update_fork.assert_any_call(
+            'someone', 'repo-9', 'myorg', 'someone_repo-9')
+
+    @mock.patch('preserve.orgs.list_repository_details')
+    @mock.patch('preserve.orgs.fork_repository')
+    @mock.patch('preserve.orgs.rename_repository')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.github.github_api_all')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organization_index(
+            self, mock_logger, mock_github_api_all, mock_update_fork,
+            mock_rename_repository, mock_fork_repository,
+            mock_list_repository_details):
+        """ Test that forks are looked up in and added to the index """
+        index = DestinationIndex('myorg')
+        mock_github_api_all.return_value = [
+            Repository('someone_one-rep', fork=True)]
+        mock_list_repository_details.return_value = [
+            Repository('one-rep'), Repository('two-rep')]
+        mock_fork_repository.side_effect = upstream_name
+        mock_rename_repository.return_value = True
+
+        result = preserve_organization('someone', 'myorg', index=index)
+
+        self.assertEqual(result, ['updated', 'forked'])
+        self.assertTrue(index.fork_exists('someone_two-rep'))
+        self.assertEqual(mock_github_api_all.call_count, 1)
+
+    @mock.patch('preserve.orgs.list_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.fork_repository')
+    @mock.patch('preserve.orgs.rename_repository')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.forks.fork_ready')
+    @mock.patch('preserve.orgs.ForkPipeline',
+                functools.partial(ForkPipeline, initial_delay=0.001))
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organization_async_forks(
+            self, mock_logger, mock_fork_ready, mock_update_fork,
+            mock_rename_repository, mock_fork_repository, mock_fork_exists,
+            mock_list_repository_details):
+        """ Test that new forks are renamed once they're ready """
+        mock_list_repository_details.return_value = [
+            Repository('one-rep'), Repository('two-rep'),
+            Repository('old-rep')]
+        mock_fork_exists.side_effect = lambda org, repo, *a, **kw: (
+            repo == 'old-rep')
+        mock_fork_repository.side_effect = upstream_name
+        mock_fork_ready.side_effect = [False, True, True]
+        mock_rename_repository.side_effect = [True, False]
+
+        result = preserve_organization('someone', 'myorg', workers=2,
+                                       async_forks=True)
+
+        self.assertEqual(sorted(result[:2]), ['failed', 'forked'])
+        self.assertEqual(result[2], 'updated')
+        self.assertEqual(mock_fork_ready.call_count, 3)
+        mock_rename_repository.assert_any_call(
+            'myorg', 'one-rep', 'someone_one-rep')
+        mock_rename_repository.assert_any_call(
+            'myorg', 'two-rep', 'someone_two-rep')
+
+    def test_group_by_org(self):
+        """ Outcomes are grouped by org in the order they come back """
+        pairs = [('a', 1), ('b', 2), ('a', 3), ('c', 4)]
+
+        result = group_by_org(
+            lambda items: [org + str(item) for org, item in items], pairs)
+
+        self.assertEqual(list(result.items()), [
+            ('a', ['a1', 'a3']), ('b', ['b2']), ('c', ['c4'])])
+
+    @mock.patch('preserve.orgs.iter_repository_details')
+    @mock.patch('preserve.orgs.logger')
+    def test_interleave_organizations(self, mock_logger,
+                                      mock_iter_repository_details):
+        """ Test that repos are taken from the active orgs in turn """
+        listings = {
+            'big': ['b1', 'b2', 'b3', 'b4', 'b5'],
+            'small': ['s1'],
+            'empty': [],
+            'late': ['l1', 'l2'],
+        }
+        mock_iter_repository_details.side_effect = lambda org: iter(
+            [Repository(name) for name in listings[org]])
+
+        result = [(org, repository.name) for org, repository in
+                  interleave_organizations(
+                      ['big', 'small', 'empty', 'late'], active=2)]
+
+        self.assertEqual(result, [
+            ('big', 'b1'), ('small', 's1'), ('big', 'b2'), ('big', 'b3'),
+            ('big', 'b4'), ('late', 'l1'), ('big', 'b5'), ('late', 'l2'),
+        ])
+
+    @mock.patch('preserve.orgs.iter_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organizations_listing_error(
+            self, mock_logger, mock_update_fork, mock_fork_exists,
+            mock_iter_repository_details):
+        """ An org that can't be listed doesn't stop the others """
+        def listing(org):
+            yield Repository(org + '-1')
+            if org == 'gone':
+                raise GitHubError('Not Found')
+            yield Repository(org + '-2')
+
+        mock_iter_repository_details.side_effect = listing
+        mock_fork_exists.return_value = True
+
+        result = preserve_organizations(['a', 'gone', 'c'], 'myorg',
+                                        workers=2)
+
+        self.assertEqual(result, {'a': ['updated', 'updated'],
+                                  'gone': ['updated', 'failed'],
+                                  'c': ['updated', 'updated']})
+        self.assertEqual(mock_logger.error.call_count, 1)
+
+    @mock.patch('preserve.orgs.iter_repository_details')
+    @mock.patch('preserve.orgs.fork_exists')
+    @mock.patch('preserve.orgs.update_fork')
+    @mock.patch('preserve.orgs.logger')
+    def test_preserve_organizations(
+            self, mock_logger, mock_update_fork, mock_fork_exists,
+            mock_iter_repository_details):
+        """ Test preserving many orgs on one pool of workers """
+        mock_iter_repository_details.side_effect = lambda org: iter(
+            [Repository(org + '-' + str(i)) for i in range(3)])
+        mock_fork_exists.return_value = True
+
+        result = preserve_organizations(
+            ('org' + str(i) for i in range(10)), 'myorg', workers=4,
+            active=3)
+
+        self.assertEqual(list(result), ['org' + str(i) for i in range(10)])
+        self.assertEqual(result['org9'], ['updated'] * 3)
+        self.assertEqual(mock_update_fork.call_count, 30)
+        mock_update_fork.assert_any_call(
+            'org9', 'org9-2', 'myorg', 'org9_org9-2')
+
+
+class PreserveServerTestCase(TestCase):
+
+    def setUp(self):
+        self.fake = FakeGitHub()
+        self.server = FakeGitHubServer(self.fake).start()
+        self.addCleanup(self.server.stop)
+        for patcher in [
+                mock.patch('preserve.github.GITHUB_API_URL', self.server.url),
+                mock.patch('preserve.github.client',
+                           GitHubClient(headers={})),
+                mock.patch('preserve.orgs.logger')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_same_name_in_many_orgs(self):
+        """ Repositories of the same name in different orgs, forked at
+            once, each end up in their own fork """
+        orgs = ['org' + str(i) for i in range(4)]
+        for org in orgs:
+            self.fake.add_repository(org, 'docs', branches={'master': org})
+        # Something else already has the upstream name
+        self.fake.add_repository('myorg', 'docs', branches={'master': 'abc'})
+
+        result = preserve_organizations(orgs, 'myorg', workers=4)
+
+        self.assertEqual(result, {org: ['forked'] for org in orgs})
+        for org in orgs:
+            self.assertEqual(self.fake.branches('myorg', org + '_docs'),
+                             {'master': org})
+        self.assertEqual(sorted(name for owner, name in self.fake.repositories
+                                if owner == 'myorg'),
+                         ['docs'] + sorted(org + '_docs' for org in orgs))
+
+    @mock.patch('preserve.orgs.ForkPipeline',
+                functools.partial(ForkPipeline, initial_delay=0.01))
+    def test_same_name_in_many_orgs_async_forks(self):
+        """ New forks are waited for under the name GitHub gave them """
+        self.fake.fork_delay = 0.05
+        orgs = ['org' + str(i) for i in range(4)]
+        for org in orgs:
+            self.fake.add_repository(org, 'docs', branches={'master': org})
+
+        result = preserve_organizations(orgs, 'myorg', workers=4,
+                                        async_forks=True)
+
+        self.assertEqual(result, {org: ['forked'] for org in orgs})
+        for org in orgs:
+            self.assertEqual(self.fake.branches('myorg', org + '_docs'),
+                             {'master': org})
+        self.assertGreaterEqual(self.fake.requests[('GET', 'list_commits')],
+                                len(orgs))
+        self.assertEqual(self.fake.requests[('POST', 'edit_repository')], 0)
+
+    def test_connection_pool(self):
+        """ The pool has room for every worker's concurrent ref writes, so
+            no keep-alive connections are thrown away """
+        branches = {'branch-' + str(i): 'abc' for i in range(20)}
+        for i in range(8):
+            self.fake.add_repository('someone', 'repo-' + str(i),
+                                     branches=branches)
+            self.fake.add_repository('myorg', 'someone_repo-' + str(i),
+                                     branches={}, fork=True)
+        client = GitHubClient(headers={}, pool_size=pool_size(4))
+
+        with mock.patch('preserve.github.client', client), \
+                mock.patch('urllib3.connectionpool.log') as mock_log:
+            result = preserve_organization('someone', 'myorg', workers=4)
+
+        self.assertEqual(result, ['updated'] * 8)
+        self.assertEqual(self.fake.branches('myorg', 'someone_repo-7'),
+                         branches)
+        mock_log.warning.assert_not_called()
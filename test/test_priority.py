@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+from preserve.github import GitHubClient, Repository
+from preserve.priority import (
+    DAY,
+    HOUR,
+    change_rate,
+    parse_timestamp,
+    preserve_by_priority,
+    schedule,
+    tier,
+)
+from preserve.state import StateStore
+from preserve.testing import FakeGitHub, FakeGitHubServer
+
+NOW = parse_timestamp('2017-06-01T00:00:00Z')
+
+
+def repository(name, pushed_at):
+    return Repository(name, pushed_at, pushed_at)
+
+
+class PriorityTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.state = StateStore(os.path.join(self.path, 'state.db'))
+        self.addCleanup(self.state.close)
+
+        logger_patcher = mock.patch('preserve.priority.logger')
+        logger_patcher.start()
+        self.addCleanup(logger_patcher.stop)
+
+    def record_sync(self, repo, pushed_at, synced_at):
+        with mock.patch('preserve.state.time.time', return_value=synced_at):
+            self.state.record_sync('myorg', 'someone_' + repo, pushed_at)
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp('1970-01-02T00:00:00Z'), DAY)
+        self.assertIsNone(parse_timestamp(None))
+
+    def test_change_rate(self):
+        # Pushed to an hour ago, but not observed to change
+        self.assertEqual(change_rate(
+            repository('one-repo', '2017-05-31T23:00:00Z'),
+            {'first_synced_at': NOW - 10 * DAY, 'changes': 0}, NOW),
+            1.0 / HOUR)
+        # Changed five times in the ten days it has been synced
+        self.assertEqual(change_rate(
+            repository('one-repo', '2016-06-01T00:00:00Z'),
+            {'first_synced_at': NOW - 10 * DAY, 'changes': 5}, NOW),
+            0.5 / DAY)
+        self.assertEqual(change_rate(repository('one-repo', None), None,
+                                     NOW), 0.0)
+
+    def test_tier(self):
+        self.assertEqual(tier(1.0 / HOUR), ('hot', DAY))
+        self.assertEqual(tier(0.5 / DAY), ('warm', 7 * DAY))
+        self.assertEqual(tier(1.0 / (20 * DAY)), ('cold', 30 * DAY))
+        self.assertEqual(tier(0.0), ('frozen', 365 * DAY))
+
+    def test_schedule(self):
+        """ New repositories come first, then changed ones by how many
+            changes they are likely to have missed, then stale ones """
+        self.record_sync('quiet-repo', '2016-01-01T00:00:00Z',
+                         NOW - 30 * DAY)
+        self.record_sync('busy-repo', '2017-05-30T00:00:00Z', NOW - DAY)
+        self.record_sync('stale-repo', '2016-01-01T00:00:00Z',
+                         NOW - 400 * DAY)
+        self.record_sync('fresh-repo', '2016-01-01T00:00:00Z', NOW - DAY)
+        repositories = [
+            ('someone', repository('fresh-repo', '2016-01-01T00:00:00Z')),
+            ('someone', repository('stale-repo', '2016-01-01T00:00:00Z')),
+            ('someone', repository('quiet-repo', '2017-05-01T00:00:00Z')),
+            ('someone', repository('busy-repo', '2017-05-31T23:00:00Z')),
+            ('someone', repository('new-repo', '2017-01-01T00:00:00Z')),
+        ]
+
+        scheduled = schedule(repositories, 'myorg', self.state,
+                             clock=lambda: NOW)
+
+        self.assertEqual([r.name for _, r in scheduled],
+                         ['new-repo', 'busy-repo', 'quiet-repo',
+                          'stale-repo'])
+        # The stale repository will be synced even though it is unchanged
+        self.assertIsNone(self.state.pushed_at('myorg',
+                                               'someone_stale-repo'))
+
+    def test_schedule_budget(self):
+        self.record_sync('stale-repo', '2016-01-01T00:00:00Z',
+                         NOW - 400 * DAY)
+        repositories = [
+            ('someone', repository('stale-repo', '2016-01-01T00:00:00Z')),
+            ('someone', repository('one-repo', '2017-01-01T00:00:00Z')),
+            ('someone', repository('two-repo', '2017-01-01T00:00:00Z')),
+        ]
+
+        scheduled = schedule(repositories, 'myorg', self.state, budget=2,
+                             clock=lambda: NOW)
+
+        self.assertEqual([r.name for _, r in scheduled],
+                         ['one-repo', 'two-repo'])
+        # The deferred repository is left as it was
+        self.assertEqual(self.state.pushed_at('myorg', 'someone_stale-repo'),
+                         '2016-01-01T00:00:00Z')
+
+
+class PreserveByPriorityTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.state = StateStore(os.path.join(self.path, 'state.db'))
+        self.addCleanup(self.state.close)
+
+        self.fake = FakeGitHub()
+        self.server = FakeGitHubServer(self.fake).start()
+        self.addCleanup(self.server.stop)
+        for patcher in [
+                mock.patch('preserve.github.GITHUB_API_URL', self.server.url),
+                mock.patch('preserve.github.client',
+                           GitHubClient(headers={})),
+                mock.patch('preserve.orgs.logger'),
+                mock.patch('preserve.priority.logger')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_preserve_by_priority(self):
+        for name in ('one-repo', 'two-repo'):
+            self.fake.add_repository('someone', name,
+                                     branches={'master': 'abc'})
+        self.fake.add_repository('another', 'three-repo',
+                                 branches={'master': 'abc'})
+
+        self.assertEqual(
+            preserve_by_priority(['someone', 'another'], 'myorg',
+                                 self.state),
+            {'someone': ['forked', 'forked'], 'another': ['forked']})
+
+        # Nothing has changed or gone stale
+        self.assertEqual(
+            preserve_by_priority(['someone', 'another'], 'myorg',
+                                 self.state), {})
+
+        self.fake.repository('someone', 'two-repo')['pushed_at'] = (
+            '2017-02-01T00:00:00Z')
+        self.fake.push('someone', 'two-repo', 'refs/heads/master', 'def')
+        self.assertEqual(
+            preserve_by_priority(['someone', 'another'], 'myorg',
+                                 self.state),
+            {'someone': ['updated']})
+        self.assertEqual(self.fake.branches('myorg', 'someone_two-repo'),
+                         {'master': 'def'})
+
+        # A year on, the unchanged repositories are synced again
+        later = self.state.activity('myorg', 'someone_one-repo')[
+            'synced_at'] + 400 * DAY
+        self.assertEqual(
+            preserve_by_priority(['someone', 'another'], 'myorg',
+                                 self.state, budget=2, clock=lambda: later),
+            {'someone': ['updated', 'updated']})
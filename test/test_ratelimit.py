@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+from unittest import mock
+
+import requests
+
+from preserve.github import (
+    GitHubClient,
+)
+from preserve.ratelimit import (
+    CORE,
+    GRAPHQL,
+    RateLimiter,
+    rate_limit_resource,
+)
+
+
+def make_response(status_code, remaining, reset, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update({
+        'X-RateLimit-Limit': '5000',
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Reset': str(reset),
+    })
+    response.headers.update(headers or {})
+    return response
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RateLimiterTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(reserve=10, clock=self.clock,
+                                   sleep=self.clock.sleep)
+
+    def test_no_delay_unknown(self):
+        """ Before any response we don't know the budget, so don't wait """
+        self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_no_delay_plenty_remaining(self):
+        self.limiter.update(make_response(200, 4000, 4600))
+        for i in range(10):
+            self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(self.limiter.windows[CORE].remaining, 3990)
+
+    def test_pacing(self):
+        """ Below the pacing threshold the budget is spread until reset """
+        self.limiter.update(make_response(200, 110, 1100))
+        self.limiter.wait()
+        self.limiter.wait()
+        self.limiter.wait()
+        # 100 usable requests over 100 seconds
+        self.assertEqual(self.clock.sleeps[0], 1.0)
+        self.assertEqual(len(self.clock.sleeps), 2)
+
+    def test_wait_for_reset(self):
+        """ Once only the reserve is left, wait for the reset """
+        self.limiter.update(make_response(200, 10, 1500))
+        self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [501])
+        self.assertIsNone(self.limiter.windows[CORE].remaining)
+
+    def test_resources(self):
+        """ Each resource is paced by its own budget """
+        self.limiter.update(make_response(200, 4900, 2000))
+        self.limiter.update(make_response(200, 5, 4000), GRAPHQL)
+        self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [])
+        self.limiter.wait(GRAPHQL)
+        self.assertEqual(self.clock.sleeps, [3001])
+        self.assertEqual(self.limiter.windows[CORE].remaining, 4899)
+
+    def test_resource_header(self):
+        """ The resource a response names is the one that is tracked """
+        self.limiter.update(make_response(
+            200, 5, 4000, {'X-RateLimit-Resource': 'search'}))
+        self.assertIsNone(self.limiter.windows.get(CORE))
+        self.assertEqual(self.limiter.windows['search'].remaining, 5)
+
+    def test_update_out_of_order(self):
+        """ A late response doesn't raise the remaining budget """
+        self.limiter.update(make_response(200, 100, 1500))
+        self.limiter.update(make_response(200, 105, 1500))
+        self.assertEqual(self.limiter.windows[CORE].remaining, 100)
+        self.limiter.update(make_response(200, 4999, 5100))
+        self.assertEqual(self.limiter.windows[CORE].remaining, 4999)
+
+    def test_retry_after(self):
+        """ Secondary limits give a Retry-After """
+        response = make_response(403, 4000, 4600, {'Retry-After': '60'})
+        self.assertEqual(self.limiter.retry_after(response), 60)
+
+    def test_retry_after_exhausted(self):
+        """ An exhausted primary limit retries after the reset """
+        response = make_response(403, 0, 1100)
+        self.assertEqual(self.limiter.retry_after(response), 101)
+
+    def test_retry_after_not_limited(self):
+        self.assertIsNone(self.limiter.retry_after(
+            make_response(200, 4000, 4600)))
+        self.assertIsNone(self.limiter.retry_after(
+            make_response(403, 4000, 4600)))
+
+    def test_backoff(self):
+        self.limiter.backoff(30)
+        self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [30])
+
+    def test_retry_exhausted(self):
+        """ An exhausted primary limit only holds back its own resource """
+        response = make_response(403, 0, 1100)
+        self.assertEqual(self.limiter.retry(response, GRAPHQL), 101)
+        self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [])
+        self.limiter.wait(GRAPHQL)
+        self.assertEqual(self.clock.sleeps, [101])
+
+    def test_retry_secondary(self):
+        """ A secondary limit holds back every request """
+        response = make_response(403, 4000, 4600, {'Retry-After': '60'})
+        self.assertEqual(self.limiter.retry(response, GRAPHQL), 60)
+        self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [60])
+
+    def test_rate_limit_resource(self):
+        self.assertEqual(rate_limit_resource('https://api.github.com/graphql'),
+                         GRAPHQL)
+        self.assertEqual(rate_limit_resource(
+            'https://api.github.com/orgs/someone/repos?per_page=100'), CORE)
+
+
+class RateLimitedClientTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(clock=self.clock, sleep=self.clock.sleep)
+
+    def test_client_retries(self):
+        """ Rate limited requests are retried after waiting """
+        client = GitHubClient(headers={}, rate_limiter=self.limiter)
+        with mock.patch.object(client.session, 'request') as mock_request:
+            mock_request.side_effect = [
+                make_response(403, 4000, 4600, {'Retry-After': '60'}),
+                make_response(200, 3999, 4600),
+            ]
+            response = client.get('https://test/url')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mock_request.mock_calls), 2)
+        self.assertEqual(self.clock.sleeps, [60])
+        self.assertEqual(self.limiter.windows[CORE].remaining, 3999)
+
+    def test_client_retries_exhausted(self):
+        """ The last rate limited response is returned after max_retries """
+        client = GitHubClient(headers={}, rate_limiter=self.limiter,
+                              max_retries=2)
+        with mock.patch.object(client.session, 'request') as mock_request:
+            mock_request.return_value = make_response(
+                429, 4000, 4600, {'Retry-After': '1'})
+            response = client.get('https://test/url')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(mock_request.mock_calls), 3)
+
+    def test_client_resources(self):
+        """ GraphQL requests are paced by the GraphQL budget alone """
+        client = GitHubClient(headers={}, rate_limiter=self.limiter)
+        with mock.patch.object(client.session, 'request') as mock_request:
+            mock_request.side_effect = [
+                make_response(200, 4900, 2000),
+                make_response(200, 5, 4000),
+                make_response(200, 4899, 2000),
+                make_response(200, 4999, 8000),
+            ]
+            client.get('https://api.github.com/rate_limit')
+            client.post('https://api.github.com/graphql')
+            client.get('https://api.github.com/rate_limit')
+            self.assertEqual(self.clock.sleeps, [])
+            client.post('https://api.github.com/graphql')
+
+        self.assertEqual(self.clock.sleeps, [3001])
+        self.assertEqual(self.limiter.windows[GRAPHQL].remaining, 4999)
+        self.assertEqual(self.limiter.windows[CORE].remaining, 4899)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+from preserve.state import (
+    StateStore,
+)
+
+
+class StateStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_record_sync(self):
+        """ The last synced pushed_at persists between runs """
+        path = os.path.join(self.path, 'nested', 'state.db')
+        state = StateStore(path)
+        self.assertIsNone(state.pushed_at('myorg', 'someone_one-repo'))
+        state.record_sync('myorg', 'someone_one-repo', '2017-01-01T00:00:00Z')
+        state.record_sync('myorg', 'someone_one-repo', '2017-02-01T00:00:00Z')
+        state.close()
+
+        state = StateStore(path)
+        self.assertEqual(state.pushed_at('myorg', 'someone_one-repo'),
+                         '2017-02-01T00:00:00Z')
+        self.assertIsNone(state.pushed_at('otherorg', 'someone_one-repo'))
+        state.close()
+
+    def test_refs(self):
+        """ Ref SHAs are recorded per fork and can be replaced """
+        state = StateStore(os.path.join(self.path, 'state.db'))
+        self.assertIsNone(state.refs('myorg', 'someone_one-repo'))
+
+        state.record_ref('myorg', 'someone_one-repo', 'refs/heads/master',
+                         'abc')
+        state.record_ref('myorg', 'someone_one-repo', 'refs/heads/master',
+                         'def')
+        state.record_ref('myorg', 'someone_one-repo', 'refs/tags/v1.0',
+                         '123')
+        self.assertEqual(state.refs('myorg', 'someone_one-repo'),
+                         {'refs/heads/master': 'def',
+                          'refs/tags/v1.0': '123'})
+
+        state.replace_refs('myorg', 'someone_one-repo',
+                           {'refs/heads/master': '456'})
+        self.assertEqual(state.refs('myorg', 'someone_one-repo'),
+                         {'refs/heads/master': '456'})
+        state.close()
+
+    @mock.patch('preserve.state.time.time')
+    def test_activity(self, mock_time):
+        """ Changes of pushed_at between syncs are counted """
+        state = StateStore(os.path.join(self.path, 'state.db'))
+        self.assertIsNone(state.activity('myorg', 'someone_one-repo'))
+
+        mock_time.return_value = 1000
+        state.record_sync('myorg', 'someone_one-repo', '2017-01-01T00:00:00Z')
+        mock_time.return_value = 2000
+        state.record_sync('myorg', 'someone_one-repo', '2017-01-01T00:00:00Z')
+        state.record_sync('myorg', 'someone_one-repo', '2017-02-01T00:00:00Z')
+        state.expire('myorg', 'someone_one-repo')
+        self.assertIsNone(state.pushed_at('myorg', 'someone_one-repo'))
+        mock_time.return_value = 3000
+        # A sync after expiring isn't a change
+        state.record_sync('myorg', 'someone_one-repo', '2017-02-01T00:00:00Z')
+
+        self.assertEqual(state.activity('myorg', 'someone_one-repo'), {
+            'pushed_at': '2017-02-01T00:00:00Z', 'synced_at': 3000,
+            'first_synced_at': 1000, 'changes': 1})
+        state.close()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+from preserve import github
+from preserve.cache import ResponseCache
+from preserve.github import (
+    DestinationIndex,
+    GitHubClient,
+    GitHubError,
+    fork_ready,
+    list_refs_batch,
+    list_repositories,
+)
+from preserve.orgs import preserve_organization
+from preserve.testing import FakeGitHub, FakeGitHubServer
+
+
+class FakeGitHubServerTestCase(TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.fake = FakeGitHub(clock=lambda: self.now)
+        self.server = FakeGitHubServer(self.fake).start()
+        self.addCleanup(self.server.stop)
+        self.use_client(GitHubClient(headers={}))
+
+        url_patcher = mock.patch('preserve.github.GITHUB_API_URL',
+                                 self.server.url)
+        url_patcher.start()
+        self.addCleanup(url_patcher.stop)
+
+        logger_patcher = mock.patch('preserve.orgs.logger')
+        logger_patcher.start()
+        self.addCleanup(logger_patcher.stop)
+
+    def use_client(self, client):
+        patcher = mock.patch('preserve.github.client', client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_preserve_organization(self):
+        """ New repositories are forked and renamed, and stale forks are
+            brought up to date """
+        self.fake.add_repository('someone', 'new-repo',
+                                 branches={'master': 'abc'})
+        self.fake.add_repository('someone', 'one-repo',
+                                 branches={'master': 'def'},
+                                 tags={'v1.0': 'def'})
+        self.fake.add_repository('myorg', 'someone_one-repo',
+                                 branches={'master': 'old'}, fork=True)
+
+        outcomes = preserve_organization(
+            'someone', 'myorg', workers=2, index=DestinationIndex('myorg'))
+
+        self.assertEqual(outcomes, ['forked', 'updated'])
+        self.assertEqual(self.fake.branches('myorg', 'someone_new-repo'),
+                         {'master': 'abc'})
+        self.assertIsNone(self.fake.repository('myorg', 'new-repo'))
+        self.assertEqual(self.fake.branches('myorg', 'someone_one-repo'),
+                         {'master': 'def'})
+        self.assertEqual(self.fake.tags('myorg', 'someone_one-repo'),
+                         {'v1.0': 'def'})
+        self.assertEqual(self.fake.requests[('PATCH', 'update_ref')], 1)
+        self.assertEqual(self.fake.requests[('POST', 'create_ref')], 1)
+
+    def test_pagination(self):
+        """ Listings are paged with Link headers """
+        for i in range(250):
+            self.fake.add_repository('someone', 'repo-{:03d}'.format(i))
+
+        repositories = list_repositories('someone')
+
+        self.assertEqual(len(repositories), 250)
+        self.assertEqual(repositories[-1], 'repo-249')
+        self.assertEqual(self.fake.requests[('GET', 'list_repositories')], 3)
+
+    def test_conditional_requests(self):
+        """ Unchanged responses are 304s, which don't use up the limit """
+        cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_path)
+        self.use_client(GitHubClient(headers={},
+                                     cache=ResponseCache(cache_path)))
+        self.fake.add_repository('someone', 'one-repo')
+
+        self.assertEqual(list_repositories('someone'), ['one-repo'])
+        remaining = self.fake.remaining
+        self.assertEqual(list_repositories('someone'), ['one-repo'])
+        self.assertEqual(self.fake.remaining, remaining)
+
+    def test_rate_limit(self):
+        self.fake.rate_limit = self.fake.remaining = 1
+        self.fake.add_repository('someone', 'one-repo')
+
+        response = github.client.get(self.server.url + '/repos/someone/'
+                                     'one-repo')
+        self.assertEqual(response.headers['X-RateLimit-Remaining'], '0')
+        self.assertEqual(response.headers['X-RateLimit-Reset'], '4600')
+
+        response = github.client.get(self.server.url + '/repos/someone/'
+                                     'one-repo')
+        self.assertEqual(response.status_code, 403)
+
+        self.now = 5000
+        response = github.client.get(self.server.url + '/repos/someone/'
+                                     'one-repo')
+        self.assertEqual(response.status_code, 200)
+
+    def test_fork_delay(self):
+        """ New forks can't be read until they're ready """
+        self.fake.fork_delay = 10
+        self.fake.add_repository('someone', 'one-repo',
+                                 branches={'master': 'abc'})
+
+        github.fork_repository('someone', 'one-repo', 'myorg')
+        self.assertFalse(fork_ready('myorg', 'one-repo'))
+        self.now += 10
+        self.assertTrue(fork_ready('myorg', 'one-repo'))
+
+    def test_fork_name(self):
+        """ Forks get the name asked for, or a suffix if it's taken, and
+            an existing fork is returned under its own name """
+        for owner in ('someone', 'another', 'third'):
+            self.fake.add_repository(owner, 'one-repo',
+                                     branches={'master': 'abc'})
+
+        self.assertEqual(
+            github.fork_repository('someone', 'one-repo', 'myorg'),
+            'one-repo')
+        self.assertEqual(
+            github.fork_repository('another', 'one-repo', 'myorg'),
+            'one-repo-1')
+        self.assertEqual(
+            github.fork_repository('third', 'one-repo', 'myorg',
+                                   name='third_one-repo'),
+            'third_one-repo')
+        self.assertEqual(
+            github.fork_repository('someone', 'one-repo', 'myorg',
+                                   name='someone_one-repo'),
+            'one-repo')
+
+    def test_graphql(self):
+        self.fake.add_repository('someone', 'one-repo',
+                                 branches={'master': 'abc', 'dev': 'def'},
+                                 tags={'v1.0': '123'})
+
+        refs = list_refs_batch([('someone', 'one-repo'),
+                                ('someone', 'missing')])
+
+        self.assertEqual(refs, {
+            ('someone', 'one-repo'): {'refs/heads/master': 'abc',
+                                      'refs/heads/dev': 'def',
+                                      'refs/tags/v1.0': '123'},
+            ('someone', 'missing'): None,
+        })
+
+    def test_error_rate(self):
+        self.fake.error_rate = 1.0
+        with self.assertRaises(GitHubError):
+            list_repositories('someone')
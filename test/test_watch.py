@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+from unittest import mock
+
+from preserve.github import GitHubClient, GitHubError
+from preserve.testing import FakeGitHub, FakeGitHubServer
+from preserve.watch import EventFeed, Watcher, repository_changes
+
+
+def event(event_id, event_type, repo, **payload):
+    return {'id': str(event_id), 'type': event_type, 'repo': {'name': repo},
+            'payload': payload}
+
+
+class RepositoryChangesTestCase(TestCase):
+
+    @mock.patch('preserve.watch.logger')
+    def test_repository_changes(self, mock_logger):
+        # Newest first, as the feed lists them
+        events = [
+            event(7, 'WatchEvent', 'someone/one-repo', action='started'),
+            event(6, 'PushEvent', 'someone/new-repo',
+                  ref='refs/heads/master', head='abc'),
+            event(5, 'CreateEvent', 'someone/new-repo', ref=None,
+                  ref_type='repository'),
+            event(4, 'DeleteEvent', 'someone/two-repo', ref='old',
+                  ref_type='branch'),
+            event(3, 'PushEvent', 'another/one-repo',
+                  ref='refs/heads/master', head='abc'),
+            event(2, 'CreateEvent', 'someone/one-repo', ref='v1.0',
+                  ref_type='tag'),
+            event(1, 'PushEvent', 'someone/one-repo',
+                  ref='refs/heads/master', head='abc'),
+        ]
+
+        changes = repository_changes('someone', events)
+
+        self.assertEqual(list(changes.items()), [
+            ('one-repo', {'refs/heads/master', 'refs/tags/v1.0'}),
+            ('new-repo', None),
+        ])
+
+
+class WatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.fake = FakeGitHub()
+        self.server = FakeGitHubServer(self.fake).start()
+        self.addCleanup(self.server.stop)
+        for patcher in [
+                mock.patch('preserve.github.GITHUB_API_URL', self.server.url),
+                mock.patch('preserve.github.client',
+                           GitHubClient(headers={})),
+                mock.patch('preserve.orgs.logger'),
+                mock.patch('preserve.watch.logger')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.fake.add_repository('someone', 'one-repo',
+                                 branches={'master': 'abc'})
+        self.fake.add_repository('someone', 'two-repo',
+                                 branches={'master': 'abc'})
+        self.watcher = Watcher(['someone'], 'myorg')
+
+    def test_first_round_sweeps(self):
+        results = self.watcher.poll()
+
+        self.assertEqual(results, {'someone': ['forked', 'forked']})
+        self.assertEqual(self.fake.requests[('GET', 'list_repositories')], 1)
+
+    def test_targeted_update(self):
+        """ Only the refs that were pushed to are synced """
+        self.watcher.poll()
+        self.fake.push('someone', 'one-repo', 'refs/heads/master', 'def')
+        self.fake.push('someone', 'one-repo', 'refs/tags/v1.0', 'def')
+        self.fake.delete_ref('someone', 'two-repo', 'refs/heads/master')
+        self.fake.requests.clear()
+
+        results = self.watcher.poll()
+
+        self.assertEqual(results, {'someone': ['updated']})
+        self.assertEqual(
+            self.fake.repository('myorg', 'someone_one-repo')['refs'],
+            {'refs/heads/master': 'def', 'refs/tags/v1.0': 'def'})
+        # The deleted branch is kept
+        self.assertEqual(self.fake.branches('myorg', 'someone_two-repo'),
+                         {'master': 'abc'})
+        self.assertEqual(self.fake.requests[('GET', 'list_repositories')], 0)
+        self.assertEqual(self.fake.requests[('GET', 'list_refs')], 0)
+        self.assertEqual(self.fake.requests[('GET', 'get_ref')], 4)
+
+    def test_unchanged_feed(self):
+        """ An unchanged feed is revalidated for free """
+        self.watcher.poll()
+        remaining = self.fake.remaining
+
+        self.assertEqual(self.watcher.poll(), {'someone': []})
+        self.assertEqual(self.fake.remaining, remaining)
+
+    def test_new_repository(self):
+        self.watcher.poll()
+        self.fake.add_repository('someone', 'new-repo',
+                                 branches={'master': 'abc'})
+
+        self.assertEqual(self.watcher.poll(), {'someone': ['forked']})
+        self.assertIsNotNone(self.fake.repository('myorg',
+                                                  'someone_new-repo'))
+
+    def test_missing_fork(self):
+        """ A push to a repository without a fork preserves it instead """
+        self.watcher.poll()
+        self.fake.repositories.pop(('myorg', 'someone_one-repo'))
+        self.fake.push('someone', 'one-repo', 'refs/heads/master', 'def')
+
+        self.assertEqual(self.watcher.poll(), {'someone': ['forked']})
+        self.assertEqual(self.fake.branches('myorg', 'someone_one-repo'),
+                         {'master': 'def'})
+
+    def test_gap_sweeps(self):
+        """ More new events than the feed keeps means some were missed """
+        self.watcher.poll()
+        for i in range(301):
+            self.fake.push('someone', 'one-repo', 'refs/heads/master',
+                           str(i))
+        self.fake.requests.clear()
+
+        results = self.watcher.poll()
+
+        self.assertEqual(results, {'someone': ['updated', 'updated']})
+        self.assertEqual(self.fake.requests[('GET', 'list_events')], 3)
+        self.assertEqual(self.fake.requests[('GET', 'list_repositories')], 1)
+        self.assertEqual(self.fake.branches('myorg', 'someone_one-repo'),
+                         {'master': '300'})
+
+    def test_failure_sweeps(self):
+        """ An org whose round fails is swept in the next """
+        self.watcher.poll()
+        self.fake.push('someone', 'one-repo', 'refs/heads/master', 'def')
+        with mock.patch('preserve.watch.update_fork',
+                        side_effect=GitHubError('Server Error')), \
+                mock.patch('preserve.watch.preserve_repository',
+                           side_effect=GitHubError('Server Error')):
+            self.assertEqual(self.watcher.poll(), {})
+        self.fake.requests.clear()
+
+        self.assertEqual(self.watcher.poll(),
+                         {'someone': ['updated', 'updated']})
+        self.assertEqual(self.fake.requests[('GET', 'list_repositories')], 1)
+
+    def test_run(self):
+        """ Rounds are at least as far apart as GitHub asks """
+        clock = mock.Mock(side_effect=[0, 5, 60])
+        sleep = mock.Mock()
+        watcher = Watcher(['someone'], 'myorg', interval=10, clock=clock,
+                          sleep=sleep)
+
+        results = list(watcher.run(rounds=2))
+
+        self.assertEqual(results, [{'someone': ['forked', 'forked']},
+                                   {'someone': []}])
+        sleep.assert_called_once_with(55)
+        self.assertEqual(watcher.feeds['someone'].poll_interval, 60)
+
+
+class EventFeedTestCase(TestCase):
+
+    @mock.patch('preserve.github.client')
+    def test_error(self, mock_client):
+        mock_client.get.return_value.status_code = 404
+        mock_client.get.return_value.json.return_value = {
+            'message': 'Not Found'}
+
+        with self.assertRaises(GitHubError):
+            EventFeed('someone').poll()
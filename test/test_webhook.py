@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest import TestCase
+from unittest import mock
+
+import requests
+
+from preserve.github import GitHubClient
+from preserve.testing import FakeGitHub, FakeGitHubServer
+from preserve.webhook import (
+    UpdateQueue,
+    WebhookReceiver,
+    WebhookServer,
+    payload_changes,
+    signature,
+    verify_signature,
+)
+
+SECRET = 'It\'s a Secret to Everybody'
+
+
+def repository_payload(org, repo, **payload):
+    payload['repository'] = {'name': repo, 'owner': {'login': org},
+                             'private': False}
+    return payload
+
+
+class PayloadTestCase(TestCase):
+
+    def test_verify_signature(self):
+        body = b'Hello, World!'
+        # The example from GitHub's documentation on validating deliveries
+        self.assertEqual(
+            signature(SECRET, body),
+            'sha256=757107ea0eb2509fc211221cce984b8a37570b6d7586c22c46f4379c8b043e17')  # noqa
+        self.assertTrue(verify_signature(SECRET, body,
+                                         signature(SECRET, body)))
+        self.assertFalse(verify_signature(SECRET, body,
+                                          signature('wrong', body)))
+        self.assertFalse(verify_signature(SECRET, body, None))
+
+    def test_payload_changes(self):
+        self.assertEqual(
+            payload_changes('push', repository_payload(
+                'someone', 'one-repo', ref='refs/heads/master')),
+            ('someone', 'one-repo', {'refs/heads/master'}))
+        self.assertEqual(
+            payload_changes('create', repository_payload(
+                'someone', 'one-repo', ref='v1.0', ref_type='tag')),
+            ('someone', 'one-repo', {'refs/tags/v1.0'}))
+        self.assertEqual(
+            payload_changes('repository', repository_payload(
+                'someone', 'one-repo', action='created')),
+            ('someone', 'one-repo', None))
+
+        # Deleted refs are kept, and other events are ignored
+        self.assertIsNone(payload_changes('push', repository_payload(
+            'someone', 'one-repo', ref='refs/heads/old', deleted=True)))
+        self.assertIsNone(payload_changes('repository', repository_payload(
+            'someone', 'one-repo', action='deleted')))
+        self.assertIsNone(payload_changes('issues', repository_payload(
+            'someone', 'one-repo', action='opened')))
+        self.assertIsNone(payload_changes('ping', {'zen': 'Keep it simple'}))
+
+
+class UpdateQueueTestCase(TestCase):
+
+    @mock.patch('preserve.webhook.update_repository')
+    def test_coalesce(self, mock_update_repository):
+        """ A burst of changes to a repository is made at once """
+        queue = UpdateQueue('myorg', delay=0)
+        queue.add('someone', 'one-repo', {'refs/heads/master'})
+        queue.add('someone', 'one-repo', {'refs/tags/v1.0'})
+        queue.add('someone', 'two-repo', {'refs/heads/master'})
+        queue.add('someone', 'two-repo', None)
+
+        queue.start()
+        queue.join()
+        queue.stop()
+
+        self.assertEqual(mock_update_repository.call_count, 2)
+        mock_update_repository.assert_has_calls([
+            mock.call('someone', 'one-repo', 'myorg',
+                      {'refs/heads/master', 'refs/tags/v1.0'},
+                      state=None, index=None),
+            mock.call('someone', 'two-repo', 'myorg', None,
+                      state=None, index=None),
+        ], any_order=True)
+
+    @mock.patch('preserve.webhook.update_repository')
+    def test_stop(self, mock_update_repository):
+        """ Changes that aren't due yet are made when the queue stops """
+        queue = UpdateQueue('myorg', delay=3600).start()
+        queue.add('someone', 'one-repo', {'refs/heads/master'})
+
+        queue.stop()
+
+        mock_update_repository.assert_called_once_with(
+            'someone', 'one-repo', 'myorg', {'refs/heads/master'},
+            state=None, index=None)
+
+    @mock.patch('preserve.webhook.logger')
+    @mock.patch('preserve.webhook.update_repository')
+    def test_failure(self, mock_update_repository, mock_logger):
+        """ A failed update doesn't stop the worker """
+        mock_update_repository.side_effect = [ValueError('oops'), 'updated']
+        queue = UpdateQueue('myorg', delay=0).start()
+        queue.add('someone', 'one-repo', None)
+        queue.join()
+        queue.add('someone', 'two-repo', None)
+        queue.join()
+        queue.stop()
+
+        self.assertEqual(mock_update_repository.call_count, 2)
+        self.assertEqual(mock_logger.error.call_count, 1)
+
+
+class WebhookServerTestCase(TestCase):
+
+    def setUp(self):
+        self.fake = FakeGitHub()
+        self.github_server = FakeGitHubServer(self.fake).start()
+        self.addCleanup(self.github_server.stop)
+        for patcher in [
+                mock.patch('preserve.github.GITHUB_API_URL',
+                           self.github_server.url),
+                mock.patch('preserve.github.client',
+                           GitHubClient(headers={})),
+                mock.patch('preserve.orgs.logger'),
+                mock.patch('preserve.watch.logger'),
+                mock.patch('preserve.webhook.logger')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.fake.add_repository('someone', 'one-repo',
+                                 branches={'master': 'abc'})
+        self.fake.add_repository('myorg', 'someone_one-repo',
+                                 branches={'master': 'abc'}, fork=True)
+
+        self.queue = UpdateQueue('myorg', delay=0)
+        receiver = WebhookReceiver(self.queue, SECRET, orgs=['someone'])
+        self.server = WebhookServer(receiver, port=0).start()
+        self.addCleanup(self.server.stop)
+
+    def deliver(self, event, payload, secret=SECRET):
+        body = json.dumps(payload).encode('utf-8')
+        return requests.post(self.server.url, data=body, headers={
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': event,
+            'X-Hub-Signature-256': signature(secret, body),
+        })
+
+    def test_push(self):
+        """ Only the pushed refs are synced """
+        self.fake.push('someone', 'one-repo', 'refs/heads/master', 'def')
+        self.fake.push('someone', 'one-repo', 'refs/tags/v1.0', 'def')
+        self.fake.requests.clear()
+
+        response = self.deliver('push', repository_payload(
+            'someone', 'one-repo', ref='refs/heads/master'))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.deliver('create', repository_payload(
+            'someone', 'one-repo', ref='v1.0', ref_type='tag')).status_code,
+            202)
+        self.queue.join()
+
+        self.assertEqual(
+            self.fake.repository('myorg', 'someone_one-repo')['refs'],
+            {'refs/heads/master': 'def', 'refs/tags/v1.0': 'def'})
+        self.assertEqual(self.fake.requests[('GET', 'list_refs')], 0)
+
+    def test_new_repository(self):
+        self.fake.add_repository('someone', 'new-repo',
+                                 branches={'master': 'abc'})
+
+        response = self.deliver('repository', repository_payload(
+            'someone', 'new-repo', action='created'))
+        self.queue.join()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertIsNotNone(self.fake.repository('myorg',
+                                                  'someone_new-repo'))
+
+    def test_bad_signature(self):
+        response = self.deliver('push', repository_payload(
+            'someone', 'one-repo', ref='refs/heads/master'), secret='wrong')
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.fake.request_count, 0)
+
+    def test_ignored(self):
+        """ Pings, and deliveries for other orgs, are acknowledged but
+            ignored """
+        self.assertEqual(self.deliver('ping', {'zen': 'Keep it simple'})
+                         .json(), {'message': 'pong'})
+        response = self.deliver('push', repository_payload(
+            'another', 'one-repo', ref='refs/heads/master'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'message': 'Ignored'})
+        self.assertEqual(self.queue.pending, {})
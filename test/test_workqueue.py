@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import collections
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from unittest import mock
+
+import requests
+
+from preserve.github import GitHubClient, GitHubError, Repository
+from preserve.testing import FakeGitHub, FakeGitHubServer
+from preserve.workqueue import (
+    WorkQueue,
+    enqueue_organizations,
+    run_worker,
+)
+
+
+def repositories(*names):
+    return [Repository(name) for name in names]
+
+
+class WorkQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.queue = WorkQueue(':memory:', visibility_timeout=60,
+                               max_attempts=2, clock=lambda: self.now)
+
+    def test_lease_complete(self):
+        self.assertEqual(self.queue.enqueue(
+            'someone', repositories('one-repo', 'two-repo'), 'myorg'), 2)
+
+        first, = self.queue.lease('worker-1')
+        second, = self.queue.lease('worker-2')
+        self.assertEqual(first.repository.name, 'one-repo')
+        self.assertEqual(second.repository.name, 'two-repo')
+        self.assertEqual(self.queue.lease('worker-3'), [])
+
+        self.assertTrue(self.queue.complete(first, 'forked'))
+        self.assertEqual(self.queue.counts(), {'pending': 0, 'leased': 1,
+                                               'done': 1, 'failed': 0})
+
+    def test_lease_expires(self):
+        """ A task whose worker goes quiet is leased to another """
+        self.queue.enqueue('someone', repositories('one-repo'), 'myorg')
+        first, = self.queue.lease('worker-1')
+
+        self.now += 30
+        self.assertTrue(self.queue.extend(first))
+        self.now += 59
+        self.assertEqual(self.queue.lease('worker-2'), [])
+
+        self.now += 1
+        second, = self.queue.lease('worker-2')
+        self.assertEqual(second.attempts, 2)
+        # The first worker can no longer finish it
+        self.assertFalse(self.queue.complete(first, 'updated'))
+        self.assertFalse(self.queue.extend(first))
+        self.assertTrue(self.queue.complete(second, 'updated'))
+
+    def test_lease_expires_too_often(self):
+        self.queue.enqueue('someone', repositories('one-repo'), 'myorg')
+        self.queue.lease('worker-1')
+        self.now += 60
+        self.queue.lease('worker-2')
+        self.now += 60
+
+        self.assertEqual(self.queue.lease('worker-3'), [])
+        self.assertEqual(self.queue.counts()['failed'], 1)
+
+    def test_fail(self):
+        """ Failed tasks are retried up to max_attempts times """
+        self.queue.enqueue('someone', repositories('one-repo'), 'myorg')
+
+        task, = self.queue.lease('worker-1')
+        self.assertTrue(self.queue.fail(task, 'Server Error'))
+        self.assertEqual(self.queue.counts()['pending'], 1)
+
+        task, = self.queue.lease('worker-1')
+        self.queue.fail(task, 'Server Error')
+        self.assertEqual(self.queue.counts()['failed'], 1)
+        self.assertEqual(self.queue.lease('worker-1'), [])
+
+    def test_enqueue_again(self):
+        """ Finished tasks are queued again, but leased ones are left """
+        self.queue.enqueue('someone', repositories('one-repo', 'two-repo'),
+                           'myorg')
+        first, second = self.queue.lease('worker-1', limit=2)
+        self.queue.complete(first, 'updated')
+
+        self.assertEqual(self.queue.enqueue(
+            'someone', repositories('one-repo', 'two-repo', 'new-repo'),
+            'myorg'), 2)
+        self.assertEqual(self.queue.counts(), {'pending': 2, 'leased': 1,
+                                               'done': 0, 'failed': 0})
+
+    @mock.patch('preserve.workqueue.list_repository_details')
+    @mock.patch('preserve.workqueue.logger')
+    def test_enqueue_organizations(self, mock_logger,
+                                   mock_list_repository_details):
+        mock_list_repository_details.side_effect = [
+            repositories('one-repo'), repositories('two-repo', 'three-repo')]
+        self.assertEqual(enqueue_organizations(
+            self.queue, ['someone', 'another'], 'myorg'), 3)
+
+
+class RunWorkerTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.queue_path = os.path.join(self.path, 'queue.db')
+
+        logger_patcher = mock.patch('preserve.orgs.logger')
+        logger_patcher.start()
+        self.addCleanup(logger_patcher.stop)
+        logger_patcher = mock.patch('preserve.workqueue.logger')
+        logger_patcher.start()
+        self.addCleanup(logger_patcher.stop)
+
+    @mock.patch('preserve.workqueue.preserve_repository')
+    def test_run_worker_failures(self, mock_preserve_repository):
+        """ Tasks that fail are retried """
+        mock_preserve_repository.side_effect = [
+            GitHubError('Server Error'), 'forked', 'updated']
+        queue = WorkQueue(self.queue_path)
+        queue.enqueue('someone', repositories('one-repo', 'two-repo'),
+                      'myorg')
+
+        outcomes = run_worker(queue, index=False, poll_interval=0)
+
+        self.assertEqual(outcomes, {'forked': 1, 'updated': 1, 'failed': 1})
+        self.assertEqual(queue.counts()['done'], 2)
+
+    @mock.patch('preserve.workqueue.preserve_repository')
+    def test_run_worker_network_errors(self, mock_preserve_repository):
+        """ Errors that aren't from GitHub don't stop the worker or leave
+            their leases held """
+        mock_preserve_repository.side_effect = [
+            requests.ConnectionError('Connection reset'),
+            requests.Timeout('Read timed out'), 'forked', 'updated']
+        queue = WorkQueue(self.queue_path)
+        queue.enqueue('someone', repositories('one-repo', 'two-repo'),
+                      'myorg')
+
+        outcomes = run_worker(queue, workers=2, index=False, poll_interval=0)
+
+        self.assertEqual(outcomes, {'forked': 1, 'updated': 1, 'failed': 2})
+        self.assertEqual(queue.counts(), {'pending': 0, 'leased': 0,
+                                          'done': 2, 'failed': 0})
+
+    def test_run_workers(self):
+        """ Workers sharing a queue preserve each repository once """
+        fake = FakeGitHub()
+        for i in range(20):
+            name = 'repo-{:02d}'.format(i)
+            fake.add_repository('someone', name, branches={'master': 'abc'})
+            if i % 2:
+                fake.add_repository('myorg', 'someone_' + name,
+                                    branches={'master': 'old'}, fork=True)
+
+        results = []
+        with FakeGitHubServer(fake) as server, \
+                mock.patch('preserve.github.GITHUB_API_URL', server.url), \
+                mock.patch('preserve.github.client',
+                           GitHubClient(headers={})):
+            enqueue_organizations(WorkQueue(self.queue_path), ['someone'],
+                                  'myorg')
+
+            def work(worker_id):
+                results.append(run_worker(WorkQueue(self.queue_path),
+                                          worker_id=worker_id, workers=2,
+                                          poll_interval=0.01))
+
+            threads = [threading.Thread(target=work, args=(str(i),))
+                       for i in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(sum(results, collections.Counter()),
+                         {'forked': 10, 'updated': 10})
+        self.assertEqual(fake.requests[('POST', 'create_fork')], 10)
+        self.assertEqual(fake.requests[('PATCH', 'update_ref')], 10)
+        self.assertEqual(fake.branches('myorg', 'someone_repo-00'),
+                         {'master': 'abc'})